@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
-from .models import DefaultAuthUserExtend
+from .models import DefaultAuthUserExtend, RegisteredService, ServiceRoute, JWTSigningKey
 
 
 @admin.register(DefaultAuthUserExtend)
@@ -36,3 +36,37 @@ class DefaultAuthUserExtendAdmin(UserAdmin):
         if request.user.is_superuser:
             return qs  # Superuser can see all users
 
+
+
+class ServiceRouteInline(admin.TabularInline):
+    model = ServiceRoute
+    fields = ('entity', 'status')
+    extra = 1
+
+
+@admin.register(RegisteredService)
+class RegisteredServiceAdmin(admin.ModelAdmin):
+    # Changes reach every worker within SERVICE_REGISTRY['REFRESH_INTERVAL'] seconds, no restart needed.
+    list_display = ('name', 'api', 'post_auth', 'status', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('name', 'routes__entity')
+    inlines = [ServiceRouteInline]
+
+
+@admin.register(ServiceRoute)
+class ServiceRouteAdmin(admin.ModelAdmin):
+    list_display = ('entity', 'service', 'status', 'updated_at')
+    list_filter = ('status', 'service')
+    search_fields = ('entity',)
+
+
+@admin.register(JWTSigningKey)
+class JWTSigningKeyAdmin(admin.ModelAdmin):
+    # Keys are generated by the rotate_signing_keys command; retiring one early here stops it signing.
+    list_display = ('kid', 'algorithm', 'active_from', 'retired_at', 'created_at')
+    list_filter = ('algorithm',)
+    fields = ('kid', 'algorithm', 'public_key', 'active_from', 'retired_at', 'created_at')
+    readonly_fields = ('kid', 'algorithm', 'public_key', 'active_from', 'created_at')
+
+    def has_add_permission(self, request):
+        return False
@@ -8,4 +8,9 @@ class AegisConfig(AppConfig):
 
     def ready(self):
         import aegis.signals
+        # Connects the receivers keeping the token caches in step with users and tokens
+        import gatekeeper.authentication
+
+        from gatekeeper.jwt_keys import install_token_backend
+        install_token_backend()
 
@@ -1,26 +1,57 @@
 # aegis/management/commands/check_api_health.py
 
-from django.core.management.base import BaseCommand
-import requests
+import json
 import logging
 
+from django.core.management.base import BaseCommand, CommandError
+
+from gatekeeper.proxy.health import probe_all
+from gatekeeper.proxy.registry import service_registry
+from gatekeeper.proxy.resilience import published_breaker_states
+
 logger = logging.getLogger('aegis')
 
+
 class Command(BaseCommand):
-    help = 'Check health status of services'
-
-    def handle(self, *args, **kwargs):
-        services = {
-            'Weather Data': "http://weather_data_service/api/health",
-            'Farm Calendar': "http://farm_calendar_service/api/health"
-        }
-
-        for service_name, url in services.items():
-            try:
-                response = requests.get(url)
-                if response.status_code == 200:
-                    logger.info(f"{service_name} is healthy")
-                else:
-                    logger.warning(f"{service_name} is not healthy: {response.status_code}")
-            except requests.exceptions.RequestException as e:
-                logger.error(f"{service_name} health check failed: {e}")
+    help = 'Probe every instance of the registered services concurrently and print their health as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--service', action='append', dest='services',
+                            help='Only probe this service, may be given several times.')
+        parser.add_argument('--fail-unhealthy', action='store_true',
+                            help='Exit with an error when an instance is unhealthy.')
+
+    def handle(self, *args, **options):
+        services = service_registry.refresh().services
+        if options['services']:
+            unknown = set(options['services']) - set(services)
+            if unknown:
+                raise CommandError(f"Unknown services: {', '.join(sorted(unknown))}")
+            services = {name: services[name] for name in options['services']}
+
+        report = {}
+        for service_name in services:
+            report[service_name] = {
+                'healthy': True,
+                'instances': [],
+                # Circuit breaker states the reverse proxy workers published to the shared cache
+                'circuit_breakers': {str(pid): state['state']
+                                     for pid, state in sorted(published_breaker_states(service_name).items())},
+            }
+        for result in probe_all(services):
+            entry = report[result['service']]
+            entry['instances'].append({
+                'url': result['url'],
+                'healthy': result['healthy'],
+                'status': result['status'],
+                'latency_ms': round(result['latency'] * 1000, 1) if result['latency'] is not None else None,
+                'error': result['error'],
+            })
+            if not result['healthy']:
+                entry['healthy'] = False
+                logger.warning(f"{result['service']} instance {result['url']} is not healthy: "
+                               f"{result['error'] or result['status']}")
+
+        self.stdout.write(json.dumps({'services': report}, indent=2))
+        if options['fail_unhealthy'] and not all(entry['healthy'] for entry in report.values()):
+            raise CommandError('Some service instances are unhealthy.')
@@ -0,0 +1,88 @@
+# aegis/management/commands/load_request_logs.py
+
+import glob
+import gzip
+import json
+import logging
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from aegis.models import RequestLog
+from gatekeeper.request_log import RECORD_FIELDS, get_request_logging_config
+
+logger = logging.getLogger('aegis')
+
+
+class Command(BaseCommand):
+    help = ('Bulk load the rotated JSON-lines request log segments into the activity_log table, '
+            'deleting each segment once it is loaded.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help="Segment directory, REQUEST_LOGGING['DIRECTORY'] by default.")
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per insert.')
+        parser.add_argument('--keep', action='store_true', help='Keep the segments after loading them.')
+        parser.add_argument('--stale-after', type=int, metavar='SECONDS',
+                            help='Also load the current files of workers that have not written for this long, '
+                                 'e.g. of workers that were killed.')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or get_request_logging_config()['DIRECTORY']
+        if not os.path.isdir(directory):
+            raise CommandError(f"No request log directory {directory}")
+
+        segments = sorted(glob.glob(os.path.join(directory, 'requests-*.jsonl'))
+                          + glob.glob(os.path.join(directory, 'requests-*.jsonl.gz')))
+        if options['stale_after'] is not None:
+            cutoff = time.time() - options['stale_after']
+            segments += sorted(path for path in glob.glob(os.path.join(directory, 'current-*.jsonl'))
+                               if os.path.getmtime(path) < cutoff)
+
+        loaded = skipped = 0
+        for segment in segments:
+            rows, bad = self.load(segment, options['batch_size'])
+            loaded += rows
+            skipped += bad
+            if not options['keep']:
+                os.remove(segment)
+            logger.info(f"Loaded {rows} request log records from {segment}")
+        self.stdout.write(f"Loaded {loaded} records from {len(segments)} segments, skipped {skipped} malformed lines.")
+
+    def load(self, segment, batch_size):
+        opener = gzip.open if segment.endswith('.gz') else open
+        rows = bad = 0
+        batch = []
+        # A segment is loaded completely or not at all, so a failed run can simply be repeated
+        with transaction.atomic(), opener(segment, 'rt', encoding='utf-8') as lines:
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                    record = {field: record.get(field) for field in RECORD_FIELDS}
+                    record['timestamp'] = parse_datetime(record['timestamp'])
+                    if record['timestamp'] is None:
+                        raise ValueError('no timestamp')
+                except (ValueError, TypeError, AttributeError):
+                    # e.g. the last line of a worker that was killed mid-write
+                    bad += 1
+                    continue
+                batch.append(RequestLog(**record))
+                if len(batch) >= batch_size:
+                    rows += self.insert(batch)
+                    batch = []
+            if batch:
+                rows += self.insert(batch)
+        return rows, bad
+
+    def insert(self, batch):
+        # Users deleted since the request was logged are unset, as the SET_NULL foreign key would have done
+        user_ids = {row.user_id for row in batch if row.user_id is not None}
+        existing = set(get_user_model().objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+        for row in batch:
+            if row.user_id not in existing:
+                row.user_id = None
+        RequestLog.objects.bulk_create(batch)
+        return len(batch)
@@ -0,0 +1,31 @@
+# aegis/management/commands/prune_activity_log.py
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from gatekeeper.activity_log import get_activity_log_config, prune_activity_log
+from gatekeeper.traffic import prune_rollups
+
+logger = logging.getLogger('aegis')
+
+
+class Command(BaseCommand):
+    help = ('Remove the activity_log requests older than ACTIVITY_LOG RETENTION_DAYS after summarizing them '
+            'into hourly rollups: whole daily partitions on PostgreSQL, batched deletes otherwise. '
+            'Also creates the upcoming partitions and deletes the traffic rollups past their retention. '
+            'Meant to run daily from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Days of requests to keep, RETENTION_DAYS by default.')
+        parser.add_argument('--batch-size', type=int, help='Rows per delete, PRUNE_BATCH_SIZE by default.')
+        parser.add_argument('--pause', type=float, help='Seconds between deletes, PRUNE_PAUSE by default.')
+        parser.add_argument('--no-rollup', action='store_true', help='Delete without summarizing the requests.')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else get_activity_log_config()['RETENTION_DAYS']
+        removed = prune_activity_log(days=days, batch_size=options['batch_size'], pause=options['pause'],
+                                     rollup=not options['no_rollup'])
+        logger.info(f"Pruned {removed} activity log requests older than {days} days")
+        self.stdout.write(f"Removed {removed} requests older than {days} days.")
+        self.stdout.write(f"Removed {prune_rollups()} expired traffic rollups.")
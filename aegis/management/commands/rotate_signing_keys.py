@@ -0,0 +1,26 @@
+# aegis/management/commands/rotate_signing_keys.py
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from gatekeeper.jwt_keys import get_jwt_signing_config, rotate_signing_keys
+
+logger = logging.getLogger('aegis')
+
+
+class Command(BaseCommand):
+    help = ('Add a new JWT signing key when the current one is older than JWT_SIGNING ROTATE_AFTER, '
+            'and delete the keys no unexpired token can be signed with. Meant to run from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Rotate even when the current key is not due yet.')
+
+    def handle(self, *args, **options):
+        config = get_jwt_signing_config()
+        key = rotate_signing_keys(force=options['force'], config=config)
+        if key is None:
+            self.stdout.write('No rotation due.')
+        else:
+            self.stdout.write(f"Added {key.algorithm} key {key.kid}, signing from {key.active_from.isoformat()}.")
@@ -0,0 +1,170 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:23
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aegis', '0001_initial'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegisteredService',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, validators=[django.core.validators.RegexValidator(message='Invalid characters', regex='^[a-zA-Z0-9_-]+$')])),
+                ('api', models.TextField(help_text='Base URL of each instance of the service, one per line.')),
+                ('post_auth', models.URLField(blank=True, help_text='Where users logging in for this service are sent with their token.', max_length=300, null=True)),
+                ('options', models.JSONField(blank=True, default=dict, help_text='Per service overrides, e.g. {"pool": {...}, "cache": {...}, "circuit_breaker": {...}, "rate_limit": {...}}.')),
+                ('status', models.BooleanField(default=True, verbose_name='Status')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+            ],
+            options={
+                'verbose_name': 'Registered Service',
+                'verbose_name_plural': 'Registered Services',
+                'db_table': 'registered_service',
+            },
+        ),
+        migrations.CreateModel(
+            name='ServiceRegistryVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+            ],
+            options={
+                'verbose_name': 'Service Registry Version',
+                'db_table': 'service_registry_version',
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='defaultauthuserextend',
+            options={'verbose_name': 'User Master', 'verbose_name_plural': 'User Masters'},
+        ),
+        migrations.AlterModelOptions(
+            name='historicaldefaultauthuserextend',
+            options={'get_latest_by': ('history_date', 'history_id'), 'ordering': ('-history_date', '-history_id'), 'verbose_name': 'historical User Master', 'verbose_name_plural': 'historical User Masters'},
+        ),
+        migrations.CreateModel(
+            name='AdminMenuMaster',
+            fields=[
+                ('id', models.SmallAutoField(db_column='id', db_index=True, editable=False, primary_key=True, serialize=False, unique=True, verbose_name='ID')),
+                ('menu_name', models.CharField(max_length=30, unique=True, validators=[django.core.validators.RegexValidator(message='Invalid characters', regex='^[a-zA-Z0-9()\\s]+$')])),
+                ('menu_icon', models.CharField(blank=True, default='list', max_length=20, null=True, validators=[django.core.validators.RegexValidator(message='Invalid characters', regex='^[a-z0-9-]+$')])),
+                ('menu_route', models.CharField(blank=True, max_length=30, null=True, validators=[django.core.validators.RegexValidator(message='Invalid characters', regex='^[a-zA-Z0-9\\s-]+$')])),
+                ('menu_access', models.CharField(blank=True, max_length=30, null=True, validators=[django.core.validators.RegexValidator(message='Invalid characters', regex='^[a-zA-Z0-9\\s-]+$')])),
+                ('menu_order', models.SmallIntegerField(blank=True, null=True, validators=[django.core.validators.RegexValidator(message='Invalid characters', regex='^[0-9]+$')])),
+                ('status', models.BooleanField(default=True, verbose_name='Status')),
+                ('deleted', models.BooleanField(default=False, verbose_name='Is Deleted')),
+                ('deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Deleted At')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('parent_id', models.ForeignKey(blank=True, db_column='parent_id', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='submenus', to='aegis.adminmenumaster')),
+            ],
+            options={
+                'verbose_name': 'Admin Menu',
+                'verbose_name_plural': 'Admin Menus',
+                'db_table': 'admin_menu_master',
+            },
+        ),
+        migrations.CreateModel(
+            name='PermissionMaster',
+            fields=[
+                ('id', models.AutoField(db_column='id', db_index=True, editable=False, primary_key=True, serialize=False, unique=True, verbose_name='ID')),
+                ('action', models.CharField(choices=[('add', 'add'), ('edit', 'edit'), ('view', 'view'), ('delete', 'delete')], max_length=20)),
+                ('is_virtual', models.BooleanField(default=False)),
+                ('status', models.BooleanField(default=True, verbose_name='Status')),
+                ('deleted', models.BooleanField(default=False, verbose_name='Is Deleted')),
+                ('deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Deleted At')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('menu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='aegis.adminmenumaster')),
+            ],
+            options={
+                'verbose_name': 'Permission',
+                'verbose_name_plural': 'Permissions',
+                'db_table': 'permission_master',
+                'unique_together': {('menu', 'action')},
+            },
+        ),
+        migrations.CreateModel(
+            name='GroupCustomPermissions',
+            fields=[
+                ('id', models.AutoField(db_column='id', db_index=True, editable=False, primary_key=True, serialize=False, unique=True, verbose_name='ID')),
+                ('status', models.BooleanField(default=True, verbose_name='Status')),
+                ('deleted', models.BooleanField(default=False, verbose_name='Is Deleted')),
+                ('deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Deleted At')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.group')),
+                ('permission_names', models.ManyToManyField(to='aegis.permissionmaster')),
+            ],
+            options={
+                'verbose_name': 'Group Custom Permission',
+                'verbose_name_plural': 'Group Custom Permissions',
+                'db_table': 'custom_group_permissions',
+            },
+        ),
+        migrations.CreateModel(
+            name='RequestLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.CharField(max_length=45)),
+                ('user_agent', models.TextField()),
+                ('path', models.CharField(max_length=200)),
+                ('query_string', models.TextField()),
+                ('body', models.TextField()),
+                ('method', models.CharField(max_length=10)),
+                ('response_status', models.IntegerField()),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Activity Log',
+                'verbose_name_plural': 'Activity Logs',
+                'db_table': 'activity_log',
+            },
+        ),
+        migrations.CreateModel(
+            name='ServiceRoute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(help_text='Path segments under /api/resources/ served by the service, e.g. FarmAssets.', max_length=200, unique=True)),
+                ('status', models.BooleanField(default=True, verbose_name='Status')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='routes', to='aegis.registeredservice')),
+            ],
+            options={
+                'verbose_name': 'Service Route',
+                'verbose_name_plural': 'Service Routes',
+                'db_table': 'service_route',
+            },
+        ),
+        migrations.CreateModel(
+            name='CustomPermissions',
+            fields=[
+                ('id', models.AutoField(db_column='id', db_index=True, editable=False, primary_key=True, serialize=False, unique=True, verbose_name='ID')),
+                ('status', models.BooleanField(default=True, verbose_name='Status')),
+                ('deleted', models.BooleanField(default=False, verbose_name='Is Deleted')),
+                ('deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Deleted At')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('permission_name', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='aegis.permissionmaster')),
+            ],
+            options={
+                'verbose_name': 'Custom Permission',
+                'verbose_name_plural': 'Custom Permissions',
+                'db_table': 'custom_permissions',
+                'unique_together': {('user', 'permission_name')},
+            },
+        ),
+    ]
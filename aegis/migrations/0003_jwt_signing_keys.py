@@ -0,0 +1,32 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aegis', '0002_service_registry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JWTSigningKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kid', models.CharField(editable=False, max_length=64, unique=True, verbose_name='Key ID')),
+                ('algorithm', models.CharField(editable=False, max_length=10)),
+                ('private_key', models.TextField(editable=False)),
+                ('public_key', models.TextField(editable=False)),
+                ('active_from', models.DateTimeField(verbose_name='Active From')),
+                ('retired_at', models.DateTimeField(blank=True, null=True, verbose_name='Retired At')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+            ],
+            options={
+                'verbose_name': 'JWT Signing Key',
+                'verbose_name_plural': 'JWT Signing Keys',
+                'db_table': 'jwt_signing_key',
+                'ordering': ('-active_from',),
+            },
+        ),
+    ]
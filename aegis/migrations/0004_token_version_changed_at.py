@@ -0,0 +1,23 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aegis', '0003_jwt_signing_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='defaultauthuserextend',
+            name='token_version_changed_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicaldefaultauthuserextend',
+            name='token_version_changed_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,120 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:53
+
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# The ACTIVITY_LOG defaults when this migration was written, frozen so later settings
+# don't change what it does
+RETENTION_DAYS = 90
+PARTITIONS_AHEAD = 7
+
+
+def day_start(moment):
+    return datetime.combine(moment.astimezone(dt_timezone.utc).date(), dt_time.min, tzinfo=dt_timezone.utc)
+
+
+def partition_name(day):
+    return f'activity_log_p{day:%Y%m%d}'
+
+
+def partition_activity_log(apps, schema_editor):
+    """
+    On PostgreSQL, turn activity_log into a table partitioned by day on timestamp. The
+    rows are copied over: the last RETENTION_DAYS days into their partitions, older ones
+    into the default partition, from where prune_activity_log deletes them. The copy runs
+    in the migration's transaction, so activity_log can't be written to until it is done.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    RequestLog = apps.get_model('aegis', 'RequestLog')
+    users_table = RequestLog._meta.get_field('user').related_model._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, 'activity_log')
+        cursor.execute('SELECT min("timestamp") FROM activity_log')
+        oldest = cursor.fetchone()[0]
+    primary_key = next(name for name, constraint in constraints.items() if constraint['primary_key'])
+    foreign_key = next(name for name, constraint in constraints.items() if constraint['foreign_key'])
+    user_index = next((name for name, constraint in constraints.items()
+                       if constraint['index'] and constraint['columns'] == ['user_id']), None)
+
+    today = day_start(timezone.now())
+    day = max(day_start(oldest), today - timedelta(days=RETENTION_DAYS)) if oldest else today
+    days = []
+    while day <= today + timedelta(days=PARTITIONS_AHEAD):
+        days.append(day)
+        day += timedelta(days=1)
+
+    execute = schema_editor.execute
+    execute('ALTER TABLE activity_log RENAME TO activity_log_unpartitioned')
+    execute(f'ALTER INDEX "{primary_key}" RENAME TO activity_log_unpartitioned_pkey')
+    if user_index:
+        execute(f'ALTER INDEX "{user_index}" RENAME TO activity_log_unpartitioned_user_id')
+    # The partition key has to be part of the primary key, and identity columns can't be partitioned
+    execute('CREATE TABLE activity_log (LIKE activity_log_unpartitioned INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE ("timestamp")')
+    execute('CREATE SEQUENCE activity_log_id_seq_new OWNED BY activity_log.id')
+    execute("ALTER TABLE activity_log ALTER COLUMN id SET DEFAULT nextval('activity_log_id_seq_new')")
+    execute(f'ALTER TABLE activity_log ADD CONSTRAINT "{primary_key}" PRIMARY KEY (id, "timestamp")')
+    execute(f'ALTER TABLE activity_log ADD CONSTRAINT "{foreign_key}" FOREIGN KEY (user_id) '
+            f'REFERENCES "{users_table}" (id) DEFERRABLE INITIALLY DEFERRED')
+    if user_index:
+        execute(f'CREATE INDEX "{user_index}" ON activity_log (user_id)')
+    execute('CREATE TABLE activity_log_default PARTITION OF activity_log DEFAULT')
+    for day in days:
+        execute(f'CREATE TABLE "{partition_name(day)}" PARTITION OF activity_log '
+                f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')")
+    execute('INSERT INTO activity_log SELECT * FROM activity_log_unpartitioned')
+    execute("SELECT setval('activity_log_id_seq_new', COALESCE((SELECT max(id) FROM activity_log), 0) + 1, false)")
+    execute('DROP TABLE activity_log_unpartitioned')
+    execute('ALTER SEQUENCE activity_log_id_seq_new RENAME TO activity_log_id_seq')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aegis', '0005_request_log_timestamp'),
+    ]
+
+    operations = [
+        # Before the indexes, which are then created on every partition
+        migrations.RunPython(partition_activity_log, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='RequestLogHourly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('path', models.CharField(max_length=200)),
+                ('method', models.CharField(max_length=10)),
+                ('response_status', models.IntegerField()),
+                ('requests', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Hourly Activity',
+                'verbose_name_plural': 'Hourly Activity',
+                'db_table': 'activity_log_hourly',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['-timestamp'], name='activity_log_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['user', '-timestamp'], name='activity_log_user_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['path', '-timestamp'], name='activity_log_path_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['response_status', '-timestamp'], name='activity_log_status_ts_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='requestloghourly',
+            constraint=models.UniqueConstraint(fields=('hour', 'path', 'method', 'response_status'), name='activity_log_hourly_key'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aegis', '0006_activity_log_indexes_and_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrafficHour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('route', models.CharField(max_length=200)),
+                ('service', models.CharField(max_length=100)),
+                ('status_class', models.CharField(max_length=3)),
+                ('user_id', models.BigIntegerField(default=0)),
+                ('requests', models.PositiveBigIntegerField(default=0)),
+                ('latency_sum', models.FloatField(default=0)),
+                ('latency_counts', models.JSONField(default=list)),
+            ],
+            options={
+                'verbose_name': 'Traffic per Hour',
+                'verbose_name_plural': 'Traffic per Hour',
+                'db_table': 'traffic_hour',
+            },
+        ),
+        migrations.CreateModel(
+            name='TrafficMinute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('route', models.CharField(max_length=200)),
+                ('service', models.CharField(max_length=100)),
+                ('status_class', models.CharField(max_length=3)),
+                ('user_id', models.BigIntegerField(default=0)),
+                ('requests', models.PositiveBigIntegerField(default=0)),
+                ('latency_sum', models.FloatField(default=0)),
+                ('latency_counts', models.JSONField(default=list)),
+            ],
+            options={
+                'verbose_name': 'Traffic per Minute',
+                'verbose_name_plural': 'Traffic per Minute',
+                'db_table': 'traffic_minute',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='traffichour',
+            constraint=models.UniqueConstraint(fields=('bucket', 'route', 'service', 'status_class', 'user_id'), name='traffic_hour_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='trafficminute',
+            constraint=models.UniqueConstraint(fields=('bucket', 'route', 'service', 'status_class', 'user_id'), name='traffic_minute_key'),
+        ),
+    ]
@@ -5,6 +5,7 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group, AbstractUser
 from django.core.validators import RegexValidator
 from django.conf import settings
+from django.utils import timezone
 
 from simple_history.models import HistoricalRecords
 
@@ -14,6 +15,13 @@ class RequestLog(models.Model):
         db_table = 'activity_log'
         verbose_name = 'Activity Log'
         verbose_name_plural = 'Activity Logs'
+        # The admin and ad-hoc queries filter on one of these and show the latest requests first
+        indexes = [
+            models.Index(fields=['-timestamp'], name='activity_log_ts_idx'),
+            models.Index(fields=['user', '-timestamp'], name='activity_log_user_ts_idx'),
+            models.Index(fields=['path', '-timestamp'], name='activity_log_path_ts_idx'),
+            models.Index(fields=['response_status', '-timestamp'], name='activity_log_status_ts_idx'),
+        ]
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
     ip_address = models.CharField(max_length=45)
@@ -23,7 +31,72 @@ class RequestLog(models.Model):
     body = models.TextField()
     method = models.CharField(max_length=10)
     response_status = models.IntegerField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the request is served, the row is written later in a batch
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+
+class RequestLogHourly(models.Model):
+    """
+    Requests per hour, path, method and status, kept after prune_activity_log removed
+    the requests themselves.
+    """
+    class Meta:
+        db_table = 'activity_log_hourly'
+        verbose_name = 'Hourly Activity'
+        verbose_name_plural = 'Hourly Activity'
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'path', 'method', 'response_status'],
+                                    name='activity_log_hourly_key'),
+        ]
+
+    hour = models.DateTimeField()
+    path = models.CharField(max_length=200)
+    method = models.CharField(max_length=10)
+    response_status = models.IntegerField()
+    requests = models.PositiveBigIntegerField(default=0)
+
+
+class TrafficRollup(models.Model):
+    """
+    Requests and their latency per time bucket, route, upstream service, status class and
+    user. Every worker process adds the requests it served to them, see gatekeeper.traffic.
+    """
+    class Meta:
+        abstract = True
+
+    bucket = models.DateTimeField()
+    route = models.CharField(max_length=200)
+    service = models.CharField(max_length=100)
+    status_class = models.CharField(max_length=3)
+    # 0 for anonymous requests; not a foreign key, so the counters outlive deleted users
+    user_id = models.BigIntegerField(default=0)
+    requests = models.PositiveBigIntegerField(default=0)
+    # Seconds, and the requests per gatekeeper.timing.LATENCY_BUCKETS bucket, so the
+    # percentiles of any set of rows can be estimated from their sum
+    latency_sum = models.FloatField(default=0)
+    latency_counts = models.JSONField(default=list)
+
+
+class TrafficMinute(TrafficRollup):
+    class Meta:
+        db_table = 'traffic_minute'
+        verbose_name = 'Traffic per Minute'
+        verbose_name_plural = 'Traffic per Minute'
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'route', 'service', 'status_class', 'user_id'],
+                                    name='traffic_minute_key'),
+        ]
+
+
+class TrafficHour(TrafficRollup):
+    class Meta:
+        db_table = 'traffic_hour'
+        verbose_name = 'Traffic per Hour'
+        verbose_name_plural = 'Traffic per Hour'
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'route', 'service', 'status_class', 'user_id'],
+                                    name='traffic_hour_key'),
+        ]
 
 
 class DefaultAuthUserExtend(AbstractUser):
@@ -37,12 +110,39 @@ class DefaultAuthUserExtend(AbstractUser):
     contact_no = models.CharField(max_length=10, null=True, db_index=True, default='', blank=True,
                                   validators=[RegexValidator(regex=r'^[0-9- ]+$', message="Invalid phone number")])
     token_version = models.IntegerField(default=1)
+    # Workers poll for the users whose token_version changed since their last poll
+    token_version_changed_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
 
     history = HistoricalRecords(table_name="history_auth_user_extend")
 
     def __str__(self):
         return f"{self.email} {self.first_name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_token_version = instance.__dict__.get('token_version')
+        return instance
+
+    def save(self, *args, **kwargs):
+        saved = getattr(self, '_saved_token_version', None)
+        if saved is not None and self.token_version != saved:
+            self.token_version_changed_at = timezone.now()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'token_version' in update_fields:
+                kwargs['update_fields'] = {*update_fields, 'token_version_changed_at'}
+        super().save(*args, **kwargs)
+        self._saved_token_version = self.token_version
+
+    def revoke_tokens(self):
+        """
+        Revoke every token issued to the user so far, in all workers within
+        AUTH_CACHE['VERSIONS_REFRESH_INTERVAL'] seconds. Use this rather than a queryset
+        update(), which would skip the change timestamp the workers poll.
+        """
+        self.token_version += 1
+        self.save(update_fields=['token_version'])
+
 
 class AdminMenuMaster(models.Model):
     class Meta:
@@ -153,3 +253,89 @@ class GroupCustomPermissions(models.Model):
         return f"{self.group} {str(self.permission_names)}"
 
 
+
+
+class RegisteredService(models.Model):
+    class Meta:
+        db_table = "registered_service"
+        verbose_name = "Registered Service"
+        verbose_name_plural = "Registered Services"
+
+    name = models.CharField(max_length=100, unique=True,
+                            validators=[RegexValidator(regex=r'^[a-zA-Z0-9_-]+$', message="Invalid characters")])
+    api = models.TextField(help_text='Base URL of each instance of the service, one per line.')
+    post_auth = models.URLField(max_length=300, null=True, blank=True,
+                                help_text='Where users logging in for this service are sent with their token.')
+    options = models.JSONField(default=dict, blank=True,
+                               help_text='Per service overrides, e.g. {"pool": {...}, "cache": {...}, '
+                                         '"circuit_breaker": {...}, "rate_limit": {...}}.')
+
+    status = models.BooleanField(default=True, verbose_name='Status')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At')
+
+    def api_urls(self):
+        return [url.strip() for url in self.api.replace(',', '\n').splitlines() if url.strip()]
+
+    def __str__(self):
+        return self.name
+
+
+class ServiceRoute(models.Model):
+    class Meta:
+        db_table = "service_route"
+        verbose_name = "Service Route"
+        verbose_name_plural = "Service Routes"
+
+    entity = models.CharField(max_length=200, unique=True,
+                              help_text='Path segments under /api/resources/ served by the service, e.g. FarmAssets.')
+    service = models.ForeignKey(RegisteredService, on_delete=models.CASCADE, related_name='routes')
+
+    status = models.BooleanField(default=True, verbose_name='Status')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At')
+
+    def __str__(self):
+        return f"{self.entity} -> {self.service.name}"
+
+
+class ServiceRegistryVersion(models.Model):
+    class Meta:
+        db_table = "service_registry_version"
+        verbose_name = "Service Registry Version"
+
+    # A single row, bumped on every change to the registered services or routes
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At')
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=1).update(version=models.F('version') + 1, updated_at=timezone.now()):
+            cls.objects.get_or_create(pk=1, defaults={'version': 1})
+
+
+class JWTSigningKey(models.Model):
+    class Meta:
+        db_table = "jwt_signing_key"
+        verbose_name = "JWT Signing Key"
+        verbose_name_plural = "JWT Signing Keys"
+        ordering = ('-active_from',)
+
+    kid = models.CharField(max_length=64, unique=True, editable=False, verbose_name='Key ID')
+    algorithm = models.CharField(max_length=10, editable=False)
+    # PEM encoded, the private key encrypted with settings.JWT_SIGNING_KEY
+    private_key = models.TextField(editable=False)
+    public_key = models.TextField(editable=False)
+
+    # Published in the JWKS from creation, signs from active_from until retired_at, and
+    # verifies until the tokens it signed have expired
+    active_from = models.DateTimeField(verbose_name='Active From')
+    retired_at = models.DateTimeField(null=True, blank=True, verbose_name='Retired At')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
+
+    def __str__(self):
+        return f"{self.kid} ({self.algorithm})"
@@ -37,3 +37,16 @@ settings.py, this logger writes the logs to the file specified by the 'file' han
 #     if created:
 #         log_entry = f"{instance.user} - {instance.method} {instance.activity} - {instance.timestamp} - {instance.user_timezone}"  # Include user_timezone here
 #         logger.info(log_entry)
+
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from aegis.models import RegisteredService, ServiceRoute, ServiceRegistryVersion
+
+
+@receiver([post_save, post_delete], sender=RegisteredService)
+@receiver([post_save, post_delete], sender=ServiceRoute)
+def bump_service_registry_version(sender, **kwargs):
+    # Workers compare this version to their registry snapshot's and reload on a change
+    ServiceRegistryVersion.bump()
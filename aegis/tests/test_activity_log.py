@@ -0,0 +1,71 @@
+# aegis/tests/test_activity_log.py
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from aegis.models import RequestLog, RequestLogHourly
+from gatekeeper.activity_log import day_start, prune_activity_log
+
+NOW = datetime(2026, 10, 18, 12, 30, tzinfo=dt_timezone.utc)
+
+
+def log(timestamp, path='/api/', status=200):
+    return RequestLog.objects.create(ip_address='127.0.0.1', user_agent='test', path=path, query_string='',
+                                     body='', method='GET', response_status=status, timestamp=timestamp)
+
+
+@override_settings(ACTIVITY_LOG={'RETENTION_DAYS': 30, 'PRUNE_BATCH_SIZE': 2, 'PRUNE_PAUSE': 0})
+@mock.patch('django.utils.timezone.now', return_value=NOW)
+class PruneActivityLogTests(TestCase):
+    def test_old_requests_are_rolled_up_then_deleted_in_batches(self, now):
+        old = NOW - timedelta(days=40)
+        for minute in (1, 2, 3):
+            log(old.replace(minute=minute))
+        log(old.replace(minute=4), status=404)
+        log(old + timedelta(hours=1))
+        kept = log(NOW - timedelta(days=29))
+
+        with mock.patch('gatekeeper.activity_log.time.sleep') as sleep:
+            self.assertEqual(prune_activity_log(), 5)
+        # Batches of 2, 2 and 1 rows
+        self.assertEqual(sleep.call_count, 2)
+
+        self.assertEqual(list(RequestLog.objects.all()), [kept])
+        hour = old.replace(minute=0, second=0, microsecond=0)
+        self.assertEqual(
+            sorted(RequestLogHourly.objects.values_list('hour', 'path', 'method', 'response_status', 'requests')),
+            [(hour, '/api/', 'GET', 200, 3), (hour, '/api/', 'GET', 404, 1),
+             (hour + timedelta(hours=1), '/api/', 'GET', 200, 1)])
+
+    def test_rollups_add_up_across_runs(self, now):
+        old = NOW - timedelta(days=40)
+        log(old)
+        prune_activity_log()
+        log(old + timedelta(minutes=5))
+        log(old + timedelta(minutes=6))
+        prune_activity_log()
+
+        self.assertEqual(RequestLogHourly.objects.get().requests, 3)
+
+    def test_retention_is_cut_at_midnight(self, now):
+        cutoff = day_start(NOW - timedelta(days=30))
+        log(cutoff - timedelta(seconds=1))
+        kept = log(cutoff)
+
+        out = StringIO()
+        call_command('prune_activity_log', stdout=out)
+
+        self.assertEqual(list(RequestLog.objects.all()), [kept])
+        self.assertIn('Removed 1 requests older than 30 days', out.getvalue())
+
+    def test_no_rollup(self, now):
+        log(NOW - timedelta(days=10))
+
+        call_command('prune_activity_log', '--days', '5', '--no-rollup', stdout=StringIO())
+
+        self.assertFalse(RequestLog.objects.exists())
+        self.assertFalse(RequestLogHourly.objects.exists())
@@ -0,0 +1,127 @@
+# aegis/tests/test_async_reverse_proxy.py
+
+import asyncio
+import json
+import threading
+from unittest import mock
+
+import httpx
+from django.test import SimpleTestCase, TestCase, AsyncRequestFactory, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.async_upstream import AsyncUpstreamClientPool
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.views import async_reverse_proxy
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+
+class AsyncReverseProxyTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.auth = f'Bearer {AccessToken.for_user(self.user)}'
+        self.upstream_requests = []
+        upstream_guards.reset()
+
+    def mock_upstream(self, handler):
+        def record(request):
+            self.upstream_requests.append(request)
+            return handler(request)
+        pool = AsyncUpstreamClientPool(transport=httpx.MockTransport(record))
+        return mock.patch('gatekeeper.views.api_async_reverse_proxy.async_upstream_pool', pool)
+
+    async def test_requires_authentication(self):
+        request = self.factory.get('/api/resources/FarmActivities/')
+        response = await async_reverse_proxy(request, path='FarmActivities/')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_proxies_get(self):
+        with self.mock_upstream(lambda request: httpx.Response(200, json={'data': 'activities'})):
+            request = self.factory.get('/api/resources/FarmActivities/', {'year': '2024'}, headers={'Authorization': self.auth})
+            response = await async_reverse_proxy(request, path='FarmActivities/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'data': 'activities'})
+        self.assertEqual(str(self.upstream_requests[0].url), f'{FARM_CALENDAR_API}FarmActivities/?year=2024')
+
+    @override_settings(PROXY_REQUEST_BODY={'MEMORY_LIMIT': 16, 'CHUNK_SIZE': 8},
+                       PROXY_STREAMING={'BUFFER_LIMIT': 16, 'CHUNK_SIZE': 8})
+    async def test_streams_large_bodies_both_ways(self):
+        body = json.dumps({'activities': ['x' * 10] * 10}).encode()
+
+        async def echo(request):
+            return httpx.Response(201, content=await request.aread())
+        with self.mock_upstream(echo):
+            request = self.factory.post(
+                '/api/resources/FarmActivities/', data=body, content_type='application/json',
+                headers={'Authorization': self.auth})
+            response = await async_reverse_proxy(request, path='FarmActivities/')
+            streamed = b''.join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.upstream_requests[0].headers['Content-Length'], str(len(body)))
+        self.assertEqual(streamed, body)
+
+    async def test_upstream_timeout(self):
+        def timeout(request):
+            raise httpx.ConnectTimeout('timed out', request=request)
+        with self.mock_upstream(timeout):
+            request = self.factory.get('/api/resources/FarmPlants/', headers={'Authorization': self.auth})
+            response = await async_reverse_proxy(request, path='FarmPlants/')
+
+        self.assertEqual(response.status_code, 504)
+
+    @override_settings(UPSTREAM_RETRY={'BACKOFF_BASE': 0})
+    async def test_retries_idempotent_request(self):
+        responses = iter([httpx.Response(502), httpx.Response(200, json={'data': 'ok'})])
+        with self.mock_upstream(lambda request: next(responses)):
+            request = self.factory.get('/api/resources/FarmActivities/', headers={'Authorization': self.auth})
+            response = await async_reverse_proxy(request, path='FarmActivities/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.upstream_requests), 2)
+
+
+class AsyncUpstreamClientPoolTests(SimpleTestCase):
+    def pool(self):
+        return AsyncUpstreamClientPool(transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+
+    def test_client_of_a_closed_loop_is_closed(self):
+        pool = self.pool()
+
+        async def get_client():
+            return pool.get_client('FarmCalendar')
+
+        async def next_loop_client():
+            client = pool.get_client('FarmCalendar')
+            await asyncio.sleep(0)
+            return client
+
+        first = asyncio.run(get_client())
+        second = asyncio.run(next_loop_client())
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed)
+        self.assertFalse(second.is_closed)
+
+    def test_loops_running_at_once_keep_their_clients(self):
+        pool = self.pool()
+        other_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=other_loop.run_forever, daemon=True)
+        thread.start()
+        self.addCleanup(other_loop.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(other_loop.call_soon_threadsafe, other_loop.stop)
+
+        async def get_client():
+            return pool.get_client('FarmCalendar')
+
+        other = asyncio.run_coroutine_threadsafe(get_client(), other_loop).result()
+        mine = asyncio.run(get_client())
+        again = asyncio.run_coroutine_threadsafe(get_client(), other_loop).result()
+
+        self.assertIsNot(mine, other)
+        self.assertIs(again, other)
+        self.assertFalse(other.is_closed)
@@ -0,0 +1,156 @@
+# aegis/tests/test_auth_cache.py
+
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from oauth2_provider.models import AccessToken as OAuth2AccessToken, Application
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.authentication import BearerTokenAuthentication, CachedJWTAuthentication, jwt_cache, oauth_token_cache, \
+    token_versions
+from gatekeeper.tokens import RefreshToken, TokenRefreshSerializer
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.authentication = CachedJWTAuthentication()
+        self.factory = APIRequestFactory()
+        jwt_cache.clear()
+        token_versions.clear()
+
+    def authenticate(self, token):
+        return self.authentication.authenticate(self.factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+
+    def test_repeated_token_skips_user_query(self):
+        token = str(AccessToken.for_user(self.user))
+        with self.assertNumQueries(1):
+            user, _ = self.authenticate(token)
+        with self.assertNumQueries(0):
+            cached_user, validated = self.authenticate(token)
+
+        self.assertEqual(cached_user.pk, self.user.pk)
+        self.assertIsNot(cached_user, user)
+        self.assertEqual(validated['user_id'], self.user.pk)
+
+    def test_saving_the_user_drops_their_tokens(self):
+        token = AccessToken.for_user(self.user)
+        token['token_version'] = self.user.token_version
+        self.authenticate(token)
+
+        self.user.token_version += 1
+        self.user.save()
+
+        self.assertEqual(len(jwt_cache), 0)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_expired_token_is_not_served_from_cache(self):
+        token = AccessToken.for_user(self.user)
+        token.set_exp(lifetime=timedelta(seconds=-1))
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+        self.assertEqual(len(jwt_cache), 0)
+
+    @override_settings(AUTH_CACHE={'MAX_ENTRIES': 2})
+    def test_cache_is_bounded(self):
+        for _ in range(3):
+            self.authenticate(AccessToken.for_user(self.user))
+        self.assertEqual(len(jwt_cache), 2)
+
+
+class TokenVersionTests(TestCase):
+    def setUp(self):
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.authentication = CachedJWTAuthentication()
+        self.factory = APIRequestFactory()
+        jwt_cache.clear()
+        token_versions.clear()
+
+    def authenticate(self, token):
+        return self.authentication.authenticate(self.factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+
+    def test_issued_tokens_carry_the_version(self):
+        refresh = RefreshToken.for_user(self.user)
+        self.assertEqual(refresh['token_version'], 1)
+        self.assertEqual(refresh.access_token['token_version'], 1)
+
+    def test_revocation_in_another_worker_is_polled(self):
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.authenticate(token)
+        with self.assertNumQueries(0):
+            self.authenticate(token)
+
+        # Another worker revoked the tokens, this one only learns it from the poll
+        DefaultAuthUserExtend.objects.filter(pk=self.user.pk).update(
+            token_version=2, token_version_changed_at=timezone.now())
+        self.authenticate(token)
+        token_versions.poll()
+
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_revoked_refresh_token_grants_nothing(self):
+        refresh = RefreshToken.for_user(self.user)
+        self.user.revoke_tokens()
+
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.token_version_changed_at)
+        serializer = TokenRefreshSerializer(data={'refresh': str(refresh)})
+        with self.assertRaises(AuthenticationFailed):
+            serializer.is_valid()
+
+    @override_settings(AUTH_CACHE={'VERSIONS_MAX_ENTRIES': 1})
+    def test_versions_are_bounded(self):
+        other = DefaultAuthUserExtend.objects.create_user(username='other', email='other@example.com',
+                                                          password='testpass')
+        self.authenticate(RefreshToken.for_user(self.user).access_token)
+        self.authenticate(RefreshToken.for_user(other).access_token)
+        self.assertEqual(len(token_versions), 1)
+
+
+class BearerTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.authentication = BearerTokenAuthentication()
+        self.factory = APIRequestFactory()
+        jwt_cache.clear()
+        oauth_token_cache.clear()
+
+    def authenticate(self, token):
+        return self.authentication.authenticate(self.factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+
+    def access_token(self):
+        application = Application.objects.create(
+            name='FarmCalendar', client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_CLIENT_CREDENTIALS)
+        return OAuth2AccessToken.objects.create(
+            user=self.user, application=application, token='oauth2accesstoken123',
+            expires=timezone.now() + timedelta(hours=1), scope='read')
+
+    def test_jwt_skips_the_access_token_query(self):
+        # Only the user is loaded, no access token lookup is tried first
+        token = str(AccessToken.for_user(self.user))
+        with self.assertNumQueries(1):
+            user, _ = self.authenticate(token)
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_access_token_lookups_are_cached(self):
+        access_token = self.access_token()
+        with self.assertNumQueries(1):
+            user, token = self.authenticate(access_token.token)
+        with self.assertNumQueries(0):
+            cached_user, cached_token = self.authenticate(access_token.token)
+        self.assertEqual(cached_user.pk, self.user.pk)
+        self.assertEqual(cached_token.application_id, access_token.application_id)
+
+    def test_revoked_access_token_is_dropped(self):
+        access_token = self.access_token()
+        self.authenticate(access_token.token)
+        access_token.delete()
+
+        self.assertIsNone(self.authenticate('oauth2accesstoken123'))
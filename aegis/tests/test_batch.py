@@ -0,0 +1,119 @@
+# aegis/tests/test_batch.py
+
+import json
+import httpx
+import requests_mock
+from unittest import mock
+
+from django.test import TestCase, AsyncRequestFactory
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.async_upstream import AsyncUpstreamClientPool
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.ratelimit import local_store
+from gatekeeper.views import async_batch
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+BATCH = {'requests': [
+    {'id': 'activities', 'path': 'FarmActivities/', 'query': {'year': 2024}},
+    {'id': 'asset', 'method': 'POST', 'path': 'FarmAssets/', 'body': {'name': 'tractor'}},
+    {'id': 'unknown', 'path': 'Unknown/'},
+]}
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+        local_store.clear()
+
+    def mock_upstream(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmActivities/', json={'data': 'activities'})
+        mock.post(f'{FARM_CALENDAR_API}FarmAssets/', status_code=201, json={'id': 1})
+
+    @requests_mock.Mocker()
+    def test_batch_fans_out(self, mock):
+        self.mock_upstream(mock)
+
+        response = self.client.post('/api/resources/_batch', BATCH, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        activities, asset, unknown = response.json()['responses']
+        self.assertEqual((activities['id'], activities['status']), ('activities', 200))
+        self.assertEqual(activities['body'], {'data': 'activities'})
+        self.assertEqual((asset['status'], asset['body']), (201, {'id': 1}))
+        self.assertEqual(unknown['status'], 405)
+        post = [request for request in mock.request_history if request.method == 'POST'][0]
+        self.assertEqual(post.json(), {'name': 'tractor'})
+        self.assertIn('Authorization', post.headers)
+        get = [request for request in mock.request_history if request.method == 'GET'][0]
+        self.assertEqual(get.qs, {'year': ['2024']})
+
+    @requests_mock.Mocker()
+    def test_batch_streams_results(self, mock):
+        self.mock_upstream(mock)
+
+        response = self.client.post('/api/resources/_batch', dict(BATCH, stream=True), format='json')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual({line['id']: line['status'] for line in lines},
+                         {'activities': 200, 'asset': 201, 'unknown': 405})
+
+    def test_batch_is_validated(self):
+        self.assertEqual(self.client.post('/api/resources/_batch', {'requests': []}, format='json').status_code, 400)
+        response = self.client.post(
+            '/api/resources/_batch', {'requests': [{'path': 'FarmAssets/', 'method': 'PATCH'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @requests_mock.Mocker()
+    def test_items_cannot_set_forwarding_or_auth_headers(self, mock):
+        self.mock_upstream(mock)
+        for header in ('X-Forwarded-For', 'x_real_ip', 'Authorization', 'Cookie', 'Connection'):
+            batch = {'requests': [{'path': 'FarmActivities/', 'headers': {header: '203.0.113.9'}}]}
+            response = self.client.post('/api/resources/_batch', batch, format='json')
+            self.assertEqual(response.status_code, 400, header)
+        self.assertFalse(mock.called)
+
+        batch = {'requests': [{'path': 'FarmActivities/', 'headers': {'Accept-Language': 'el'}}]}
+        self.assertEqual(self.client.post('/api/resources/_batch', batch, format='json').status_code, 200)
+        self.assertEqual(mock.last_request.headers['Accept-Language'], 'el')
+
+    def test_batch_requires_authentication(self):
+        self.client.credentials()
+        self.assertEqual(self.client.post('/api/resources/_batch', BATCH, format='json').status_code, 401)
+
+
+class AsyncBatchTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.auth = f'Bearer {AccessToken.for_user(self.user)}'
+        proxy_cache.clear()
+        upstream_guards.reset()
+        local_store.clear()
+
+    async def test_batch_fans_out(self):
+        def upstream(request):
+            if request.method == 'POST':
+                return httpx.Response(201, json=json.loads(request.content))
+            return httpx.Response(200, json={'path': request.url.path})
+
+        pool = AsyncUpstreamClientPool(transport=httpx.MockTransport(upstream))
+        with mock.patch('gatekeeper.views.api_async_reverse_proxy.async_upstream_pool', pool):
+            request = self.factory.post(
+                '/api/resources/_batch', json.dumps(BATCH), content_type='application/json',
+                headers={'Authorization': self.auth})
+            response = await async_batch(request)
+
+        activities, asset, unknown = json.loads(response.content)['responses']
+        self.assertEqual(activities['body'], {'path': '/api/FarmActivities/'})
+        self.assertEqual((asset['status'], asset['body']), (201, {'name': 'tractor'}))
+        self.assertEqual(unknown['status'], 405)
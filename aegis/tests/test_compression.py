@@ -0,0 +1,128 @@
+# aegis/tests/test_compression.py
+
+import gzip
+import json
+import httpx
+import requests_mock
+from unittest import mock
+
+from django.test import TestCase, AsyncRequestFactory
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.async_upstream import AsyncUpstreamClientPool
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.compression import accepts_encoding, choose_encoding
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.views import async_reverse_proxy
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+LARGE_BODY = json.dumps({'data': [{'activity': 'ploughing', 'id': i} for i in range(200)]}).encode()
+
+
+class EncodingNegotiationTests(TestCase):
+    def test_accepts_encoding(self):
+        self.assertTrue(accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertFalse(accepts_encoding('gzip;q=0, deflate', 'gzip'))
+        self.assertTrue(accepts_encoding('*', 'br'))
+        self.assertFalse(accepts_encoding('', 'gzip'))
+
+    def test_choose_encoding(self):
+        self.assertEqual(choose_encoding('gzip'), 'gzip')
+        self.assertIsNone(choose_encoding('identity'))
+        with mock.patch('gatekeeper.proxy.compression.brotli', object()):
+            self.assertEqual(choose_encoding('gzip, br'), 'br')
+            self.assertEqual(choose_encoding('gzip, br;q=0.5'), 'gzip')
+
+
+class ProxyCompressionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+
+    @requests_mock.Mocker()
+    def test_encoded_body_is_passed_through(self, mock):
+        body = gzip.compress(LARGE_BODY)
+        mock.post(f'{FARM_CALENDAR_API}FarmActivities/', content=body,
+                  headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+        response = self.client.post('/api/resources/FarmActivities/', {}, format='json', HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content, body)
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    @requests_mock.Mocker()
+    def test_encoded_body_is_decoded_for_clients_without_the_encoding(self, mock):
+        mock.post(f'{FARM_CALENDAR_API}FarmActivities/', content=gzip.compress(b'{"data": 1}'),
+                  headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+        response = self.client.post('/api/resources/FarmActivities/', {}, format='json', HTTP_ACCEPT_ENCODING='identity')
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.json(), {'data': 1})
+
+    @requests_mock.Mocker()
+    def test_large_json_is_compressed(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', content=LARGE_BODY, headers={'Content-Type': 'application/json'})
+
+        response = self.client.get('/api/resources/FarmAssets/', HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), LARGE_BODY)
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+
+    @requests_mock.Mocker()
+    def test_small_json_is_not_compressed(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json={'data': 1})
+
+        response = self.client.get('/api/resources/FarmAssets/', HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.json(), {'data': 1})
+
+    def test_own_endpoints_are_compressed(self):
+        admin = DefaultAuthUserExtend.objects.create_superuser(
+            username='admin', email='admin@example.com', password='testpass')
+        self.client.force_authenticate(admin)
+
+        with self.settings(RESPONSE_COMPRESSION={'MIN_SIZE': 10}):
+            response = self.client.get('/api/proxy/routes/', HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('routes', json.loads(gzip.decompress(response.content)))
+
+
+class UpstreamStream(httpx.AsyncByteStream):
+    # A body the transport hasn't read yet, as sent by a real upstream
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        yield self.body
+
+
+class AsyncProxyCompressionTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.auth = f'Bearer {AccessToken.for_user(self.user)}'
+        upstream_guards.reset()
+
+    async def test_encoded_body_is_passed_through(self):
+        body = gzip.compress(LARGE_BODY)
+        pool = AsyncUpstreamClientPool(transport=httpx.MockTransport(lambda request: httpx.Response(
+            200, stream=UpstreamStream(body), headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})))
+        with mock.patch('gatekeeper.views.api_async_reverse_proxy.async_upstream_pool', pool):
+            request = self.factory.post(
+                '/api/resources/FarmActivities/', b'{}', content_type='application/json',
+                headers={'Authorization': self.auth, 'Accept-Encoding': 'gzip, br'})
+            response = await async_reverse_proxy(request, path='FarmActivities/')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content, body)
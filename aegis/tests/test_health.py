@@ -0,0 +1,92 @@
+# aegis/tests/test_health.py
+
+import json
+from io import StringIO
+
+import requests
+import requests_mock
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.balancer import load_balancers
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.health import health_registry, probe_all
+from gatekeeper.proxy.resilience import upstream_guards
+
+INSTANCES = ['http://calendar-1/api/', 'http://calendar-2/api/']
+
+SERVICES = {
+    'FarmCalendar': {'api': INSTANCES, 'post_auth': None},
+}
+
+
+@override_settings(AVAILABLE_SERVICES=SERVICES, REVERSE_PROXY_MAPPING={'FarmAssets': 'FarmCalendar'},
+                   SERVICE_REGISTRY={'ENABLED': False})
+class HealthProberTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+        load_balancers.reset()
+        health_registry.reset()
+
+    def probe_rounds(self, rounds=3):
+        for _ in range(rounds):
+            probe_all()
+
+    @requests_mock.Mocker()
+    def test_unhealthy_instance_is_skipped(self, mock):
+        mock.get('http://calendar-1/api/health', status_code=503)
+        mock.get('http://calendar-2/api/health', json={'status': 'ok'})
+        mock.get('http://calendar-2/api/FarmAssets/', json={})
+
+        probe_all()
+        # A single failed probe doesn't mark the instance unhealthy yet
+        self.assertFalse(health_registry.unhealthy('FarmCalendar', INSTANCES[0]))
+        self.probe_rounds(2)
+        self.assertTrue(health_registry.unhealthy('FarmCalendar', INSTANCES[0]))
+
+        for _ in range(3):
+            self.assertEqual(self.client.get('/api/resources/FarmAssets/').status_code, 200)
+        self.assertEqual([call.url for call in mock.request_history if 'FarmAssets' in call.url],
+                         ['http://calendar-2/api/FarmAssets/'] * 3)
+
+        instances = health_registry.snapshot()['FarmCalendar']
+        self.assertEqual([instance['healthy'] for instance in instances], [False, True])
+        self.assertEqual(instances[1]['success_rate'], 1.0)
+
+    @requests_mock.Mocker()
+    def test_fails_fast_without_healthy_instances(self, mock):
+        mock.get('http://calendar-1/api/health', exc=requests.exceptions.ConnectTimeout)
+        mock.get('http://calendar-2/api/health', status_code=500)
+        self.probe_rounds()
+
+        response = self.client.get('/api/resources/FarmAssets/')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(any('FarmAssets' in call.url for call in mock.request_history))
+
+        # Two passed probes in a row bring an instance back
+        mock.get('http://calendar-2/api/health', json={})
+        self.probe_rounds(2)
+        self.assertFalse(health_registry.unhealthy('FarmCalendar', INSTANCES[1]))
+
+    @requests_mock.Mocker()
+    def test_command_prints_json(self, mock):
+        mock.get('http://calendar-1/api/health', json={})
+        mock.get('http://calendar-2/api/health', exc=requests.exceptions.ConnectionError)
+        out = StringIO()
+
+        call_command('check_api_health', stdout=out)
+
+        report = json.loads(out.getvalue())['services']['FarmCalendar']
+        self.assertFalse(report['healthy'])
+        self.assertEqual([instance['healthy'] for instance in report['instances']], [True, False])
+        self.assertEqual(report['instances'][0]['status'], 200)
@@ -0,0 +1,96 @@
+# aegis/tests/test_introspection.py
+
+from datetime import timedelta
+
+from django.contrib.auth.models import Group
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from oauth2_provider.models import AccessToken as OAuth2AccessToken, Application
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend, RequestLog
+from gatekeeper.authentication import introspection_cache
+from gatekeeper.views.AuthV import LoginView
+
+
+class TokenIntrospectionTests(TestCase):
+    def setUp(self):
+        self.service = DefaultAuthUserExtend.objects.create_user(username='farmcalendar', email='farmcalendar@example.com', password='testpass')
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', email='testuser@example.com', password='testpass')
+        self.user.groups.add(Group.objects.create(name='farmers'))
+        self.service.groups.add(Group.objects.create(name='token_introspection'))
+        self.client = APIClient()
+        self.client.force_authenticate(self.service)
+        introspection_cache.clear()
+
+    def introspect(self, tokens):
+        return self.client.post('/api/token/introspect/', {'tokens': tokens}, format='json')
+
+    def access_token(self):
+        application = Application.objects.create(
+            name='FarmCalendar', client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_CLIENT_CREDENTIALS)
+        return OAuth2AccessToken.objects.create(
+            user=self.user, application=application, token='oauth2accesstoken123',
+            expires=timezone.now() + timedelta(hours=1), scope='read')
+
+    def test_batch_of_tokens(self):
+        jwt = AccessToken.for_user(self.user)
+        login_token = LoginView().generate_token(self.user, timedelta(minutes=10))
+        response = self.introspect([str(jwt), login_token, self.access_token().token, 'not-a-token'])
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(results[0], {'active': True, 'user_id': self.user.pk, 'token_version': 1,
+                                      'groups': ['farmers'], 'exp': jwt['exp']})
+        self.assertEqual((results[1]['active'], results[1]['user_id']), (True, self.user.pk))
+        self.assertEqual(results[2]['groups'], ['farmers'])
+        self.assertEqual(results[3], {'active': False})
+        # Every token outlives the cache lifetime, which bounds the memoization
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('max-age=30', response['Cache-Control'])
+        self.assertEqual(RequestLog.objects.get(path='/api/token/introspect/').body, '[redacted]')
+
+    def test_results_are_cached_until_the_user_changes(self):
+        token = str(AccessToken.for_user(self.user))
+        self.introspect([token])
+        # Only the caller's group check and the request log row, inserted in a savepoint
+        with self.assertNumQueries(4):
+            self.assertTrue(self.introspect([token]).json()['results'][0]['active'])
+
+        self.user.token_version += 1
+        self.user.save()
+        token_with_version = AccessToken.for_user(self.user)
+        token_with_version['token_version'] = 1
+        self.assertFalse(self.introspect([str(token_with_version)]).json()['results'][0]['active'])
+
+        self.user.groups.clear()
+        self.assertEqual(self.introspect([token]).json()['results'][0]['groups'], [])
+
+    def test_expired_and_inactive(self):
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(lifetime=timedelta(seconds=-1))
+        self.user.is_active = False
+        self.user.save()
+
+        results = self.introspect([str(expired), str(AccessToken.for_user(self.user))]).json()['results']
+        self.assertEqual(results, [{'active': False}, {'active': False}])
+
+    def test_only_services_may_introspect(self):
+        token = str(AccessToken.for_user(self.user))
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.introspect([token]).status_code, 403)
+
+        # A client credentials application of a downstream service
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access_token().token}')
+        response = client.post('/api/token/introspect/', {'tokens': [token]}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(TOKEN_INTROSPECTION={'MAX_TOKENS': 2})
+    def test_invalid_requests(self):
+        self.assertEqual(self.introspect(['a', 'b', 'c']).status_code, 400)
+        self.assertEqual(self.client.post('/api/token/introspect/', {'tokens': 'a'}, format='json').status_code, 400)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.introspect(['a']).status_code, 401)
@@ -0,0 +1,111 @@
+# aegis/tests/test_jwt_keys.py
+
+from datetime import timedelta
+from io import StringIO
+
+import jwt
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend, JWTSigningKey
+from gatekeeper.jwt_keys import encode_token, key_ring, rotate_signing_keys, verification_grace
+
+
+class JWTSigningKeyTests(TestCase):
+    def setUp(self):
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        key_ring.reset()
+
+    def tearDown(self):
+        key_ring.reset()
+
+    def jwks(self):
+        response = self.client.get(reverse('jwks'))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def verify_locally(self, token):
+        # What a downstream service does with the published keys
+        kid = jwt.get_unverified_header(token)['kid']
+        jwk = next(key for key in self.jwks().json()['keys'] if key['kid'] == kid)
+        return jwt.decode(token, jwt.PyJWK(jwk).key, algorithms=[jwk['alg']])
+
+    def test_tokens_name_their_key_and_verify_with_the_jwks(self):
+        token = str(AccessToken.for_user(self.user))
+
+        header = jwt.get_unverified_header(token)
+        self.assertEqual(header['alg'], 'RS256')
+        self.assertEqual(header['kid'], JWTSigningKey.objects.get().kid)
+        self.assertEqual(self.verify_locally(token)['user_id'], self.user.pk)
+        self.assertEqual(AccessToken(token)['user_id'], self.user.pk)
+
+    def test_jwks_is_cacheable_and_public_only(self):
+        encode_token({'user_id': self.user.pk})
+        response = self.jwks()
+
+        self.assertEqual(response['Cache-Control'], 'public, max-age=900')
+        key = response.json()['keys'][0]
+        self.assertEqual((key['kty'], key['alg'], key['use']), ('RSA', 'RS256', 'sig'))
+        self.assertNotIn('d', key)
+
+    def test_rotation_overlaps(self):
+        old_token = str(AccessToken.for_user(self.user))
+        old_kid = jwt.get_unverified_header(old_token)['kid']
+        new_key = rotate_signing_keys(force=True)
+        key_ring.refresh()
+
+        # Published ahead, but the old key keeps signing until the new one takes over
+        self.assertEqual({key['kid'] for key in self.jwks().json()['keys']}, {old_kid, new_key.kid})
+        self.assertEqual(jwt.get_unverified_header(str(AccessToken.for_user(self.user)))['kid'], old_kid)
+
+        JWTSigningKey.objects.filter(kid=new_key.kid).update(active_from=timezone.now())
+        JWTSigningKey.objects.filter(kid=old_kid).update(retired_at=timezone.now())
+        key_ring.refresh()
+        new_token = str(AccessToken.for_user(self.user))
+        self.assertEqual(jwt.get_unverified_header(new_token)['kid'], new_key.kid)
+        self.assertEqual(AccessToken(old_token)['user_id'], self.user.pk)
+        self.assertEqual(self.verify_locally(old_token)['user_id'], self.user.pk)
+
+    def test_expired_keys_are_pruned(self):
+        encode_token({'user_id': self.user.pk})
+        JWTSigningKey.objects.update(retired_at=timezone.now() - verification_grace() - timedelta(seconds=1))
+
+        new_key = rotate_signing_keys()
+
+        self.assertEqual(list(JWTSigningKey.objects.values_list('kid', flat=True)), [new_key.kid])
+        self.assertLessEqual(new_key.active_from, timezone.now())
+
+    def test_rotation_waits_until_due(self):
+        encode_token({'user_id': self.user.pk})
+        self.assertIsNone(rotate_signing_keys())
+        call_command('rotate_signing_keys', '--force', stdout=StringIO())
+        self.assertEqual(JWTSigningKey.objects.count(), 2)
+
+    def test_unknown_key_is_rejected(self):
+        token = jwt.encode({'user_id': self.user.pk, 'token_type': 'access', 'jti': 'x',
+                            'exp': timezone.now() + timedelta(minutes=5)},
+                           settings.JWT_SIGNING_KEY, algorithm='HS256', headers={'kid': 'unknown'})
+        with self.assertRaises(TokenError):
+            AccessToken(token)
+
+    def test_legacy_hs256_tokens(self):
+        token = jwt.encode({'user_id': self.user.pk, 'token_type': 'access', 'jti': 'x',
+                            'exp': timezone.now() + timedelta(minutes=5)},
+                           settings.JWT_SIGNING_KEY, algorithm='HS256')
+        self.assertEqual(AccessToken(token)['user_id'], self.user.pk)
+        with override_settings(JWT_SIGNING={'ACCEPT_HS256': False}):
+            with self.assertRaises(TokenError):
+                AccessToken(token)
+
+    @override_settings(JWT_SIGNING={'ALGORITHM': 'EdDSA'})
+    def test_eddsa(self):
+        token = str(AccessToken.for_user(self.user))
+
+        self.assertEqual(jwt.get_unverified_header(token)['alg'], 'EdDSA')
+        self.assertEqual(self.jwks().json()['keys'][0]['crv'], 'Ed25519')
+        self.assertEqual(self.verify_locally(token)['user_id'], self.user.pk)
@@ -0,0 +1,120 @@
+# aegis/tests/test_load_balancer.py
+
+import requests_mock
+
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.balancer import ServiceBalancer, DEFAULT_LOAD_BALANCER, service_instances, load_balancers
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import upstream_guards
+
+INSTANCES = ['http://calendar-1/api/', 'http://calendar-2/api/', 'http://calendar-3/api/']
+
+SERVICES = {
+    'FarmCalendar': {'api': INSTANCES[:2], 'post_auth': None},
+}
+
+
+class ServiceBalancerTests(TestCase):
+    def balancer(self, **config):
+        return ServiceBalancer('FarmCalendar', INSTANCES, dict(DEFAULT_LOAD_BALANCER, **config))
+
+    def test_service_instances_accepts_url_or_list(self):
+        self.assertEqual(service_instances({'api': INSTANCES[0]}), INSTANCES[:1])
+        self.assertEqual(service_instances({'api': INSTANCES}), INSTANCES)
+        self.assertEqual(service_instances({'api': None}), [])
+
+    def test_round_robin(self):
+        balancer = self.balancer()
+        picked = []
+        for _ in range(6):
+            instance = balancer.acquire()
+            balancer.release(instance, True, 0.01)
+            picked.append(instance.url)
+        self.assertEqual(picked, INSTANCES * 2)
+
+    def test_least_outstanding_avoids_busy_instances(self):
+        balancer = self.balancer(POLICY='least_outstanding')
+        busy = [balancer.acquire(), balancer.acquire()]
+
+        instance = balancer.acquire()
+
+        self.assertNotIn(instance, busy)
+        self.assertEqual([i.in_flight for i in balancer.instances], [1, 1, 1])
+
+    def test_power_of_two_prefers_less_loaded(self):
+        balancer = self.balancer(POLICY='power_of_two')
+        balancer.instances[0].in_flight = 5
+        balancer.instances[1].in_flight = 5
+        # Any pair of the three instances includes a less loaded one unless it's 0 and 1
+        for _ in range(20):
+            instance = balancer.acquire()
+            self.assertTrue(instance is balancer.instances[2] or instance.in_flight == 6)
+            balancer.release(instance, True, 0.01)
+
+    def test_failing_instance_is_ejected_and_readmitted(self):
+        balancer = self.balancer(POLICY='least_outstanding', EJECT_AFTER=2)
+        failing = balancer.instances[0]
+        for _ in range(2):
+            failing.in_flight += 1
+            balancer.release(failing, False, 0.01)
+
+        picked = {balancer.acquire().url for _ in range(10)}
+        self.assertNotIn(failing.url, picked)
+        self.assertEqual(balancer.snapshot()['instances'][0]['ejections'], 1)
+
+        failing.ejected_until = 0
+        self.assertFalse(failing.ejected(1))
+
+    def test_ejection_is_capped(self):
+        balancer = self.balancer(EJECT_AFTER=1, MAX_EJECTED_PERCENT=50)
+        for instance in balancer.instances:
+            instance.in_flight += 1
+            balancer.release(instance, False, 0.01)
+
+        self.assertEqual(sum(1 for instance in balancer.instances if instance.ejected_until), 1)
+
+
+@override_settings(AVAILABLE_SERVICES=SERVICES, UPSTREAM_RETRY={'BACKOFF_BASE': 0})
+class BalancedProxyTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+        load_balancers.reset()
+
+    @requests_mock.Mocker()
+    def test_requests_are_spread_over_instances(self, mock):
+        for url in INSTANCES[:2]:
+            mock.post(f'{url}FarmActivities/', json={'instance': url})
+
+        served = {self.client.post('/api/resources/FarmActivities/', {}, format='json').json()['instance']
+                  for _ in range(2)}
+
+        self.assertEqual(served, set(INSTANCES[:2]))
+
+    @requests_mock.Mocker()
+    def test_retry_goes_to_another_instance(self, mock):
+        mock.get(f'{INSTANCES[0]}FarmPlants/', status_code=502)
+        mock.get(f'{INSTANCES[1]}FarmPlants/', json={'data': 'plants'})
+
+        response = self.client.get('/api/resources/FarmPlants/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'data': 'plants'})
+        self.assertEqual([request.hostname for request in mock.request_history], ['calendar-1', 'calendar-2'])
+
+    def test_upstream_stats_require_admin(self):
+        admin = DefaultAuthUserExtend.objects.create_superuser(
+            username='admin', email='admin@example.com', password='testpass')
+        self.client.force_authenticate(admin)
+
+        response = self.client.get('/api/proxy/upstreams/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('services', response.json())
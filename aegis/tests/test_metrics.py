@@ -0,0 +1,94 @@
+# aegis/tests/test_metrics.py
+
+import os
+import tempfile
+
+import requests_mock
+
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.metrics import Counter, Gauge, Histogram, MmapValues, REGISTRY, render, store
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import upstream_guards
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+
+class MetricsRenderTests(TestCase):
+    def setUp(self):
+        store.reset()
+        self.addCleanup(store.reset)
+        self.addCleanup(lambda: [REGISTRY.pop(name, None) for name in ('test_hits', 'test_level', 'test_seconds')])
+
+    def test_counter_gauge_and_cumulative_histogram(self):
+        hits = Counter('test_hits', 'Hits.', ('kind',))
+        level = Gauge('test_level', 'Level.')
+        seconds = Histogram('test_seconds', 'Seconds.', buckets=(0.1, 1))
+        hits.inc(kind='a')
+        hits.inc(2, kind='a')
+        level.set(7)
+        level.dec()
+        for value in (0.05, 0.5, 0.7, 5):
+            seconds.observe(value)
+
+        output = render()
+        self.assertIn('# TYPE test_hits counter', output)
+        self.assertIn('test_hits_total{kind="a"} 3.0', output)
+        self.assertIn('test_level 6.0', output)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', output)
+        self.assertIn('test_seconds_bucket{le="1"} 3', output)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', output)
+        self.assertIn('test_seconds_count 4.0', output)
+
+    def test_worker_files_are_aggregated(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(METRICS={'MULTIPROCESS_DIR': directory}):
+            hits = Counter('test_hits', 'Hits.')
+            hits.inc(2)
+            # Another worker's file, written as that worker would
+            other = MmapValues(os.path.join(directory, f'metrics_{os.getppid()}.db'))
+            other.put(other.slot('["test_hits", "_total", []]'), 3)
+            other.close()
+
+            self.assertIn('test_hits_total 5.0', render())
+            store.reset()
+
+
+class MetricsEndpointTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+        store.reset()
+
+    @requests_mock.Mocker()
+    def test_proxied_requests_are_counted(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json={})
+        mock.get(f'{FARM_CALENDAR_API}FarmActivities/', status_code=500, json={})
+        self.client.get('/api/resources/FarmAssets/')
+        self.client.get('/api/resources/FarmAssets/')
+        self.client.get('/api/resources/FarmActivities/')
+
+        response = self.client.get('/metrics')
+        output = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('gatekeeper_requests_total{route="FarmAssets",method="GET",status="200"} 2.0', output)
+        self.assertIn('gatekeeper_upstream_responses_total{service="FarmCalendar",status="500"}', output)
+        self.assertIn('gatekeeper_stage_duration_seconds_count{service="FarmCalendar",stage="upstream"}', output)
+        self.assertIn('gatekeeper_db_queries_per_request_count{route="FarmAssets"}', output)
+
+    def test_token_is_required_when_set(self):
+        with self.settings(METRICS={'TOKEN': 'scrape-secret'}):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.client.credentials(HTTP_AUTHORIZATION='Bearer scrape-secret')
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_only_local_scrapers_without_token(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='::1').status_code, 200)
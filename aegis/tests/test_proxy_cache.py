@@ -0,0 +1,98 @@
+# aegis/tests/test_proxy_cache.py
+
+import requests_mock
+
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import upstream_guards
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+
+class ProxyCacheTests(TestCase):
+    def setUp(self):
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.other_user = DefaultAuthUserExtend.objects.create_user(
+            username='otheruser', email='other@example.com', password='testpass')
+        self.client = self.client_for(self.user)
+        proxy_cache.clear()
+        upstream_guards.reset()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        return client
+
+    @requests_mock.Mocker()
+    def test_shared_entity_is_served_from_cache(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmActivityTypes/', json=[{'name': 'Sowing'}])
+
+        first = self.client.get('/api/resources/FarmActivityTypes/?b=2&a=1')
+        second = self.client_for(self.other_user).get('/api/resources/FarmActivityTypes/?a=1&b=2')
+
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.json(), [{'name': 'Sowing'}])
+        self.assertEqual(mock.call_count, 1)
+
+    @requests_mock.Mocker()
+    def test_user_scoped_entries_are_not_shared(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json=[], headers={'Cache-Control': 'max-age=60'})
+
+        self.client.get('/api/resources/FarmAssets/')
+        self.assertEqual(self.client.get('/api/resources/FarmAssets/')['X-Cache'], 'HIT')
+        self.assertEqual(self.client_for(self.other_user).get('/api/resources/FarmAssets/')['X-Cache'], 'MISS')
+        self.assertEqual(mock.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_no_store_is_honoured(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json=[], headers={'Cache-Control': 'no-store'})
+
+        self.client.get('/api/resources/FarmAssets/')
+        self.client.get('/api/resources/FarmAssets/')
+
+        self.assertEqual(mock.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_stale_entry_is_revalidated_with_etag(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmPlants/', [
+            {'json': [{'name': 'Tomato'}], 'headers': {'ETag': '"v1"', 'Cache-Control': 'no-cache'}},
+            {'status_code': 304, 'headers': {'ETag': '"v1"', 'Cache-Control': 'no-cache'}},
+        ])
+
+        self.client.get('/api/resources/FarmPlants/')
+        response = self.client.get('/api/resources/FarmPlants/')
+
+        self.assertEqual(mock.last_request.headers['If-None-Match'], '"v1"')
+        self.assertEqual(response['X-Cache'], 'REVALIDATED')
+        self.assertEqual(response.json(), [{'name': 'Tomato'}])
+
+        not_modified = self.client.get('/api/resources/FarmPlants/', HTTP_IF_NONE_MATCH='"v1"')
+        self.assertEqual(not_modified.status_code, 304)
+
+    @override_settings(PROXY_CACHE={'MAX_ENTRIES': 1, 'SCOPE': 'shared', 'TTL': 60})
+    @requests_mock.Mocker()
+    def test_lru_eviction(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json=[])
+        mock.get(f'{FARM_CALENDAR_API}FarmPlants/', json=[])
+
+        self.client.get('/api/resources/FarmAssets/')
+        self.client.get('/api/resources/FarmPlants/')
+
+        stats = proxy_cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+    @requests_mock.Mocker()
+    def test_client_conditional_headers_are_answered_by_the_proxy(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json=[], headers={'ETag': '"v2"'})
+
+        response = self.client.get('/api/resources/FarmAssets/', HTTP_IF_NONE_MATCH='"v2"')
+
+        self.assertNotIn('If-None-Match', mock.last_request.headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"v2"')
@@ -0,0 +1,146 @@
+# aegis/tests/test_rate_limit.py
+
+import requests_mock
+
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from aegis.views.api.auth import TokenObtainView
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.ratelimit import Bucket, LocalBucketStore, client_ip, parse_rate, local_store
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+
+class TokenBucketTests(TestCase):
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('600/minute'), (600, 10))
+        self.assertEqual(parse_rate('10/5s'), (10, 2))
+
+    def test_bucket_allows_burst_then_refills(self):
+        store = LocalBucketStore()
+        bucket = Bucket('user:1', 2, 1000)
+        self.assertTrue(store.consume(bucket, 10).allowed)
+        self.assertTrue(store.consume(bucket, 10).allowed)
+
+        slow = Bucket('user:2', 1, 0.001)
+        store.consume(slow, 10)
+        state = store.consume(slow, 10)
+        self.assertFalse(state.allowed)
+        self.assertGreater(state.retry_after, 0)
+
+    @override_settings(TRUSTED_PROXIES=['172.16.0.0/12'])
+    def test_client_ip_behind_trusted_proxy(self):
+        factory = APIRequestFactory()
+        behind_nginx = factory.get('/', REMOTE_ADDR='172.18.0.3', HTTP_X_FORWARDED_FOR='6.6.6.6, 203.0.113.7')
+        real_ip = factory.get('/', REMOTE_ADDR='172.18.0.3', HTTP_X_REAL_IP='203.0.113.8')
+        direct = factory.get('/', REMOTE_ADDR='198.51.100.1', HTTP_X_FORWARDED_FOR='203.0.113.7')
+
+        # The client can put anything in front of the hop nginx appended
+        self.assertEqual(client_ip(behind_nginx), '203.0.113.7')
+        self.assertEqual(client_ip(real_ip), '203.0.113.8')
+        self.assertEqual(client_ip(direct), '198.51.100.1')
+
+    def test_local_store_is_bounded(self):
+        store = LocalBucketStore()
+        for key in range(5):
+            store.consume(Bucket(key, 1, 1), 3)
+        self.assertEqual(len(store._buckets), 3)
+
+
+@override_settings(RATE_LIMITS={'PROXY': {'USER': '2/minute'}})
+class ProxyRateLimitTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+        local_store.clear()
+
+    def tearDown(self):
+        # The buckets drained here would otherwise limit the proxy tests that follow
+        local_store.clear()
+
+    @requests_mock.Mocker()
+    def test_user_is_limited(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json={})
+
+        first = self.client.get('/api/resources/FarmAssets/')
+        self.client.get('/api/resources/FarmAssets/')
+        limited = self.client.get('/api/resources/FarmAssets/')
+
+        self.assertEqual(first['RateLimit-Limit'], '2')
+        self.assertEqual(first['RateLimit-Remaining'], '1')
+        self.assertEqual(limited.status_code, 429)
+        self.assertIn('Retry-After', limited)
+        self.assertEqual(mock.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_route_limits_override_service_limits(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json={})
+
+        with self.settings(REVERSE_PROXY_RATE_LIMITS={'FarmAssets': {'USER': '1/minute'}}):
+            self.client.get('/api/resources/FarmAssets/')
+            response = self.client.get('/api/resources/FarmAssets/')
+
+        self.assertEqual(response.status_code, 429)
+
+
+@override_settings(RATE_LIMITS={'LOGIN': {'USER': '2/minute', 'IP': '10/minute'}})
+class LoginRateLimitTests(TestCase):
+    def setUp(self):
+        DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        local_store.clear()
+
+    def tearDown(self):
+        local_store.clear()
+
+    def test_token_endpoint_is_limited_per_username(self):
+        for _ in range(2):
+            response = self.client.post('/api/token/', {'username': 'testuser', 'password': 'wrong'},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 401)
+
+        response = self.client.post('/api/token/', {'username': 'testuser', 'password': 'testpass'},
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+    def test_token_endpoint_issues_and_refreshes_tokens(self):
+        response = self.client.post('/api/token/', {'username': 'testuser', 'password': 'testpass'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/api/token/refresh/', {'refresh': response.json()['refresh_token']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.json())
+
+    @override_settings(TRUSTED_PROXIES=['172.16.0.0/12'])
+    def test_username_is_limited_per_client_ip(self):
+        factory = APIRequestFactory()
+        view = TokenObtainView.as_view()
+
+        def attempt(ip, password='wrong'):
+            return view(factory.post('/', {'username': 'testuser', 'password': password}, format='json',
+                                     REMOTE_ADDR='172.18.0.3', HTTP_X_FORWARDED_FOR=ip))
+
+        for _ in range(2):
+            attempt('203.0.113.7')
+        self.assertEqual(attempt('203.0.113.7').status_code, 429)
+        # Guessing from elsewhere doesn't lock the user out
+        self.assertEqual(attempt('198.51.100.1', 'testpass').status_code, 200)
+
+    def test_login_view_is_limited(self):
+        for _ in range(2):
+            self.client.post('/login/', {'username': 'testuser', 'password': 'wrong'})
+
+        response = self.client.post('/login/', {'username': 'testuser', 'password': 'testpass'})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertContains(response, 'Too many login attempts', status_code=429)
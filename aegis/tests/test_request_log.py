@@ -0,0 +1,215 @@
+# aegis/tests/test_request_log.py
+
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend, RequestLog
+from gatekeeper.request_log import DatabaseSink, JsonLinesSink, RequestLogWriter, get_request_logging_config, \
+    get_sink
+
+
+
+def record(path='/'):
+    return {'user_id': None, 'ip_address': '127.0.0.1', 'user_agent': 'test', 'path': path, 'query_string': '',
+            'body': '', 'method': 'GET', 'response_status': 200, 'timestamp': timezone.now()}
+
+
+@override_settings(REQUEST_LOGGING={'QUEUE_SIZE': 2, 'BATCH_SIZE': 2, 'FLUSH_INTERVAL': 0.05,
+                                    'BLOCK_TIMEOUT': 0.05})
+class RequestLogWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        patcher = mock.patch('gatekeeper.request_log.write_records', side_effect=self.write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The traffic counters the thread flushes are covered by test_traffic
+        patcher = mock.patch('gatekeeper.request_log.traffic_counters')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = RequestLogWriter()
+        self.addCleanup(self.writer.stop)
+
+    def write(self, records, config):
+        self.writing.set()
+        self.release.wait(5)
+        self.batches.append([r['path'] for r in records])
+
+    def stall(self):
+        # The writer thread takes the first record and hangs in its insert, the queue fills up
+        self.release.clear()
+        self.writer.submit(record('/stalled'))
+        self.assertTrue(self.writing.wait(5))
+
+    def written(self):
+        return sorted(path for batch in self.batches for path in batch)
+
+    def test_unstarted_writer_writes_right_away(self):
+        self.writer.submit(record('/now'))
+        self.assertEqual(self.batches, [['/now']])
+
+    def test_records_are_batched_and_flushed_on_stop(self):
+        self.writer.start()
+        self.stall()
+        for i in range(2):
+            self.writer.submit(record(f'/{i}'))
+        self.release.set()
+        self.writer.stop()
+
+        self.assertEqual(self.written(), ['/0', '/1', '/stalled'])
+        self.assertIn(['/0', '/1'], self.batches)
+
+    def test_overflow_drops(self):
+        self.writer.start()
+        self.stall()
+        for i in range(3):
+            self.writer.submit(record(f'/{i}'))
+        self.release.set()
+        self.writer.stop()
+
+        self.assertEqual(self.written(), ['/0', '/1', '/stalled'])
+
+    @override_settings(REQUEST_LOGGING={'QUEUE_SIZE': 4, 'OVERFLOW': 'sample', 'SAMPLE_RATE': 0})
+    def test_sampling_from_half_full(self):
+        self.writer.start()
+        self.stall()
+        for i in range(3):
+            self.writer.submit(record(f'/{i}'))
+        self.release.set()
+        self.writer.stop()
+
+        self.assertEqual(self.written(), ['/0', '/1', '/stalled'])
+
+    @override_settings(REQUEST_LOGGING={'QUEUE_SIZE': 1, 'OVERFLOW': 'block', 'BLOCK_TIMEOUT': 0.05})
+    def test_block_waits_for_room(self):
+        self.writer.start()
+        self.stall()
+        self.writer.submit(record('/0'))
+
+        started = time.monotonic()
+        self.writer.submit(record('/1'))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.release.set()
+        self.writer.stop()
+
+        self.assertEqual(self.written(), ['/0', '/stalled'])
+
+
+class DatabaseSinkTests(TestCase):
+    def test_a_bad_record_only_loses_itself(self):
+        config = get_request_logging_config()
+        bad = dict(record('/bad'), response_status=None)
+
+        dropped = DatabaseSink(config).write([record('/1'), bad, record('/2')], config)
+
+        self.assertEqual(dropped, 1)
+        self.assertEqual(sorted(RequestLog.objects.values_list('path', flat=True)), ['/1', '/2'])
+
+    def test_long_paths_are_cut_to_the_column(self):
+        self.client.get('/' + 'x' * 300)
+        self.client.get('/login/')
+
+        self.assertEqual(sorted(len(path) for path in RequestLog.objects.values_list('path', flat=True)), [7, 200])
+
+
+class JsonLinesSinkTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def config(self, **options):
+        config = get_request_logging_config()
+        config.update({'DIRECTORY': self.directory, 'ROTATE_BYTES': 1024, **options})
+        return config
+
+    def segments(self):
+        return sorted(os.path.basename(path) for path in glob.glob(os.path.join(self.directory, 'requests-*')))
+
+    def test_segments_rotate_and_load(self):
+        config = self.config()
+        sink = JsonLinesSink(config)
+        for i in range(20):
+            sink.write([record(f'/{i}')], config)
+        sink.close(config)
+
+        segments = self.segments()
+        self.assertGreater(len(segments), 1)
+        self.assertTrue(all(segment.endswith('.jsonl.gz') for segment in segments))
+        self.assertEqual(glob.glob(os.path.join(self.directory, 'current-*')), [])
+
+        call_command('load_request_logs', '--directory', self.directory, stdout=StringIO())
+        self.assertEqual(sorted(RequestLog.objects.values_list('path', flat=True)),
+                         sorted(f'/{i}' for i in range(20)))
+        self.assertEqual(self.segments(), [])
+
+    def test_malformed_lines_are_skipped(self):
+        config = self.config(COMPRESS=False)
+        sink = JsonLinesSink(config)
+        sink.write([record('/ok')], config)
+        sink._file.write('{"path": "/cut')
+        sink.close(config)
+
+        call_command('load_request_logs', '--directory', self.directory, '--keep', stdout=StringIO())
+        self.assertEqual(list(RequestLog.objects.values_list('path', flat=True)), ['/ok'])
+        self.assertEqual(len(self.segments()), 1)
+
+
+class RequestLogRoutesTests(TestCase):
+    @override_settings(REQUEST_LOGGING={'ROUTES': {'/metrics': {'SAMPLE_RATE': 0},
+                                                   '/api/resources/': {'BODY_LIMIT': 2}}})
+    def test_per_route_sampling_and_body_limit(self):
+        user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+
+        self.client.get('/metrics')
+        self.client.post('/api/resources/_batch', '{"requests": []}', content_type='application/json',
+                         HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+
+        self.assertEqual(list(RequestLog.objects.values_list('path', 'body')), [('/api/resources/_batch', '{"')])
+
+
+class CredentialRedactionTests(TestCase):
+    PASSWORD = 'S3cret-pass!'
+
+    def post_credentials(self):
+        DefaultAuthUserExtend.objects.create_user(username='testuser', password=self.PASSWORD,
+                                                  email='test@example.com')
+        self.client.post('/login/', {'username': 'testuser', 'password': self.PASSWORD})
+        # Mismatched confirmations, so the forms are read but nothing is saved
+        self.client.post('/register/', {'username': 'other', 'email': 'other@example.com',
+                                        'password1': self.PASSWORD, 'password2': 'other'})
+        self.client.post('/reset_password/', {'email': 'test@example.com', 'new_password1': self.PASSWORD,
+                                              'new_password2': 'other'})
+        self.client.post('/api/token/', {'username': 'testuser', 'password': self.PASSWORD},
+                         content_type='application/json')
+
+    def test_no_password_reaches_the_database(self):
+        self.post_credentials()
+
+        bodies = list(RequestLog.objects.values_list('path', 'body'))
+        self.assertEqual(sorted(path for path, _ in bodies), ['/api/token/', '/login/', '/register/', '/reset_password/'])
+        self.assertEqual({body for _, body in bodies}, {'[redacted]'})
+
+    def test_no_password_reaches_the_jsonl_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        with self.settings(REQUEST_LOGGING={'SINK': 'jsonl', 'DIRECTORY': directory, 'COMPRESS': False}):
+            self.post_credentials()
+            get_sink(get_request_logging_config()).close(get_request_logging_config())
+
+        written = ''.join(open(path).read() for path in glob.glob(os.path.join(directory, 'requests-*')))
+        self.assertIn('/reset_password/', written)
+        self.assertNotIn(self.PASSWORD, written)
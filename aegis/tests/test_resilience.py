@@ -0,0 +1,152 @@
+# aegis/tests/test_resilience.py
+
+import time
+from unittest import mock
+
+import requests_mock
+
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import CircuitBreaker, RetryBudget, DEFAULT_CIRCUIT_BREAKER, \
+    DEFAULT_UPSTREAM_RETRY, CLOSED, OPEN, HALF_OPEN, publish_breaker_state, published_breaker_states, \
+    upstream_guards
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+# Breaker states are published to the shared cache, kept in memory rather than on disk in tests
+LOCAL_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+}
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CircuitBreakerTests(TestCase):
+    def breaker(self, publish=False, **config):
+        breaker = CircuitBreaker('FarmCalendar', dict(DEFAULT_CIRCUIT_BREAKER, **config))
+        if not publish:
+            # No publisher threads left running into the next tests
+            breaker._publish = lambda changed: None
+        return breaker
+
+    def test_opens_on_error_rate_after_min_calls(self):
+        breaker = self.breaker(MIN_CALLS=4)
+        for _ in range(3):
+            breaker.record(False, 0.01)
+        self.assertEqual(breaker.state, CLOSED)
+
+        breaker.record(False, 0.01)
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow_request())
+        self.assertGreater(breaker.retry_after(), 0)
+
+    def test_opens_on_slow_call_rate(self):
+        breaker = self.breaker(MIN_CALLS=2, SLOW_CALL_DURATION=1)
+        breaker.record(True, 2)
+        breaker.record(True, 2)
+
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open_trial_closes_or_reopens(self):
+        breaker = self.breaker(MIN_CALLS=1, OPEN_DURATION=0)
+        breaker.record(False, 0.01)
+
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow_request())
+        breaker.record(False, 0.01)
+        self.assertEqual(breaker.state, OPEN)
+
+        self.assertTrue(breaker.allow_request())
+        breaker.record(True, 0.01)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_state_changes_are_published_outside_the_lock(self):
+        caches['shared'].clear()
+        breaker = self.breaker(publish=True, MIN_CALLS=1)
+        locked = []
+
+        def publish(*args):
+            locked.append(breaker._lock.locked())
+            publish_breaker_state(*args)
+
+        with mock.patch('gatekeeper.proxy.resilience.publish_breaker_state', side_effect=publish):
+            breaker.record(False, 0.01)
+            breaker._publisher.join()
+
+        self.assertEqual(locked, [False])
+        self.assertEqual([state['state'] for state in published_breaker_states('FarmCalendar').values()], [OPEN])
+
+    def test_published_states_are_kept_per_worker(self):
+        caches['shared'].clear()
+        with mock.patch('gatekeeper.proxy.resilience.os.getpid', return_value=1):
+            publish_breaker_state('FarmCalendar', OPEN, 2, 60)
+            # A change published late doesn't overwrite a newer one
+            publish_breaker_state('FarmCalendar', CLOSED, 1, 60)
+        with mock.patch('gatekeeper.proxy.resilience.os.getpid', return_value=2):
+            publish_breaker_state('FarmCalendar', HALF_OPEN, 3, 60)
+
+        states = published_breaker_states('FarmCalendar')
+        self.assertEqual({pid: state['state'] for pid, state in states.items()}, {1: OPEN, 2: HALF_OPEN})
+
+        caches['shared'].delete('proxy:circuit_breakers:FarmCalendar:1')
+        self.assertEqual(list(published_breaker_states('FarmCalendar')), [2])
+
+    def test_retry_budget_limits_retries(self):
+        budget = RetryBudget(dict(DEFAULT_UPSTREAM_RETRY, BUDGET_MIN_PER_SECOND=0, BUDGET_RATIO=0.5))
+        budget._tokens = 0
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+
+@override_settings(UPSTREAM_RETRY={'BACKOFF_BASE': 0}, CIRCUIT_BREAKER={'MIN_CALLS': 3}, CACHES=LOCAL_CACHES)
+class ResilientProxyTests(TestCase):
+    def setUp(self):
+        publish = mock.patch.object(CircuitBreaker, '_publish')
+        publish.start()
+        self.addCleanup(publish.stop)
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+
+    @requests_mock.Mocker()
+    def test_idempotent_request_is_retried(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmActivities/', [{'status_code': 503}, {'json': {'data': 'ok'}}])
+
+        response = self.client.get('/api/resources/FarmActivities/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_post_is_not_retried(self, mock):
+        mock.post(f'{FARM_CALENDAR_API}FarmActivities/', status_code=503)
+
+        response = self.client.post('/api/resources/FarmActivities/', {'a': 1}, format='json')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(mock.call_count, 1)
+
+    @requests_mock.Mocker()
+    def test_open_breaker_fails_fast(self, mock):
+        mock.post(f'{FARM_CALENDAR_API}FarmActivities/', status_code=500)
+        for _ in range(3):
+            self.client.post('/api/resources/FarmActivities/', {}, format='json')
+
+        response = self.client.post('/api/resources/FarmActivities/', {}, format='json')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(mock.call_count, 3)
+        state = upstream_guards.breaker('FarmCalendar').snapshot()
+        self.assertEqual(state['state'], OPEN)
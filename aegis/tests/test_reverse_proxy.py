@@ -0,0 +1,144 @@
+# aegis/tests/test_reverse_proxy.py
+
+import json
+import logging
+import requests
+import requests_mock
+
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend, RequestLog
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.proxy.upstream import upstream_pool
+
+logger = logging.getLogger('aegis')
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+
+class ReverseProxyTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.token = str(AccessToken.for_user(self.user))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+
+    @requests_mock.Mocker()
+    def test_proxy_reuses_service_session(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmActivities/', json={'data': 'activities'})
+
+        session = upstream_pool.get_session('FarmCalendar')
+        response = self.client.get('/api/resources/FarmActivities/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'data': 'activities'})
+        self.assertIs(upstream_pool.get_session('FarmCalendar'), session)
+        self.assertEqual(mock.last_request.timeout, upstream_pool.get_timeout('FarmCalendar'))
+
+    @requests_mock.Mocker()
+    def test_proxy_does_not_forward_hop_by_hop_headers(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json={})
+
+        self.client.get('/api/resources/FarmAssets/', HTTP_CONNECTION='close, X-Private', HTTP_X_PRIVATE='1')
+
+        self.assertEqual(mock.last_request.headers['Connection'], 'keep-alive')
+        self.assertNotIn('X-Private', mock.last_request.headers)
+        self.assertIn('Authorization', mock.last_request.headers)
+
+    @requests_mock.Mocker()
+    def test_proxy_upstream_timeout(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmPlants/', exc=requests.exceptions.ConnectTimeout)
+
+        response = self.client.get('/api/resources/FarmPlants/')
+
+        self.assertEqual(response.status_code, 504)
+
+    @requests_mock.Mocker()
+    def test_proxy_buffers_small_responses(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmActivityTypes/', content=b'[]', headers={'Content-Type': 'application/json'})
+
+        response = self.client.get('/api/resources/FarmActivityTypes/')
+
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content, b'[]')
+
+    @override_settings(PROXY_STREAMING={'BUFFER_LIMIT': 8, 'CHUNK_SIZE': 4})
+    @requests_mock.Mocker()
+    def test_proxy_streams_responses_above_buffer_limit(self, mock):
+        body = b'{"assets": "' + b'x' * 64 + b'"}'
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', content=body, headers={'Content-Length': str(len(body))})
+
+        response = self.client.get('/api/resources/FarmAssets/')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Length'], str(len(body)))
+        self.assertEqual(b''.join(response.streaming_content), body)
+
+    @override_settings(PROXY_STREAMING={'BUFFER_LIMIT': 8, 'CHUNK_SIZE': 4})
+    @requests_mock.Mocker()
+    def test_proxy_streams_undeclared_length_once_buffer_limit_is_hit(self, mock):
+        body = b'x' * 32
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', content=body)
+
+        response = self.client.get('/api/resources/FarmAssets/')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), body)
+
+    @requests_mock.Mocker()
+    def test_proxy_forwards_json_body(self, mock):
+        mock.post(f'{FARM_CALENDAR_API}FarmActivities/', status_code=201, json={'id': 1})
+
+        response = self.client.post(
+            '/api/resources/FarmActivities/', data=json.dumps({'title': 'Sowing'}), content_type='application/json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(mock.last_request.json(), {'title': 'Sowing'})
+
+    @override_settings(PROXY_REQUEST_BODY={'MEMORY_LIMIT': 16, 'CHUNK_SIZE': 8})
+    @requests_mock.Mocker()
+    def test_proxy_spools_large_bodies(self, mock):
+        received = {}
+
+        def upstream(request, context):
+            received['length'] = request.headers['Content-Length']
+            received['body'] = request.body.read()
+            return {}
+        mock.put(f'{FARM_CALENDAR_API}FarmActivities/1/', json=upstream)
+        body = json.dumps({'activities': ['x' * 10] * 10})
+
+        self.client.put('/api/resources/FarmActivities/1/', data=body, content_type='application/json')
+
+        self.assertEqual(received['length'], str(len(body)))
+        self.assertEqual(received['body'], body.encode())
+
+    @override_settings(PROXY_REQUEST_BODY={'MEMORY_LIMIT': 16, 'STREAM': True})
+    @requests_mock.Mocker()
+    def test_proxy_streams_large_bodies(self, mock):
+        received = {}
+
+        def upstream(request, context):
+            received['length'] = request.headers['Content-Length']
+            received['body'] = request.body.read()
+            return {}
+        mock.post(f'{FARM_CALENDAR_API}FarmActivities/', json=upstream)
+        body = json.dumps({'activities': ['x' * 10] * 10})
+
+        self.client.post('/api/resources/FarmActivities/', data=body, content_type='application/json')
+
+        self.assertEqual(received['length'], str(len(body)))
+        self.assertEqual(received['body'], body.encode())
+
+    @override_settings(REQUEST_LOGGING={'BODY_LIMIT': 8})
+    @requests_mock.Mocker()
+    def test_request_log_keeps_bounded_body_prefix(self, mock):
+        mock.post(f'{FARM_CALENDAR_API}FarmActivities/', json={})
+
+        self.client.post('/api/resources/FarmActivities/', data='{"title": "Sowing"}', content_type='application/json')
+
+        self.assertEqual(RequestLog.objects.get(path='/api/resources/FarmActivities/').body, '{"title"')
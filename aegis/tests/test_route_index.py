@@ -0,0 +1,58 @@
+# aegis/tests/test_route_index.py
+
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.routing import RouteIndex
+
+SERVICES = {
+    'FarmCalendar': {'api': 'http://farm_calendar/api/'},
+    'WeatherService': {'api': 'http://weather/api/'},
+    'Reports': {'api': 'http://reports/api/'},
+}
+
+
+class RouteIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = RouteIndex({
+            'FarmActivityTypes': 'FarmCalendar',
+            'FarmActivities': 'FarmCalendar',
+            'WeeklyWeatherForecast': 'WeatherService',
+            'FarmActivities/Reports': 'Reports',
+        }, SERVICES)
+
+    def test_resolves_whole_segments_only(self):
+        self.assertEqual(self.index.resolve('v1/FarmActivityTypes/3/').entity, 'FarmActivityTypes')
+        self.assertEqual(self.index.resolve('v1/FarmActivities/').entity, 'FarmActivities')
+        self.assertIsNone(self.index.resolve('v1/FarmActivitiesExtra/'))
+
+    def test_longest_match_wins(self):
+        route = self.index.resolve('v1/FarmActivities/Reports/?year=2024')
+        self.assertEqual(route.service, 'Reports')
+        self.assertEqual(route.api, 'http://reports/api/')
+
+    def test_route_table(self):
+        entities = [route.entity for route in self.index.routes()]
+        self.assertEqual(entities, sorted(entities))
+        self.assertEqual(len(entities), 4)
+
+
+class RouteTableViewTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_route_table_requires_admin(self):
+        user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.force_authenticate(user)
+        self.assertEqual(self.client.get('/api/proxy/routes/').status_code, 403)
+
+    def test_route_table_lists_mapping(self):
+        admin = DefaultAuthUserExtend.objects.create_superuser(
+            username='admin', email='admin@example.com', password='testpass')
+        self.client.force_authenticate(admin)
+        response = self.client.get('/api/proxy/routes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            {'entity': 'WeeklyWeatherForecast', 'service': 'WeatherService', 'api': 'http://external_weather/api/'},
+            response.json()['routes'])
@@ -0,0 +1,139 @@
+# aegis/tests/test_server_timing.py
+
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+import requests_mock
+
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend
+from gatekeeper.proxy.async_upstream import ConnectTrace
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.proxy.upstream import TimedHTTPAdapter, connect_time
+from gatekeeper.timing import LatencyHistogram, RequestTimer, latency_histograms
+
+FARM_CALENDAR_API = 'http://127.0.0.1:8002/api/'
+
+
+class LatencyHistogramTests(TestCase):
+    def test_quantiles(self):
+        histogram = LatencyHistogram(buckets=(0.01, 0.1, 1))
+        for _ in range(90):
+            histogram.observe(0.005)
+        for _ in range(10):
+            histogram.observe(0.5)
+
+        self.assertLessEqual(histogram.quantile(0.5), 0.01)
+        self.assertGreater(histogram.quantile(0.99), 0.1)
+        self.assertEqual(histogram.snapshot()['count'], 100)
+        self.assertEqual(sum(histogram.counts), 100)
+
+    def test_timer_adds_up_repeated_stages(self):
+        timer = RequestTimer()
+        timer.add('upstream', 0.01)
+        timer.add('upstream', 0.02)
+        self.assertEqual(timer.header(), 'upstream;dur=30.0')
+
+
+class NoContentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectTimingTests(TestCase):
+    def test_new_connections_are_timed(self):
+        server = HTTPServer(('127.0.0.1', 0), NoContentHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        session = requests.Session()
+        session.mount('http://', TimedHTTPAdapter())
+        self.addCleanup(session.close)
+        url = f'http://127.0.0.1:{server.server_port}/'
+
+        connect_time()
+        session.get(url)
+        self.assertGreater(connect_time(), 0)
+        # The keep-alive connection is reused
+        session.get(url)
+        self.assertEqual(connect_time(), 0)
+
+    def test_connect_trace(self):
+        trace = ConnectTrace()
+
+        async def connect():
+            for event in ('connection.connect_tcp.started', 'connection.connect_tcp.complete',
+                          'http11.send_request_headers.started', 'http11.send_request_headers.complete'):
+                await trace(event, {})
+
+        asyncio.run(connect())
+        self.assertGreater(trace.duration, 0)
+
+
+class ServerTimingTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(username='testuser', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+        latency_histograms.clear()
+
+    @requests_mock.Mocker()
+    def test_header_is_opt_in(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json={})
+
+        self.assertNotIn('Server-Timing', self.client.get('/api/resources/FarmAssets/'))
+        with self.settings(SERVER_TIMING={'HEADER': True}):
+            response = self.client.get('/api/resources/FarmAssets/')
+
+        stages = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        for stage in ('auth', 'route', 'ratelimit', 'cache', 'upstream', 'body', 'log', 'total'):
+            self.assertIn(stage, stages)
+
+    @requests_mock.Mocker()
+    def test_histograms_per_service_and_stage(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', json={})
+
+        self.client.get('/api/resources/FarmAssets/')
+        self.client.get('/api/resources/FarmAssets/')
+
+        stages = latency_histograms.snapshot()['FarmCalendar']
+        self.assertEqual(stages['upstream']['count'], 2)
+        self.assertEqual(stages['total']['count'], 2)
+
+    @override_settings(PROXY_STREAMING={'STREAM': True})
+    @requests_mock.Mocker()
+    def test_streamed_body_is_timed_until_sent(self, mock):
+        mock.get(f'{FARM_CALENDAR_API}FarmAssets/', content=b'x' * 10)
+
+        with self.settings(SERVER_TIMING={'HEADER': True}):
+            response = self.client.get('/api/resources/FarmAssets/')
+        self.assertNotIn('body;', response['Server-Timing'])
+        self.assertNotIn('body', latency_histograms.snapshot()['FarmCalendar'])
+
+        b''.join(response.streaming_content)
+        response.close()
+        self.assertEqual(latency_histograms.snapshot()['FarmCalendar']['body']['count'], 1)
+
+    def test_latency_stats_endpoint(self):
+        admin = DefaultAuthUserExtend.objects.create_superuser(
+            username='admin', email='admin@example.com', password='testpass')
+        self.client.force_authenticate(admin)
+
+        response = self.client.get('/api/proxy/latency/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('services', response.json())
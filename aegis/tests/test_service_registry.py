@@ -0,0 +1,102 @@
+# aegis/tests/test_service_registry.py
+
+from unittest import mock
+
+import requests_mock
+
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from aegis.models import DefaultAuthUserExtend, RegisteredService, ServiceRoute
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.registry import service_registry
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.ratelimit import local_store
+
+
+@override_settings(SERVICE_REGISTRY={'REFRESH_INTERVAL': 0})
+class ServiceRegistryTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = DefaultAuthUserExtend.objects.create_user(
+            username='testuser', email='test@example.com', password='testpass')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        proxy_cache.clear()
+        upstream_guards.reset()
+        service_registry.reset()
+
+    def tearDown(self):
+        local_store.clear()
+        service_registry.reset()
+
+    def register(self, name='SoilService', api='http://soil-1/api/\nhttp://soil-2/api/', entities=('SoilSamples',),
+                 **kwargs):
+        service = RegisteredService.objects.create(name=name, api=api, **kwargs)
+        for entity in entities:
+            ServiceRoute.objects.create(entity=entity, service=service)
+        return service
+
+    @requests_mock.Mocker()
+    def test_registered_route_is_proxied_without_restart(self, mock):
+        self.assertEqual(self.client.get('/api/resources/SoilSamples/').status_code, 405)
+        self.register()
+        mock.get('http://soil-1/api/SoilSamples/', json={'samples': []})
+        mock.get('http://soil-2/api/SoilSamples/', json={'samples': []})
+
+        response = self.client.get('/api/resources/SoilSamples/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(service_registry.current().services['SoilService']['api'],
+                         ['http://soil-1/api/', 'http://soil-2/api/'])
+        # The settings routes are still served
+        self.assertEqual(service_registry.current().route_index.resolve('FarmAssets/').service, 'FarmCalendar')
+
+    def test_unchanged_version_keeps_snapshot(self):
+        self.register()
+        snapshot = service_registry.refresh_if_stale()
+        # One query for the version, none for the services and routes
+        with self.assertNumQueries(1):
+            self.assertIs(service_registry.refresh_if_stale(), snapshot)
+
+        ServiceRoute.objects.create(entity='SoilMoisture', service=RegisteredService.objects.get())
+        self.assertIsNot(service_registry.refresh_if_stale(), snapshot)
+        self.assertEqual(service_registry.current().route_index.resolve('SoilMoisture/').service, 'SoilService')
+
+    @override_settings(SERVICE_REGISTRY={'REFRESH_INTERVAL': 60})
+    def test_no_query_between_checks(self):
+        service_registry.refresh_if_stale()
+        with self.assertNumQueries(0):
+            service_registry.refresh_if_stale()
+
+    @override_settings(SERVICE_REGISTRY={'REFRESH_INTERVAL': 60})
+    def test_failed_load_waits_for_the_interval(self):
+        with mock.patch('aegis.models.ServiceRegistryVersion.current', side_effect=DatabaseError('down')) as current:
+            for _ in range(3):
+                snapshot = service_registry.refresh_if_stale()
+        self.assertEqual(current.call_count, 1)
+        # The settings routes keep being served meanwhile
+        self.assertEqual(snapshot.route_index.resolve('FarmAssets/').service, 'FarmCalendar')
+
+    def test_deactivated_service_is_withdrawn(self):
+        service = self.register(name='FarmCalendar', api='http://calendar-v2/api/', entities=())
+        self.assertEqual(service_registry.refresh_if_stale().route_index.resolve('FarmAssets/').api,
+                         ['http://calendar-v2/api/'])
+
+        service.status = False
+        service.save()
+        snapshot = service_registry.refresh_if_stale()
+        self.assertNotIn('FarmCalendar', snapshot.services)
+        self.assertIsNone(snapshot.route_index.resolve('FarmAssets/'))
+
+    def test_login_redirects_to_registered_post_auth(self):
+        self.register(post_auth='http://soil-1/post_auth/')
+        session = self.client.session
+        session['next'] = 'SoilService'
+        session.save()
+
+        response = self.client.post('/login/', {'username': 'testuser', 'password': 'testpass'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith('http://soil-1/post_auth/?auth_token='))
@@ -0,0 +1,87 @@
+# aegis/tests/test_single_flight.py
+
+import asyncio
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from gatekeeper.proxy.singleflight import SingleFlight, AsyncSingleFlight
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_calls_share_one_result(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'response'
+
+        def request():
+            results.append(single_flight.do('FarmActivityTypes', fetch, timeout=5))
+
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        threads[0].start()
+        while not calls:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        while single_flight.coalesced < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('response', False)] + [('response', True)] * 4)
+
+    def test_waiters_get_nothing_when_the_call_fails(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def failing_fetch():
+            started.set()
+            release.wait(5)
+            raise ValueError('upstream broke')
+
+        def leader():
+            with self.assertRaises(ValueError):
+                single_flight.do('key', failing_fetch)
+
+        leader_thread = threading.Thread(target=leader)
+        leader_thread.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(single_flight.do('key', lambda: 'own', timeout=5)))
+        follower.start()
+        while single_flight.coalesced < 1:
+            time.sleep(0.001)
+        release.set()
+        leader_thread.join()
+        follower.join()
+
+        self.assertEqual(results, [(None, True)])
+
+
+class AsyncSingleFlightTests(SimpleTestCase):
+    def test_concurrent_coroutines_share_one_result(self):
+        single_flight = AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'response'
+
+        async def run():
+            return await asyncio.gather(*[single_flight.do('key', fetch) for _ in range(3)])
+
+        results = asyncio.run(run())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [('response', False), ('response', True), ('response', True)])
@@ -0,0 +1,93 @@
+# aegis/tests/test_traffic.py
+
+from datetime import timedelta
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from aegis.models import DefaultAuthUserExtend, TrafficHour, TrafficMinute
+from gatekeeper.timing import LatencyHistogram
+from gatekeeper.traffic import prune_rollups, traffic_counters, traffic_summary
+
+
+class TrafficRollupTests(TestCase):
+    def setUp(self):
+        traffic_counters.clear()
+        self.addCleanup(traffic_counters.clear)
+        self.user = DefaultAuthUserExtend.objects.create_user(username='admin', password='testpass',
+                                                              email='admin@example.com', is_staff=True)
+
+    def test_requests_are_counted_into_minute_and_hour_rollups(self):
+        self.client.get('/login/')
+        self.client.get('/login/')
+        self.client.get('/missing/')
+        traffic_counters.flush()
+
+        self.assertEqual(
+            sorted(TrafficMinute.objects.values_list('route', 'service', 'status_class', 'user_id', 'requests')),
+            [('login', 'gatekeeper', '2xx', 0, 2), ('unmatched', 'gatekeeper', '4xx', 0, 1)])
+        hour = TrafficHour.objects.get(route='login')
+        self.assertEqual(hour.bucket, TrafficMinute.objects.get(route='login').bucket.replace(minute=0))
+        self.assertEqual(sum(hour.latency_counts), 2)
+        self.assertGreater(hour.latency_sum, 0)
+
+    def test_flushes_add_up(self):
+        for duration in (0.002, 0.2):
+            traffic_counters.record('login', 'gatekeeper', 200, self.user.pk, duration)
+            traffic_counters.flush()
+
+        rollup = TrafficMinute.objects.get()
+        self.assertEqual((rollup.user_id, rollup.requests), (self.user.pk, 2))
+        self.assertAlmostEqual(rollup.latency_sum, 0.202)
+        self.assertEqual(TrafficHour.objects.get().requests, 2)
+
+    def test_summary_merges_the_latency_histograms(self):
+        for _ in range(90):
+            traffic_counters.record('login', 'gatekeeper', 200, self.user.pk, 0.004)
+        for _ in range(10):
+            traffic_counters.record('login', 'FarmCalendar', 502, None, 2)
+        traffic_counters.flush()
+
+        summary = traffic_summary()
+
+        self.assertEqual(sum(minute['requests'] for minute in summary['minutes']), 100)
+        self.assertEqual(sum(minute['errors'] for minute in summary['minutes']), 10)
+        route = summary['routes'][0]
+        self.assertEqual((route['route'], route['requests'], route['errors']), ('login', 100, 10))
+        self.assertLessEqual(route['p50_ms'], 5)
+        self.assertGreater(route['p99_ms'], 1000)
+        self.assertEqual([(row['username'], row['requests']) for row in summary['users']],
+                         [('admin', 90), ('anonymous', 10)])
+
+    def test_dashboard_is_read_from_the_rollups(self):
+        traffic_counters.record('login', 'gatekeeper', 200, None, 0.01)
+        traffic_counters.flush()
+        self.client.login(username='admin', password='testpass')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('aegis:dashboard'))
+
+        # One query per rollup table, nothing scans the activity log
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(len([sql for sql in selects if 'traffic_' in sql]), 2)
+        self.assertFalse([sql for sql in selects if 'activity_log' in sql])
+        self.assertEqual(response.context['traffic']['total']['requests'], 1)
+        self.assertContains(response, 'traffic-per-minute')
+
+    def test_expired_rollups_are_pruned(self):
+        old = timezone.now() - timedelta(days=3)
+        TrafficMinute.objects.create(bucket=old, route='login', service='gatekeeper', status_class='2xx', requests=1)
+        TrafficHour.objects.create(bucket=old, route='login', service='gatekeeper', status_class='2xx', requests=1)
+
+        self.assertEqual(prune_rollups(), 1)
+        self.assertTrue(TrafficHour.objects.exists())
+
+    def test_histogram_merge(self):
+        first, second = LatencyHistogram(), LatencyHistogram()
+        first.observe(0.001)
+        second.observe(1)
+        first.merge(second)
+        self.assertEqual((first.count, sum(first.counts)), (2, 2))
@@ -2,6 +2,8 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from .mixins import AdminMenuMixin
 from django.views.generic import TemplateView
 
+from gatekeeper.traffic import traffic_summary
+
 
 class DashboardView(LoginRequiredMixin, TemplateView, AdminMenuMixin):
     template_name = "dashboard.html"
@@ -9,5 +11,7 @@ class DashboardView(LoginRequiredMixin, TemplateView, AdminMenuMixin):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        # Read from the traffic rollups, not the activity log, so the page costs the same at any traffic
+        if self.request.user.is_staff:
+            context['traffic'] = traffic_summary()
         return context
-
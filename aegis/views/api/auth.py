@@ -4,25 +4,40 @@ from django.views.generic import TemplateView
 from django.contrib.auth import authenticate, login as auth_login
 from django.contrib.auth import authenticate
 from django.views.decorators.cache import never_cache
+from django.views.decorators.debug import sensitive_post_parameters
 from django.utils.decorators import method_decorator
 from django.shortcuts import render, redirect
 
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenRefreshView
+from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 import logging
 
 from gatekeeper.forms import LoginForm, RegisterForm
+from gatekeeper.ratelimit import login_rate_limit
+from gatekeeper.tokens import RefreshToken
 
 logger = logging.getLogger('aegis')
 
 
+# Request bodies of views marked with sensitive_post_parameters are left out of the activity log
+@method_decorator(sensitive_post_parameters(), name='dispatch')
 class TokenObtainView(APIView):
+    # Credentials are what this view checks, the default IsAuthenticated would refuse every request
+    permission_classes = [AllowAny]
+
     def post(self, request, *args, **kwargs):
         username = request.data.get('username')
         password = request.data.get('password')
+
+        # Throttle before the password hash is checked, it's what an attacker makes us pay for
+        limit = login_rate_limit(request, username)
+        if not limit.allowed:
+            return limit.annotate(
+                Response({"error": "Too many login attempts"}, status=status.HTTP_429_TOO_MANY_REQUESTS))
+
         user = authenticate(username=username, password=password)
 
         if user is not None:
@@ -36,8 +51,10 @@ class TokenObtainView(APIView):
             return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
 
 
+@method_decorator(sensitive_post_parameters(), name='dispatch')
 class CustomTokenRefreshView(TokenRefreshView):
     def post(self, request, *args, **kwargs):
         response = super().post(request, *args, **kwargs)
-        logger.info(f"Refreshed token: {response.data.get('access_token')}")
+        # Never log the token itself, the log would hand it to anyone who can read it
+        logger.info("Refreshed an access token")
         return response
@@ -0,0 +1,198 @@
+import logging
+import time
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_ACTIVITY_LOG = {
+    'RETENTION_DAYS': 90,           # days of requests kept in the activity_log table
+    'PARTITIONS_AHEAD': 7,          # daily partitions created ahead of time, on PostgreSQL
+    'PRUNE_BATCH_SIZE': 5000,       # rows deleted by one statement, each in its own transaction
+    'PRUNE_PAUSE': 0.1,             # seconds between two batches
+}
+
+ROLLUP_KEY = ('path', 'method', 'response_status')
+
+
+def get_activity_log_config():
+    config = dict(DEFAULT_ACTIVITY_LOG)
+    config.update(getattr(settings, 'ACTIVITY_LOG', {}))
+    return config
+
+
+def day_start(moment):
+    """
+    The UTC midnight starting the day of `moment`, the lower bound of its partition.
+    """
+    return datetime.combine(moment.astimezone(dt_timezone.utc).date(), dt_time.min, tzinfo=dt_timezone.utc)
+
+
+def partition_name(day):
+    return f'activity_log_p{day:%Y%m%d}'
+
+
+def is_partitioned():
+    """
+    Whether activity_log is a natively partitioned PostgreSQL table; on other backends
+    it is a plain table and old rows are only ever deleted in batches.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('activity_log')")
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def partitions():
+    """
+    The daily partitions of activity_log as (name, start, end), oldest first, without
+    the default partition.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass('activity_log')")
+        names = [row[0] for row in cursor.fetchall()]
+    found = []
+    for name in names:
+        if not name.startswith('activity_log_p'):
+            continue
+        start = datetime.strptime(name[len('activity_log_p'):], '%Y%m%d').replace(tzinfo=dt_timezone.utc)
+        found.append((name, start, start + timedelta(days=1)))
+    return sorted(found, key=lambda partition: partition[1])
+
+
+def create_partitions(days_ahead=None):
+    """
+    Create the daily partitions from today until `days_ahead` days from now, so requests
+    never land in the default partition. Returns the names of the partitions created.
+    """
+    if days_ahead is None:
+        days_ahead = get_activity_log_config()['PARTITIONS_AHEAD']
+    existing = {name for name, _, _ in partitions()}
+    today = day_start(timezone.now())
+    created = []
+    for offset in range(days_ahead + 1):
+        start = today + timedelta(days=offset)
+        name = partition_name(start)
+        if name in existing:
+            continue
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f'CREATE TABLE "{name}" PARTITION OF activity_log '
+                               f"FOR VALUES FROM ('{start.isoformat()}') TO ('{(start + timedelta(days=1)).isoformat()}')")
+        except DatabaseError as e:
+            # The default partition already holds rows of that day, they are pruned from there in batches
+            logger.warning(f"Could not create the activity log partition {name}: {e}")
+            continue
+        created.append(name)
+    return created
+
+
+def add_to_rollups(rows):
+    """
+    Add aggregated request counts, dicts with hour, path, method, response_status and
+    requests, to the hourly rollups.
+    """
+    from aegis.models import RequestLogHourly
+
+    rows = list(rows)
+    if not rows:
+        return
+    hours = {row['hour'] for row in rows}
+    paths = {row['path'] for row in rows}
+    existing = {(rollup.hour,) + tuple(getattr(rollup, field) for field in ROLLUP_KEY): rollup
+                for rollup in RequestLogHourly.objects.filter(hour__in=hours, path__in=paths)}
+    changed = []
+    created = []
+    for row in rows:
+        rollup = existing.get((row['hour'],) + tuple(row[field] for field in ROLLUP_KEY))
+        if rollup is not None:
+            rollup.requests = F('requests') + row['requests']
+            changed.append(rollup)
+        else:
+            created.append(RequestLogHourly(**row))
+    RequestLogHourly.objects.bulk_update(changed, ['requests'])
+    RequestLogHourly.objects.bulk_create(created)
+
+
+def summarize(queryset):
+    return queryset.annotate(hour=TruncHour('timestamp', tzinfo=dt_timezone.utc)) \
+        .values('hour', *ROLLUP_KEY).annotate(requests=Count('id')).order_by()
+
+
+def drop_partitions(cutoff, rollup=True):
+    """
+    Summarize the partitions that end before `cutoff` into the hourly rollups and drop
+    them. Each partition is summarized and dropped in one transaction, so it is counted
+    exactly once even when a run is interrupted. Returns the number of rows dropped.
+    """
+    from aegis.models import RequestLog
+
+    dropped = 0
+    for name, start, end in partitions():
+        if end > cutoff:
+            break
+        with transaction.atomic():
+            rows = RequestLog.objects.filter(timestamp__gte=start, timestamp__lt=end)
+            count = rows.count()
+            if rollup:
+                add_to_rollups(summarize(rows))
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE "{name}"')
+        logger.info(f"Dropped the activity log partition {name} with {count} rows")
+        dropped += count
+    return dropped
+
+
+def delete_in_batches(cutoff, batch_size, pause, rollup=True):
+    """
+    Summarize and delete the rows older than `cutoff`, oldest first, `batch_size` rows
+    per transaction, so no statement holds its locks for long. Returns the number of
+    rows deleted.
+    """
+    from aegis.models import RequestLog
+
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            old = RequestLog.objects.filter(timestamp__lt=cutoff)
+            ids = list(old.order_by('timestamp').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            batch = old.filter(id__in=ids)
+            if rollup:
+                add_to_rollups(summarize(batch))
+            deleted += batch.delete()[0]
+        if len(ids) < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+def prune_activity_log(days=None, batch_size=None, pause=None, rollup=True):
+    """
+    Drop the requests older than `days` days, RETENTION_DAYS by default, after
+    summarizing them into the hourly rollups. On PostgreSQL the upcoming daily partitions
+    are created and whole old partitions are dropped; the remaining old rows, e.g. in the
+    default partition or on other backends, are deleted in batches. Returns the number
+    of rows removed.
+    """
+    config = get_activity_log_config()
+    days = config['RETENTION_DAYS'] if days is None else days
+    batch_size = batch_size or config['PRUNE_BATCH_SIZE']
+    pause = config['PRUNE_PAUSE'] if pause is None else pause
+    cutoff = day_start(timezone.now() - timedelta(days=days))
+
+    removed = 0
+    if is_partitioned():
+        create_partitions(config['PARTITIONS_AHEAD'])
+        removed += drop_partitions(cutoff, rollup)
+    removed += delete_in_batches(cutoff, batch_size, pause, rollup)
+    return removed
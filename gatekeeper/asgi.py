@@ -12,5 +12,15 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gatekeeper.settings')
+# Proxy /api/resources/ on the event loop instead of in a worker thread
+os.environ.setdefault('ASYNC_REVERSE_PROXY', 'True')
 
 application = get_asgi_application()
+
+# Probe the upstream instances and write the request log in the background of every
+# worker process, once the apps are loaded
+from gatekeeper.proxy.health import start_health_monitor  # noqa: E402
+from gatekeeper.request_log import start_request_log_writer  # noqa: E402
+
+start_health_monitor()
+start_request_log_writer()
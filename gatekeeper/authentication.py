@@ -0,0 +1,379 @@
+import copy
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+from django.db.models.signals import m2m_changed, pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from oauth2_provider.contrib.rest_framework import OAuth2Authentication
+from oauth2_provider.models import AccessToken
+from oauth2_provider.oauth2_validators import OAuth2Validator
+from rest_framework.authentication import BaseAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+
+from gatekeeper.metrics import AUTH_CACHE_REQUESTS
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_AUTH_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 10000,           # tokens of each kind kept per worker process, least recently used dropped first
+    'MAX_AGE': 300,                 # seconds a validated token is trusted before the user is loaded again
+    'VERSIONS_MAX_ENTRIES': 100000, # users whose token_version is kept per worker process
+    'VERSIONS_REFRESH_INTERVAL': 5, # seconds between two polls for changed token versions
+}
+
+TOKEN_VERSION_CLAIM = 'token_version'
+
+# Changes are polled from a little before the previous poll, covering commit delays and clock skew
+VERSIONS_POLL_OVERLAP = timedelta(seconds=5)
+
+
+def get_auth_cache_config():
+    config = dict(DEFAULT_AUTH_CACHE)
+    config.update(getattr(settings, 'AUTH_CACHE', {}))
+    return config
+
+
+def token_digest(raw_token):
+    if isinstance(raw_token, str):
+        raw_token = raw_token.encode()
+    return hashlib.sha256(raw_token).digest()
+
+
+class TokenCache:
+    """
+    LRU cache of credentials that were already checked, keyed by the token digest so the
+    tokens themselves are never kept. An entry lives until the token expires and at most
+    MAX_AGE seconds, and is dropped when its user is saved or deleted in this process, e.g.
+    when their token_version is bumped to revoke their tokens.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user_id, value, expires_at = entry
+            if time.time() >= expires_at:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, user_id, value, expires_at, config):
+        expires_at = min(expires_at, time.time() + config['MAX_AGE'])
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (user_id, value, expires_at)
+            self._users.setdefault(user_id, set()).add(key)
+            while len(self._entries) > config['MAX_ENTRIES']:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in self._users.pop(user_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._users.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._users.get(entry[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._users[entry[0]]
+
+
+jwt_cache = TokenCache()
+oauth_token_cache = TokenCache()
+# Results of gatekeeper.introspection, JWTs and OAuth2 access tokens alike
+introspection_cache = TokenCache()
+
+
+class TokenVersionMap:
+    """
+    Bounded map of user id to the current token_version of the users seen by this worker,
+    so a token carrying a revoked version is refused without loading its user. Every
+    VERSIONS_REFRESH_INTERVAL seconds one request loads the versions that changed since the
+    previous poll; saves in this worker update the map straight away.
+
+    A version read from the database is only stored when no poll ran meanwhile, so a read
+    racing a change can't overwrite the newer version the poll brought in.
+    """
+
+    def __init__(self):
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._polled_at = None
+        self._checked = 0
+        self.generation = 0
+
+    def get(self, user_id, config):
+        self.poll_if_stale(config)
+        with self._lock:
+            version = self._versions.get(user_id)
+            if version is not None:
+                self._versions.move_to_end(user_id)
+                return version
+        # First token of this user in this worker
+        generation = self.generation
+        version = get_user_model().objects.filter(pk=user_id).values_list('token_version', flat=True).first()
+        if version is not None:
+            self.seed(user_id, version, generation, config)
+        return version
+
+    def seed(self, user_id, version, generation, config):
+        with self._lock:
+            if generation == self.generation:
+                self._store(user_id, version, config)
+
+    def set(self, user_id, version, config):
+        with self._lock:
+            self._store(user_id, version, config)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._versions.pop(user_id, None)
+
+    def _store(self, user_id, version, config):
+        self._versions[user_id] = version
+        self._versions.move_to_end(user_id)
+        while len(self._versions) > config['VERSIONS_MAX_ENTRIES']:
+            self._versions.popitem(last=False)
+
+    def poll_if_stale(self, config):
+        if time.monotonic() - self._checked < config['VERSIONS_REFRESH_INTERVAL']:
+            return
+        # Requests arriving meanwhile go on with the versions they have
+        if not self._poll_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked = time.monotonic()
+            self.poll()
+        finally:
+            self._poll_lock.release()
+
+    def poll(self):
+        started = timezone.now()
+        if self._polled_at is None:
+            # Nothing was read before the first poll, so nothing can be stale yet
+            self._polled_at = started
+            return
+        try:
+            changed = list(get_user_model().objects.filter(
+                token_version_changed_at__gte=self._polled_at - VERSIONS_POLL_OVERLAP,
+            ).values_list('pk', 'token_version'))
+        except DatabaseError as e:
+            logger.error(f"Could not poll the changed token versions: {e}")
+            return
+        with self._lock:
+            self.generation += 1
+            for user_id, version in changed:
+                if user_id in self._versions and self._versions[user_id] != version:
+                    self._versions[user_id] = version
+                    jwt_cache.invalidate_user(user_id)
+                    introspection_cache.invalidate_user(user_id)
+        self._polled_at = started
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+            self.generation += 1
+        self._polled_at = None
+        self._checked = 0
+
+    def __len__(self):
+        return len(self._versions)
+
+
+token_versions = TokenVersionMap()
+
+
+def check_token_version(validated_token, config=None):
+    """
+    Refuse a token whose token_version claim is not its user's current version. Tokens
+    without the claim predate it and pass.
+    """
+    version = validated_token.get(TOKEN_VERSION_CLAIM)
+    if version is None:
+        return
+    config = config or get_auth_cache_config()
+    if token_versions.get(validated_token.get(api_settings.USER_ID_CLAIM), config) != version:
+        raise AuthenticationFailed('Token has been revoked.', code='token_revoked')
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication remembering the tokens it validated, so a client sending the same
+    token again skips the signature check and the user query.
+    """
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        config = get_auth_cache_config()
+        if not config['ENABLED']:
+            validated_token = self.get_validated_token(raw_token)
+            return self.get_user(validated_token), validated_token
+
+        key = token_digest(raw_token)
+        cached = jwt_cache.get(key)
+        if cached is not None:
+            AUTH_CACHE_REQUESTS.inc(kind='jwt', result='hit')
+            user, validated_token = cached
+            # Revoked in another worker since it was cached
+            check_token_version(validated_token, config)
+            # Each request gets its own copy, so nothing a view sets on request.user leaks into the next
+            return copy.copy(user), validated_token
+        AUTH_CACHE_REQUESTS.inc(kind='jwt', result='miss')
+        validated_token = self.get_validated_token(raw_token)
+        user = self.get_user(validated_token)
+        jwt_cache.put(key, user.pk, (copy.copy(user), validated_token), validated_token.get('exp', 0), config)
+        return user, validated_token
+
+    def get_user(self, validated_token):
+        generation = token_versions.generation
+        user = super().get_user(validated_token)
+        token_versions.seed(user.pk, user.token_version, generation, get_auth_cache_config())
+        # Tokens carrying the version they were issued for die when the user's version moves on
+        version = validated_token.get(TOKEN_VERSION_CLAIM)
+        if version is not None and version != user.token_version:
+            raise AuthenticationFailed('Token has been revoked.', code='token_revoked')
+        return user
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+    """
+    OAuth2Validator remembering the access tokens it loaded, with their application and
+    user, until they expire.
+    """
+
+    def _load_access_token(self, token):
+        config = get_auth_cache_config()
+        if not config['ENABLED']:
+            return super()._load_access_token(token)
+        key = token_digest(token)
+        access_token = oauth_token_cache.get(key)
+        if access_token is not None:
+            AUTH_CACHE_REQUESTS.inc(kind='oauth2', result='hit')
+            access_token = copy.copy(access_token)
+            if access_token.user is not None:
+                access_token.user = copy.copy(access_token.user)
+            return access_token
+        AUTH_CACHE_REQUESTS.inc(kind='oauth2', result='miss')
+        access_token = super()._load_access_token(token)
+        if access_token is not None:
+            oauth_token_cache.put(key, access_token.user_id, copy.copy(access_token),
+                                  access_token.expires.timestamp(), config)
+        return access_token
+
+
+def looks_like_jwt(raw_token):
+    # header.payload.signature, the header being base64url JSON; OAuth2 tokens have no dots
+    return raw_token.count(b'.') == 2 and raw_token.startswith(b'eyJ')
+
+
+class BearerTokenAuthentication(BaseAuthentication):
+    """
+    Sends a bearer token straight to the authentication it can belong to, going by its
+    shape: JWTs to CachedJWTAuthentication, anything else to OAuth2Authentication. Trying
+    them in turn would cost every JWT an access token query that can only miss.
+    """
+
+    def __init__(self):
+        self.jwt = CachedJWTAuthentication()
+        self.oauth2 = OAuth2Authentication()
+
+    def authenticate(self, request):
+        header = self.jwt.get_header(request)
+        raw_token = self.jwt.get_raw_token(header) if header is not None else None
+        if raw_token is not None and looks_like_jwt(raw_token):
+            return self.jwt.authenticate(request)
+        return self.oauth2.authenticate(request)
+
+    def authenticate_header(self, request):
+        return self.jwt.authenticate_header(request)
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_tokens(sender, instance, signal, update_fields=None, **kwargs):
+    if signal is post_save and (update_fields is None or 'token_version' in update_fields):
+        token_versions.set(instance.pk, instance.token_version, get_auth_cache_config())
+    else:
+        # The instance's token_version wasn't written, it may be an outdated copy
+        token_versions.discard(instance.pk)
+    jwt_cache.invalidate_user(instance.pk)
+    oauth_token_cache.invalidate_user(instance.pk)
+    introspection_cache.invalidate_user(instance.pk)
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def invalidate_cached_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    # Introspection results list the user's groups
+    if action.startswith('post_'):
+        user_ids = (pk_set or ()) if reverse else (instance.pk,)
+        if reverse and action == 'post_clear':
+            # The group's former members aren't known any more
+            introspection_cache.clear()
+        for user_id in user_ids:
+            introspection_cache.invalidate_user(user_id)
+
+
+@receiver(pre_save, sender=AccessToken)
+def invalidate_replaced_access_token(sender, instance, **kwargs):
+    # A refresh may give an existing access token a new value, the old one must go
+    if instance.pk is not None:
+        previous = AccessToken.objects.filter(pk=instance.pk).values_list('token', flat=True).first()
+        if previous:
+            oauth_token_cache.invalidate(token_digest(previous))
+            introspection_cache.invalidate(token_digest(previous))
+
+
+@receiver([post_save, post_delete], sender=AccessToken)
+def invalidate_cached_access_token(sender, instance, **kwargs):
+    # Revoked tokens are deleted
+    oauth_token_cache.invalidate(token_digest(instance.token))
+    introspection_cache.invalidate(token_digest(instance.token))
+
+
+@receiver(setting_changed)
+def reset_token_caches(setting, **kwargs):
+    if setting in ('AUTH_CACHE', 'SIMPLE_JWT', 'OAUTH2_PROVIDER', 'TOKEN_INTROSPECTION'):
+        jwt_cache.clear()
+        oauth_token_cache.clear()
+        introspection_cache.clear()
+        token_versions.clear()
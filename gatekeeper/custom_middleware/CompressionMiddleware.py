@@ -0,0 +1,52 @@
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from gatekeeper.proxy.compression import (
+    get_compression_config, choose_encoding, compress, compress_chunks, acompress_chunks
+)
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compresses responses of an allowed content type with brotli or gzip, whichever the
+    client prefers. Proxied bodies the upstream already encoded are passed through as they
+    are, as are bodies below MIN_SIZE that wouldn't gain enough to be worth the CPU.
+    """
+
+    def process_response(self, request, response):
+        config = get_compression_config()
+        if not config['ENABLED'] or response.has_header('Content-Encoding'):
+            return response
+        if response.status_code < 200 or response.status_code in (204, 304):
+            return response
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in config['CONTENT_TYPES']:
+            return response
+
+        # Whatever the outcome, the response depends on the client's Accept-Encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        coding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if coding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = acompress_chunks(response.streaming_content, coding, config)
+            else:
+                response.streaming_content = compress_chunks(response.streaming_content, coding, config)
+            del response['Content-Length']
+        else:
+            if len(response.content) < config['MIN_SIZE']:
+                return response
+            compressed = compress(response.content, coding, config)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # The compressed body is a different representation, so a strong ETag becomes weak
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = f'W/{etag}'
+        response['Content-Encoding'] = coding
+        return response
@@ -1,33 +1,118 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+import random
+
+from django.utils import timezone
+
 from aegis.models import RequestLog
+from gatekeeper.metrics import request_route
+from gatekeeper.request_log import get_request_logging_config, get_route_config, request_log_writer
+from gatekeeper.timing import GATEKEEPER_SERVICE, get_timer
+from gatekeeper.traffic import get_traffic_config, traffic_counters
+
+
+def column_limit(field):
+    return RequestLog._meta.get_field(field).max_length
+
+
+class BodyPrefixRecorder:
+    """
+    Wraps the request's input stream and keeps a copy of the first `limit` bytes read from
+    it, so the body can be logged without reading it into memory a second time.
+    """
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._limit = limit
+        self._prefix = bytearray()
+
+    def _record(self, data):
+        missing = self._limit - len(self._prefix)
+        if missing > 0 and data:
+            self._prefix += data[:missing]
+        return data
+
+    def read(self, *args, **kwargs):
+        return self._record(self._stream.read(*args, **kwargs))
+
+    def readline(self, *args, **kwargs):
+        return self._record(self._stream.readline(*args, **kwargs))
+
+    def close(self):
+        self._stream.close()
+
+    @property
+    def prefix(self):
+        return bytes(self._prefix)
 
 
 class RequestLoggingMiddleware:
+    # Supports both stacks, so an async view served through ASGI (the async reverse proxy)
+    # isn't pushed back onto a thread by this middleware.
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
-
-    def process_request(self, request):
-        # This method should log the body before any other processing consumes it
-        body = request.body.decode('utf-8') if request.body else ''
-        request.logged_body = body  # Store it on request if needed later
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        # Access the stored body
-        body = getattr(request, 'logged_body', '')
-
-        # Ensure user_agent is never None
-        user_agent = request.META.get('HTTP_USER_AGENT', 'unknown')
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
 
-        # Log request data
+        recorder = self.record_body(request)
         response = self.get_response(request)
+        self.log_request(request, response, recorder)
+        return response
 
-        RequestLog.objects.create(
-            user=request.user if request.user.is_authenticated else None,
-            ip_address=request.META.get('REMOTE_ADDR'),
-            user_agent=user_agent,
-            path=request.path,
-            query_string=request.META.get('QUERY_STRING'),
-            body=body,
-            method=request.method,
-            response_status=response.status_code
-        )
+    async def __acall__(self, request):
+        recorder = self.record_body(request)
+        response = await self.get_response(request)
+        await sync_to_async(self.log_request)(request, response, recorder)
         return response
+
+    def record_body(self, request):
+        """
+        Returns the recorder of the request's body, or None when the request isn't sampled
+        for the log. The body is recorded as the view reads it, only the first BODY_LIMIT
+        bytes of the route are kept.
+        """
+        route = get_route_config(request.path, get_request_logging_config())
+        if route['SAMPLE_RATE'] < 1 and random.random() >= route['SAMPLE_RATE']:
+            return None
+        recorder = BodyPrefixRecorder(request._stream, route['BODY_LIMIT'])
+        request._stream = recorder
+        return recorder
+
+    def log_request(self, request, response, recorder):
+        user_id = request.user.pk if request.user.is_authenticated else None
+        timer = get_timer(request)
+        # Counted for the traffic rollups whether or not the request is sampled for the log
+        if get_traffic_config()['ENABLED']:
+            traffic_counters.record(request_route(request, timer), timer.service or GATEKEEPER_SERVICE,
+                                    response.status_code, user_id, timer.elapsed())
+        if recorder is None:
+            return
+
+        # Ensure user_agent is never None
+        user_agent = request.META.get('HTTP_USER_AGENT', 'unknown')
+        # Views marked with @sensitive_post_parameters receive credentials, their bodies aren't kept
+        body = recorder.prefix.decode('utf-8', errors='replace')
+        if getattr(request, 'sensitive_post_parameters', None):
+            body = '[redacted]'
+
+        # Queued for the background writer, the response doesn't wait for the insert
+        with timer.stage('log'):
+            request_log_writer.submit({
+                'user_id': user_id,
+                # Cut to their columns, an over-long value would fail the insert of its whole batch
+                'ip_address': (request.META.get('REMOTE_ADDR') or '')[:column_limit('ip_address')],
+                'user_agent': user_agent,
+                'path': request.path[:column_limit('path')],
+                'query_string': request.META.get('QUERY_STRING'),
+                'body': body,
+                'method': request.method[:column_limit('method')],
+                'response_status': response.status_code,
+                'timestamp': timezone.now(),
+            })
@@ -0,0 +1,48 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from gatekeeper.metrics import get_metrics_config, record_request, start_query_count
+from gatekeeper.timing import RequestTimer, get_timing_config, latency_histograms
+
+
+class ServerTimingMiddleware:
+    """
+    Times each request and the stages the views and middleware below it record on
+    request._timer, adds them to the latency histograms and, when SERVER_TIMING['HEADER']
+    is on, sends them in a Server-Timing header. It also counts the request's database
+    queries and records it in the /metrics metrics. It goes first in MIDDLEWARE so its
+    total covers the whole middleware chain.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        request._timer = RequestTimer()
+        queries = start_query_count()
+        response = self.get_response(request)
+        return self.finish(request, response, queries)
+
+    async def __acall__(self, request):
+        request._timer = RequestTimer()
+        queries = start_query_count()
+        response = await self.get_response(request)
+        return self.finish(request, response, queries)
+
+    def finish(self, request, response, queries):
+        timer = request._timer
+        timer.add('total', timer.elapsed())
+        config = get_timing_config()
+        if config['HISTOGRAMS']:
+            latency_histograms.record(timer)
+        if config['HEADER']:
+            response['Server-Timing'] = timer.header()
+        if get_metrics_config()['ENABLED']:
+            record_request(request, response, timer, queries)
+        return response
@@ -0,0 +1,113 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from oauth2_provider.models import AccessToken
+from rest_framework_simplejwt.exceptions import TokenBackendError
+from rest_framework_simplejwt.settings import api_settings
+
+from gatekeeper import jwt_keys
+from gatekeeper.authentication import TOKEN_VERSION_CLAIM, introspection_cache, looks_like_jwt, token_digest
+from gatekeeper.metrics import AUTH_CACHE_REQUESTS
+
+DEFAULT_TOKEN_INTROSPECTION = {
+    'MAX_TOKENS': 100,              # tokens one request may introspect
+    'MAX_ENTRIES': 10000,           # results kept per worker process, least recently used dropped first
+    'MAX_AGE': 30,                  # seconds a result is served from the cache, and callers may memoize it
+    'GROUP': 'token_introspection',  # users of this group may introspect, besides staff and client credentials
+}
+
+INACTIVE = {'active': False}
+
+
+def get_introspection_config():
+    config = dict(DEFAULT_TOKEN_INTROSPECTION)
+    config.update(getattr(settings, 'TOKEN_INTROSPECTION', {}))
+    return config
+
+
+def describe(user, token_version, exp):
+    return {
+        'active': True,
+        'user_id': user.pk,
+        'token_version': token_version,
+        'groups': sorted(group.name for group in user.groups.all()),
+        'exp': int(exp),
+    }
+
+
+def introspect_jwts(pending):
+    """
+    Results of the JWTs whose signature and expiry checked out, their users loaded in one query.
+    """
+    user_ids = {payload.get(api_settings.USER_ID_CLAIM) for payload in pending.values()}
+    users = get_user_model().objects.filter(pk__in=user_ids - {None}, is_active=True).prefetch_related('groups')
+    users = {user.pk: user for user in users}
+    results = {}
+    for token, payload in pending.items():
+        user = users.get(payload.get(api_settings.USER_ID_CLAIM))
+        version = payload.get(TOKEN_VERSION_CLAIM, user.token_version if user is not None else None)
+        if user is None or version != user.token_version:
+            results[token] = (INACTIVE, None)
+        else:
+            results[token] = (describe(user, version, payload['exp']), user.pk)
+    return results
+
+
+def introspect_access_tokens(pending):
+    """
+    Results of OAuth2 access tokens, loaded with their users in one query.
+    """
+    access_tokens = AccessToken.objects.filter(token__in=pending).select_related('user') \
+        .prefetch_related('user__groups')
+    access_tokens = {access_token.token: access_token for access_token in access_tokens}
+    results = {}
+    for token in pending:
+        access_token = access_tokens.get(token)
+        user = access_token.user if access_token is not None else None
+        if user is None or not user.is_active or not access_token.is_valid():
+            results[token] = (INACTIVE, None)
+        else:
+            results[token] = (describe(user, user.token_version, access_token.expires.timestamp()), user.pk)
+    return results
+
+
+def introspect(tokens, config=None):
+    """
+    Introspect a batch of JWTs and OAuth2 access tokens. Returns a result per token, in
+    order, and for how many seconds the results may be memoized: until the first of them
+    expires and at most MAX_AGE seconds.
+    """
+    config = config or get_introspection_config()
+    now = time.time()
+    found = {}
+    pending_jwts = {}
+    pending_access_tokens = set()
+    for token in set(tokens):
+        cached = introspection_cache.get(token_digest(token))
+        if cached is not None:
+            AUTH_CACHE_REQUESTS.inc(kind='introspection', result='hit')
+            found[token] = cached
+            continue
+        AUTH_CACHE_REQUESTS.inc(kind='introspection', result='miss')
+        if looks_like_jwt(token.encode()):
+            try:
+                pending_jwts[token] = jwt_keys.token_backend.decode(token)
+            except TokenBackendError:
+                found[token] = (INACTIVE, now + config['MAX_AGE'])
+                introspection_cache.put(token_digest(token), None, found[token], now + config['MAX_AGE'], config)
+        else:
+            pending_access_tokens.add(token)
+
+    loaded = {}
+    if pending_jwts:
+        loaded.update(introspect_jwts(pending_jwts))
+    if pending_access_tokens:
+        loaded.update(introspect_access_tokens(pending_access_tokens))
+    for token, (result, user_id) in loaded.items():
+        expires_at = min(result.get('exp', now + config['MAX_AGE']), now + config['MAX_AGE'])
+        found[token] = (result, expires_at)
+        introspection_cache.put(token_digest(token), user_id, found[token], expires_at, config)
+
+    max_age = min((expires_at for _, expires_at in found.values()), default=now + config['MAX_AGE']) - now
+    return [found[token][0] for token in tokens], max(int(max_age), 0)
@@ -0,0 +1,322 @@
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+from rest_framework_simplejwt.backends import TokenBackend
+from rest_framework_simplejwt.exceptions import TokenBackendError
+from rest_framework_simplejwt.settings import api_settings
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_JWT_SIGNING = {
+    'ALGORITHM': 'RS256',           # RS256 or EdDSA key pairs; HS256 keeps signing with the shared JWT_SIGNING_KEY
+    'RSA_KEY_SIZE': 2048,
+    'ROTATE_AFTER': 30 * 86400,     # seconds a key signs before rotate_signing_keys replaces it
+    'PUBLISH_AHEAD': 3600,          # seconds a new key is in the JWKS before it signs, keep it above JWKS_MAX_AGE
+    'JWKS_MAX_AGE': 900,            # seconds verifiers may cache /.well-known/jwks.json
+    'REFRESH_INTERVAL': 60,         # seconds between two loads of the keys from the database
+    'ACCEPT_HS256': True,           # still accept tokens without a key ID signed with JWT_SIGNING_KEY
+}
+
+KEY_ALGORITHMS = ('RS256', 'EdDSA')
+
+# A token naming an unknown key reloads the keys, but not more often than this
+UNKNOWN_KID_REFRESH = 5
+
+SigningKey = namedtuple('SigningKey', ['kid', 'algorithm', 'active_from', 'retired_at', 'private_key', 'public_key'])
+
+
+def get_jwt_signing_config():
+    config = dict(DEFAULT_JWT_SIGNING)
+    config.update(getattr(settings, 'JWT_SIGNING', {}))
+    return config
+
+
+def verification_grace():
+    """
+    How long a retired key keeps verifying: the longest lifetime of a token it may have signed.
+    """
+    from gatekeeper.views.AuthV import JWT_EXPIRATION
+
+    leeway = api_settings.LEEWAY
+    if not isinstance(leeway, timedelta):
+        leeway = timedelta(seconds=leeway or 0)
+    return max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME, JWT_EXPIRATION) + leeway
+
+
+def _passphrase():
+    secret = settings.JWT_SIGNING_KEY
+    return secret.encode() if secret else None
+
+
+def public_jwk(algorithm, public_key):
+    if algorithm == 'EdDSA':
+        return OKPAlgorithm.to_jwk(public_key, as_dict=True)
+    return RSAAlgorithm.to_jwk(public_key, as_dict=True)
+
+
+def thumbprint(jwk):
+    """
+    RFC 7638 thumbprint of a public JWK, used as its key ID.
+    """
+    required = ('crv', 'kty', 'x') if jwk['kty'] == 'OKP' else ('e', 'kty', 'n')
+    canonical = json.dumps({name: jwk[name] for name in required}, separators=(',', ':'), sort_keys=True)
+    return base64.urlsafe_b64encode(hashlib.sha256(canonical.encode()).digest()).rstrip(b'=').decode()
+
+
+def create_signing_key(algorithm, active_from, config=None):
+    """
+    Generate a key pair and store it, the private key encrypted with JWT_SIGNING_KEY.
+    """
+    from aegis.models import JWTSigningKey
+
+    config = config or get_jwt_signing_config()
+    if algorithm not in KEY_ALGORITHMS:
+        raise ValueError(f"Cannot generate {algorithm} signing keys, use one of {', '.join(KEY_ALGORITHMS)}")
+    if algorithm == 'EdDSA':
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=config['RSA_KEY_SIZE'])
+    passphrase = _passphrase()
+    encryption = serialization.BestAvailableEncryption(passphrase) if passphrase else serialization.NoEncryption()
+    return JWTSigningKey.objects.create(
+        kid=thumbprint(public_jwk(algorithm, private_key.public_key())),
+        algorithm=algorithm,
+        private_key=private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, encryption).decode(),
+        public_key=private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode(),
+        active_from=active_from,
+    )
+
+
+def rotate_signing_keys(force=False, config=None):
+    """
+    Add a key that is published now and starts signing PUBLISH_AHEAD seconds later, when the
+    current keys retire; they keep verifying until the tokens they signed have expired.
+    Rotates when the newest key is older than ROTATE_AFTER or of another algorithm than
+    ALGORITHM, or always when forced. Keys past their verification window are deleted.
+    Returns the new key, or None.
+    """
+    from aegis.models import JWTSigningKey
+
+    config = config or get_jwt_signing_config()
+    now = timezone.now()
+    deleted = JWTSigningKey.objects.filter(retired_at__lt=now - verification_grace()).delete()[0]
+    if deleted:
+        logger.info(f"Deleted {deleted} expired JWT signing keys")
+    if config['ALGORITHM'] not in KEY_ALGORITHMS:
+        return None
+
+    with transaction.atomic():
+        newest = JWTSigningKey.objects.select_for_update().filter(retired_at__isnull=True).first()
+        if not force and newest is not None and newest.algorithm == config['ALGORITHM'] \
+                and newest.active_from > now - timedelta(seconds=config['ROTATE_AFTER']):
+            return None
+        # The first key has no predecessor to overlap with and signs straight away
+        active_from = now + timedelta(seconds=config['PUBLISH_AHEAD']) if newest is not None else now
+        key = create_signing_key(config['ALGORITHM'], active_from, config)
+        JWTSigningKey.objects.filter(retired_at__isnull=True).exclude(pk=key.pk).update(retired_at=active_from)
+    logger.info(f"Added JWT signing key {key.kid} ({key.algorithm}), signing from {active_from.isoformat()}")
+    return key
+
+
+class KeyRing:
+    """
+    The JWT signing keys of this worker, loaded from the database at most every
+    REFRESH_INTERVAL seconds: the published ones, including the next key before it signs
+    and retired keys until the tokens they signed have expired, with the private keys of
+    those that still sign decrypted once.
+    """
+
+    def __init__(self):
+        self._keys = None
+        self._jwks = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def keys(self):
+        if self._keys is None or time.monotonic() - self._loaded >= get_jwt_signing_config()['REFRESH_INTERVAL']:
+            self.refresh(blocking=False)
+        return self._keys
+
+    def refresh(self, blocking=True):
+        # Requests arriving during a reload keep using the loaded keys
+        if not self._lock.acquire(blocking=blocking or self._keys is None):
+            return
+        try:
+            self._load()
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        from aegis.models import JWTSigningKey
+
+        config = get_jwt_signing_config()
+        now = timezone.now()
+        try:
+            rows = list(JWTSigningKey.objects.filter(
+                Q(retired_at__isnull=True) | Q(retired_at__gt=now - verification_grace())))
+            if config['ALGORITHM'] in KEY_ALGORITHMS and not any(row.retired_at is None for row in rows):
+                rotate_signing_keys(force=True, config=config)
+                rows = list(JWTSigningKey.objects.filter(
+                    Q(retired_at__isnull=True) | Q(retired_at__gt=now - verification_grace())))
+        except DatabaseError as e:
+            logger.error(f"Could not load the JWT signing keys, keeping the current ones: {e}")
+            self._loaded = time.monotonic()
+            if self._keys is None:
+                self._keys, self._jwks = {}, {'keys': []}
+            return
+
+        previous = self._keys or {}
+        keys = {}
+        for row in rows:
+            known = previous.get(row.kid)
+            if known is not None and (known.active_from, known.retired_at) == (row.active_from, row.retired_at):
+                keys[row.kid] = known
+                continue
+            private_key = None
+            if row.retired_at is None or row.retired_at > now:
+                try:
+                    private_key = serialization.load_pem_private_key(row.private_key.encode(), _passphrase())
+                except (TypeError, ValueError) as e:
+                    # e.g. JWT_SIGNING_KEY changed, the key still verifies
+                    logger.error(f"Could not decrypt JWT signing key {row.kid}: {e}")
+            keys[row.kid] = SigningKey(row.kid, row.algorithm, row.active_from, row.retired_at, private_key,
+                                       serialization.load_pem_public_key(row.public_key.encode()))
+        self._keys = keys
+        self._jwks = {'keys': [
+            {**public_jwk(key.algorithm, key.public_key), 'kid': key.kid, 'alg': key.algorithm, 'use': 'sig'}
+            for key in sorted(keys.values(), key=lambda key: key.active_from, reverse=True)
+        ]}
+        self._loaded = time.monotonic()
+
+    def signing_key(self):
+        keys = self.keys()
+        now = timezone.now()
+        candidates = [key for key in keys.values()
+                      if key.private_key is not None and key.active_from <= now
+                      and (key.retired_at is None or key.retired_at > now)]
+        if not candidates:
+            raise TokenBackendError(_('No JWT signing key is available'))
+        return max(candidates, key=lambda key: key.active_from)
+
+    def verifying_key(self, kid):
+        key = self.keys().get(kid)
+        if key is None and time.monotonic() - self._loaded >= UNKNOWN_KID_REFRESH:
+            # Possibly added by another worker since the last load
+            self.refresh(blocking=False)
+            key = self._keys.get(kid)
+        return key
+
+    def jwks(self):
+        self.keys()
+        return self._jwks
+
+    def reset(self):
+        self._keys = None
+        self._jwks = None
+        self._loaded = 0
+
+
+key_ring = KeyRing()
+
+
+def encode_token(payload, json_encoder=None):
+    """
+    Sign a JWT with the current key, naming it in the `kid` header so verifiers can pick it
+    from the JWKS. With ALGORITHM HS256 the shared JWT_SIGNING_KEY signs instead.
+    """
+    if get_jwt_signing_config()['ALGORITHM'] not in KEY_ALGORITHMS:
+        return jwt.encode(payload, settings.JWT_SIGNING_KEY, algorithm='HS256', json_encoder=json_encoder)
+    key = key_ring.signing_key()
+    return jwt.encode(payload, key.private_key, algorithm=key.algorithm, headers={'kid': key.kid},
+                      json_encoder=json_encoder)
+
+
+class KeyRingTokenBackend(TokenBackend):
+    """
+    simplejwt token backend signing with the key ring and verifying a token with the key
+    its `kid` header names, in that key's algorithm. Tokens without a key ID are checked
+    against SIMPLE_JWT's HS256 key while ACCEPT_HS256 is set.
+    """
+
+    def __init__(self):
+        super().__init__(api_settings.ALGORITHM, api_settings.SIGNING_KEY, api_settings.VERIFYING_KEY,
+                         api_settings.AUDIENCE, api_settings.ISSUER, api_settings.JWK_URL, api_settings.LEEWAY,
+                         api_settings.JSON_ENCODER)
+
+    def encode(self, payload):
+        jwt_payload = payload.copy()
+        if self.audience is not None:
+            jwt_payload['aud'] = self.audience
+        if self.issuer is not None:
+            jwt_payload['iss'] = self.issuer
+        return encode_token(jwt_payload, json_encoder=self.json_encoder)
+
+    def decode(self, token, verify=True):
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+        except jwt.InvalidTokenError as ex:
+            raise TokenBackendError(_('Token is invalid or expired')) from ex
+        if kid is None:
+            if not get_jwt_signing_config()['ACCEPT_HS256']:
+                raise TokenBackendError(_('Token is invalid or expired'))
+            return super().decode(token, verify)
+
+        key = key_ring.verifying_key(kid)
+        if key is None:
+            raise TokenBackendError(_('Token is invalid or expired'))
+        try:
+            return jwt.decode(
+                token,
+                key.public_key,
+                algorithms=[key.algorithm],
+                audience=self.audience,
+                issuer=self.issuer,
+                leeway=self.get_leeway(),
+                options={
+                    'verify_aud': self.audience is not None,
+                    'verify_signature': verify,
+                },
+            )
+        except jwt.InvalidAlgorithmError as ex:
+            raise TokenBackendError(_('Invalid algorithm specified')) from ex
+        except jwt.InvalidTokenError as ex:
+            raise TokenBackendError(_('Token is invalid or expired')) from ex
+
+
+token_backend = KeyRingTokenBackend()
+
+
+def install_token_backend():
+    # Token.get_token_backend() reads this class attribute, every simplejwt token class included
+    from rest_framework_simplejwt.tokens import Token
+
+    Token._token_backend = token_backend
+
+
+@receiver(setting_changed)
+def reset_key_ring(setting, **kwargs):
+    global token_backend
+    if setting in ('JWT_SIGNING', 'JWT_SIGNING_KEY', 'SIMPLE_JWT'):
+        key_ring.reset()
+        if setting == 'SIMPLE_JWT':
+            token_backend = KeyRingTokenBackend()
+            install_token_backend()
@@ -0,0 +1,453 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+DEFAULT_METRICS = {
+    'ENABLED': True,
+    'MULTIPROCESS_DIR': None,       # directory shared by the worker processes, None when running a single process
+    'TOKEN': None,                  # bearer token required to read /metrics, None to leave it open
+}
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+_config = None
+
+
+def get_metrics_config():
+    # Read on every update, so it's merged once and reset when the setting changes
+    global _config
+    if _config is None:
+        config = dict(DEFAULT_METRICS)
+        config.update(getattr(settings, 'METRICS', {}))
+        _config = config
+    return _config
+
+
+class LocalValues:
+    """
+    Sample values of a single process, kept in one array of doubles. The dict only maps a
+    sample key to its slot in the array.
+    """
+
+    def __init__(self):
+        self._slots = {}
+        self._keys = []
+        self._values = array('d')
+
+    def slot(self, key):
+        self._slots[key] = len(self._values)
+        self._keys.append(key)
+        self._values.append(0.0)
+        return self._slots[key]
+
+    def get(self, slot):
+        return self._values[slot]
+
+    def put(self, slot, value):
+        self._values[slot] = value
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def close(self):
+        pass
+
+
+class MmapValues:
+    """
+    Sample values of one worker process, in a memory mapped file of the multiprocess
+    directory so the process serving /metrics can read every worker's values.
+
+    The file starts with the number of bytes used, followed by entries of a key length, the
+    key padded to 8 bytes and a double. A new entry is written before the used length is
+    moved past it, so a reader never sees half an entry. Each file has a single writer.
+    """
+
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._slots = {}
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(self.INITIAL_SIZE)
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._used = struct.unpack_from('i', self._map, 0)[0] or 8
+        for key, value, offset in read_entries(self._map, self._used):
+            self._slots[key] = offset
+
+    def slot(self, key):
+        # A restarted worker may get the pid, and so the file, of an earlier one
+        if key in self._slots:
+            return self._slots[key]
+        encoded = key.encode()
+        padded = len(encoded) + (8 - (len(encoded) + 4) % 8) % 8
+        size = 4 + padded + 8
+        while self._used + size > self._capacity:
+            self._grow()
+        struct.pack_into(f'i{padded}sd', self._map, self._used, len(encoded), encoded, 0.0)
+        offset = self._used + 4 + padded
+        self._used += size
+        struct.pack_into('i', self._map, 0, self._used)
+        self._slots[key] = offset
+        return offset
+
+    def get(self, slot):
+        return struct.unpack_from('d', self._map, slot)[0]
+
+    def put(self, slot, value):
+        struct.pack_into('d', self._map, slot, value)
+
+    def items(self):
+        return [(key, value) for key, value, offset in read_entries(self._map, self._used)]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _grow(self):
+        self._capacity *= 2
+        self._map.close()
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+
+def read_entries(buffer, used):
+    position = 8
+    while position < used:
+        length = struct.unpack_from('i', buffer, position)[0]
+        padded = length + (8 - (length + 4) % 8) % 8
+        key = bytes(buffer[position + 4:position + 4 + length]).decode()
+        offset = position + 4 + padded
+        yield key, struct.unpack_from('d', buffer, offset)[0], offset
+        position = offset + 8
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class MetricsStore:
+    """
+    The sample values of this process, in memory or, with MULTIPROCESS_DIR set, in this
+    process' file of that directory. Updates take one short lock around the array write;
+    slots are found with a plain dict lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._values = None
+        self._pid = None
+
+    def _store(self):
+        # Worker processes forked after the first update get values of their own
+        if self._values is None or self._pid != os.getpid():
+            directory = get_metrics_config()['MULTIPROCESS_DIR']
+            self._pid = os.getpid()
+            self._slots = {}
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                self._values = MmapValues(os.path.join(directory, f'metrics_{self._pid}.db'))
+            else:
+                self._values = LocalValues()
+        return self._values
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            name, suffix, labels = key
+            slot = self._slots[key] = self._values.slot(json.dumps([name, suffix, labels]))
+        return slot
+
+    def inc(self, key, amount):
+        with self._lock:
+            values = self._store()
+            slot = self._slot(key)
+            values.put(slot, values.get(slot) + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            values = self._store()
+            values.put(self._slot(key), value)
+
+    def samples(self):
+        """
+        Yield (pid, name, suffix, labels, value) of this process or, in multiprocess mode,
+        of every file of the directory.
+        """
+        directory = get_metrics_config()['MULTIPROCESS_DIR']
+        if not directory:
+            with self._lock:
+                items = list(self._store().items())
+            for key, value in items:
+                name, suffix, labels = json.loads(key)
+                yield os.getpid(), name, suffix, tuple(map(tuple, labels)), value
+            return
+        for path in glob.glob(os.path.join(directory, 'metrics_*.db')):
+            pid = int(os.path.basename(path)[len('metrics_'):-len('.db')])
+            with open(path, 'rb') as file:
+                data = file.read()
+            if len(data) < 8:
+                continue
+            for key, value, offset in read_entries(data, struct.unpack_from('i', data, 0)[0]):
+                name, suffix, labels = json.loads(key)
+                yield pid, name, suffix, tuple(map(tuple, labels)), value
+
+    def reset(self):
+        with self._lock:
+            if self._values is not None:
+                self._values.close()
+            self._values = None
+            self._slots = {}
+
+
+store = MetricsStore()
+REGISTRY = {}
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), mode='sum'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # How a gauge of several processes is aggregated: 'sum' or 'max' over live processes
+        self.mode = mode
+        REGISTRY[name] = self
+
+    def _labels(self, labels):
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if get_metrics_config()['ENABLED']:
+            store.inc((self.name, '_total', self._labels(labels)), amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if get_metrics_config()['ENABLED']:
+            store.set((self.name, '', self._labels(labels)), value)
+
+    def inc(self, amount=1, **labels):
+        if get_metrics_config()['ENABLED']:
+            store.inc((self.name, '', self._labels(labels)), amount)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not get_metrics_config()['ENABLED']:
+            return
+        labels = self._labels(labels)
+        # Buckets are stored as plain counts and made cumulative when rendered
+        bound = next((bound for bound in self.buckets if value <= bound), '+Inf')
+        store.inc((self.name, '_bucket', labels + (('le', str(bound)),)), 1)
+        store.inc((self.name, '_sum', labels), value)
+        store.inc((self.name, '_count', labels), 1)
+
+
+# Collectors called when /metrics is rendered, for state only the serving process has
+COLLECTORS = []
+
+
+def register_collector(collector):
+    """
+    Register a function returning [(metric, value, labels)] read at scrape time.
+    """
+    COLLECTORS.append(collector)
+    return collector
+
+
+REQUESTS = Counter('gatekeeper_requests', 'Requests served, by route, method and status.',
+                   ('route', 'method', 'status'))
+REQUEST_DURATION = Histogram('gatekeeper_request_duration_seconds', 'Request latency by route.', ('route',))
+STAGE_DURATION = Histogram('gatekeeper_stage_duration_seconds', 'Latency of each request stage by upstream service.',
+                           ('service', 'stage'))
+UPSTREAM_RESPONSES = Counter('gatekeeper_upstream_responses', 'Upstream responses by service and status code.',
+                             ('service', 'status'))
+CACHE_REQUESTS = Counter('gatekeeper_proxy_cache_requests', 'Proxied GETs by cache result.', ('result',))
+CACHE_ENTRIES = Gauge('gatekeeper_proxy_cache_entries', 'Entries in the proxy response caches.')
+CACHE_BYTES = Gauge('gatekeeper_proxy_cache_bytes', 'Body bytes held by the proxy response caches.')
+BREAKER_STATE = Gauge('gatekeeper_circuit_breaker_state', 'Circuit breaker state: 0 closed, 1 half open, 2 open.',
+                      ('service',), mode='max')
+AUTH_CACHE_REQUESTS = Counter('gatekeeper_auth_cache_requests',
+                              'Token lookups by credential kind or introspection, and cache result.',
+                              ('kind', 'result'))
+DB_QUERIES = Histogram('gatekeeper_db_queries_per_request', 'Database queries run by one request, by route.',
+                       ('route',), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+UPSTREAM_HEALTHY = Gauge('gatekeeper_upstream_instance_healthy', 'Whether the health probes pass on an upstream instance.',
+                         ('service', 'instance'), mode='max')
+REQUEST_LOG_BACKLOG = Gauge('gatekeeper_request_log_backlog', 'Request log records queued for the background writer.')
+REQUEST_LOG_WRITTEN = Counter('gatekeeper_request_log_written', 'Request log records written to the database.')
+REQUEST_LOG_DROPPED = Counter('gatekeeper_request_log_dropped',
+                              'Request log records dropped: overflow, sampled out or failed to write.', ('reason',))
+WAITRESS_THREADS = Gauge('gatekeeper_waitress_threads', 'Waitress worker threads.')
+WAITRESS_BUSY = Gauge('gatekeeper_waitress_threads_busy', 'Waitress worker threads serving a request.')
+WAITRESS_QUEUE = Gauge('gatekeeper_waitress_queue_depth', 'Requests waiting for a free waitress thread.')
+
+
+# Database queries of the current request, counted by a wrapper on every connection
+_query_count = ContextVar('gatekeeper_query_count', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def start_query_count():
+    # Connections opened before this module was imported missed connection_created
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+    counter = [0]
+    _query_count.set(counter)
+    return counter
+
+
+def request_route(request, timer):
+    return timer.route or getattr(getattr(request, 'resolver_match', None), 'url_name', None) or 'unmatched'
+
+
+def record_request(request, response, timer, queries):
+    route = request_route(request, timer)
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    REQUEST_DURATION.observe(timer.stages.get('total', 0), route=route)
+    service = timer.service or 'gatekeeper'
+    for stage, duration in timer.stages.items():
+        STAGE_DURATION.observe(duration, service=service, stage=stage)
+    DB_QUERIES.observe(queries[0], route=route)
+    if response.has_header('X-Cache'):
+        CACHE_REQUESTS.inc(result=response['X-Cache'].lower())
+
+
+def watch_waitress(task_dispatcher):
+    """
+    Report the thread usage of the waitress server serving the gatekeeper.
+    """
+    @register_collector
+    def waitress_threads():
+        return [
+            (WAITRESS_THREADS, len(task_dispatcher.threads), {}),
+            (WAITRESS_BUSY, task_dispatcher.active_count, {}),
+            (WAITRESS_QUEUE, len(task_dispatcher.queue), {}),
+        ]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _aggregate():
+    """
+    Merge the samples of all processes: counters and histograms add up over every process
+    that ever wrote them, gauges only over live processes ('sum') or take the highest ('max').
+    """
+    totals = {}
+    alive = {}
+    for pid, name, suffix, labels, value in store.samples():
+        metric = REGISTRY.get(name)
+        if metric is None:
+            continue
+        key = (name, suffix, labels)
+        if metric.kind == 'gauge':
+            if pid not in alive:
+                alive[pid] = _pid_alive(pid)
+            if not alive[pid]:
+                continue
+            if metric.mode == 'max':
+                totals[key] = max(totals.get(key, value), value)
+                continue
+        totals[key] = totals.get(key, 0) + value
+    for collector in COLLECTORS:
+        for metric, value, labels in collector():
+            totals[(metric.name, '', metric._labels(labels))] = value
+    return totals
+
+
+def render():
+    """
+    The metrics in the Prometheus text exposition format.
+    """
+    totals = _aggregate()
+    lines = []
+    for name, metric in REGISTRY.items():
+        samples = sorted((key, value) for key, value in totals.items() if key[0] == name)
+        if not samples:
+            continue
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        if metric.kind != 'histogram':
+            for (_, suffix, labels), value in samples:
+                lines.append(f'{name}{suffix}{_format_labels(labels)} {value}')
+            continue
+        series = {}
+        for (_, suffix, labels), value in samples:
+            if suffix == '_bucket':
+                bound = dict(labels)['le']
+                labels = tuple(label for label in labels if label[0] != 'le')
+                series.setdefault(labels, {}).setdefault('buckets', {})[bound] = value
+            else:
+                series.setdefault(labels, {})[suffix] = value
+        for labels, values in sorted(series.items()):
+            cumulative = 0.0
+            counts = values.get('buckets', {})
+            for bound in [str(bound) for bound in metric.buckets] + ['+Inf']:
+                cumulative += counts.get(bound, 0)
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {values.get("_sum", 0)}')
+            lines.append(f'{name}_count{_format_labels(labels)} {values.get("_count", 0)}')
+    return '\n'.join(lines) + '\n'
+
+
+@receiver(setting_changed)
+def reset_metrics_store(setting, **kwargs):
+    global _config
+    if setting == 'METRICS':
+        _config = None
+        store.reset()
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import threading
+import time
+from http import cookiejar
+
+import httpx
+
+from gatekeeper.proxy.upstream import get_pool_config
+
+logger = logging.getLogger('aegis')
+
+
+class ConnectTrace:
+    """
+    httpx trace extension adding up the time a request spends opening a new connection
+    (TCP connect and TLS handshake), which httpx doesn't report apart from the time to
+    first byte.
+    """
+
+    STEPS = ('connection.connect_tcp.', 'connection.start_tls.')
+
+    def __init__(self):
+        self.duration = 0
+        self._started = None
+
+    async def __call__(self, event, info):
+        if not event.startswith(self.STEPS):
+            return
+        if event.endswith('.started'):
+            self._started = time.perf_counter()
+        elif self._started is not None:
+            self.duration += time.perf_counter() - self._started
+            self._started = None
+
+
+class AsyncUpstreamClientPool:
+    """
+    Async counterpart of UpstreamSessionPool: one httpx.AsyncClient per service and event
+    loop, sized and timed out from the same UPSTREAM_POOL configuration, shared by every
+    request handled on that loop.
+    """
+
+    def __init__(self, transport=None):
+        self.transport = transport
+        # loop -> {service: client}, a client's connections belong to the loop that opened them.
+        # Loops are held until a new loop closes their clients, a weak reference would
+        # drop a closed loop's clients without closing them.
+        self._clients = {}
+        self._closing = set()
+        self._lock = threading.Lock()
+
+    def get_client(self, service_name):
+        loop = asyncio.get_running_loop()
+        clients = self._clients.get(loop)
+        client = clients.get(service_name) if clients is not None else None
+        if client is None:
+            with self._lock:
+                if loop not in self._clients:
+                    self._close_stale(loop)
+                    self._clients[loop] = {}
+                clients = self._clients[loop]
+                client = clients.get(service_name)
+                if client is None:
+                    client = clients[service_name] = self._build_client(service_name)
+        return client
+
+    def _close_stale(self, loop):
+        # The clients of loops that have been closed would keep their connections open, so
+        # they are closed from the new loop. Clients of loops still running are left alone.
+        for stale in [other for other in self._clients if other.is_closed()]:
+            for client in self._clients.pop(stale).values():
+                task = loop.create_task(self._aclose(client))
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+
+    async def _aclose(self, client):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Could not close the async upstream client of a closed loop: {e}")
+
+    async def aclose_all(self):
+        """
+        Close the clients of the running loop.
+        """
+        with self._lock:
+            clients = self._clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+    def _build_client(self, service_name):
+        config = get_pool_config(service_name)
+        limits = httpx.Limits(
+            max_connections=config['POOL_MAXSIZE'] if config['POOL_BLOCK'] else None,
+            max_keepalive_connections=config['POOL_MAXSIZE'] if config['KEEP_ALIVE'] else 0,
+        )
+        timeout = httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT'])
+        client = httpx.AsyncClient(limits=limits, timeout=timeout, transport=self.transport)
+        # Same as the sync sessions: the client is shared by every user of this worker, so it
+        # must never keep cookies set by the upstream.
+        client.cookies.jar.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        logger.info(f"Created async upstream client for service: {service_name}")
+        return client
+
+
+async_upstream_pool = AsyncUpstreamClientPool()
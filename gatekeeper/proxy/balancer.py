@@ -0,0 +1,212 @@
+import itertools
+import logging
+import random
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from gatekeeper.proxy.conf import get_service_config, service_instances
+from gatekeeper.proxy.health import health_registry
+from gatekeeper.proxy.registry import get_services, registry_changed
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_LOAD_BALANCER = {
+    'POLICY': 'round_robin',        # a name from POLICIES or the dotted path of a policy function
+    'EJECT_AFTER': 5,               # consecutive failures that eject an instance
+    'EJECT_DURATION': 30,           # seconds of the first ejection, doubled on every ejection in a row
+    'MAX_EJECT_DURATION': 300,
+    'MAX_EJECTED_PERCENT': 50,      # never eject more than this share of a service's instances
+    'LATENCY_DECAY': 0.2,           # weight of the latest call in the moving average latency
+}
+
+
+def get_balancer_config(service_name):
+    return get_service_config(service_name, DEFAULT_LOAD_BALANCER, 'LOAD_BALANCER', 'load_balancer')
+
+
+class UpstreamInstance:
+    """
+    One upstream instance of a service, with its in-flight count, latency and ejection state.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.ejections = 0
+        self.ejected_until = None
+
+    def ejected(self, now):
+        return self.ejected_until is not None and now < self.ejected_until
+
+    def snapshot(self, now):
+        return {
+            'url': self.url,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'failures': self.failures,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'ejected': self.ejected(now),
+            'ejections': self.ejections,
+        }
+
+
+def round_robin(balancer, candidates):
+    return candidates[next(balancer.counter) % len(candidates)]
+
+
+def least_outstanding(balancer, candidates):
+    fewest = min(instance.in_flight for instance in candidates)
+    return random.choice([instance for instance in candidates if instance.in_flight == fewest])
+
+
+def power_of_two(balancer, candidates):
+    # Least loaded of two random instances, ties broken by the lower moving average latency
+    if len(candidates) == 1:
+        return candidates[0]
+    first, second = random.sample(candidates, 2)
+    return min(first, second, key=lambda instance: (instance.in_flight, instance.latency or 0))
+
+
+POLICIES = {
+    'round_robin': round_robin,
+    'least_outstanding': least_outstanding,
+    'power_of_two': power_of_two,
+}
+
+
+class ServiceBalancer:
+    """
+    Spreads a service's requests over its instances with the configured policy.
+
+    Instances are ejected passively: after EJECT_AFTER consecutive failed calls an instance
+    is skipped for EJECT_DURATION seconds (doubled when it fails again right after being
+    re-admitted), then re-admitted on its next pick. Instances the health prober marked
+    unhealthy are skipped as well. When every instance is ejected, all of them are used
+    again rather than refusing the request.
+    """
+
+    def __init__(self, service_name, urls, config):
+        self.service_name = service_name
+        self.config = config
+        self.instances = [UpstreamInstance(url) for url in urls]
+        policy = config['POLICY']
+        self.policy = POLICIES[policy] if policy in POLICIES else import_string(policy)
+        self.counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=None):
+        """
+        Pick an instance for a call and count it as in flight; exclude is an instance to
+        avoid if another one is available, e.g. the one a retried call just failed on.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [instance for instance in self.instances if not instance.ejected(now)
+                          and not health_registry.unhealthy(self.service_name, instance.url)] or self.instances
+            if exclude is not None and len(candidates) > 1:
+                candidates = [instance for instance in candidates if instance is not exclude]
+            instance = self.policy(self, candidates)
+            instance.in_flight += 1
+            instance.requests += 1
+            return instance
+
+    def healthy(self):
+        """
+        False when the health prober marked every instance of the service unhealthy.
+        """
+        return not self.instances or not all(
+            health_registry.unhealthy(self.service_name, instance.url) for instance in self.instances)
+
+    def release(self, instance, success, duration):
+        with self._lock:
+            instance.in_flight -= 1
+            decay = self.config['LATENCY_DECAY']
+            instance.latency = duration if instance.latency is None else \
+                decay * duration + (1 - decay) * instance.latency
+            if success:
+                instance.consecutive_failures = 0
+                if not instance.ejected(time.monotonic()):
+                    instance.ejections = 0
+                return
+            instance.failures += 1
+            instance.consecutive_failures += 1
+            if instance.consecutive_failures >= self.config['EJECT_AFTER']:
+                self._eject(instance)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'service': self.service_name,
+                'policy': self.config['POLICY'],
+                'instances': [
+                    dict(instance.snapshot(now), healthy=not health_registry.unhealthy(self.service_name, instance.url))
+                    for instance in self.instances
+                ],
+            }
+
+    def _eject(self, instance):
+        now = time.monotonic()
+        if len(self.instances) < 2 or instance.ejected(now):
+            return
+        ejected = sum(1 for other in self.instances if other.ejected(now))
+        if (ejected + 1) * 100 > self.config['MAX_EJECTED_PERCENT'] * len(self.instances):
+            return
+        duration = min(self.config['MAX_EJECT_DURATION'], self.config['EJECT_DURATION'] * 2 ** instance.ejections)
+        instance.ejections += 1
+        instance.consecutive_failures = 0
+        instance.ejected_until = now + duration
+        logger.warning(f"Ejected {instance.url} of {self.service_name} for {duration}s")
+
+
+class LoadBalancers:
+    """
+    The ServiceBalancer of every service of the service registry, created on first use.
+    """
+
+    def __init__(self):
+        self._balancers = {}
+        self._lock = threading.Lock()
+
+    def get(self, service_name):
+        balancer = self._balancers.get(service_name)
+        if balancer is None:
+            with self._lock:
+                balancer = self._balancers.get(service_name)
+                if balancer is None:
+                    balancer = self._balancers[service_name] = ServiceBalancer(
+                        service_name,
+                        service_instances(get_services().get(service_name, {})),
+                        get_balancer_config(service_name),
+                    )
+        return balancer
+
+    def snapshot(self):
+        return [balancer.snapshot() for balancer in list(self._balancers.values())]
+
+    def reset(self):
+        with self._lock:
+            self._balancers = {}
+
+
+load_balancers = LoadBalancers()
+
+
+@receiver(setting_changed)
+def reset_load_balancers(setting, **kwargs):
+    if setting in ('AVAILABLE_SERVICES', 'LOAD_BALANCER'):
+        load_balancers.reset()
+
+
+@receiver(registry_changed)
+def reload_load_balancers(snapshot, **kwargs):
+    # Instances may have been added or removed
+    load_balancers.reset()
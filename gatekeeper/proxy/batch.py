@@ -0,0 +1,179 @@
+import base64
+import io
+import json
+
+from django.conf import settings
+from django.http import HttpRequest, QueryDict
+
+from gatekeeper.proxy.upstream import HOP_BY_HOP_HEADERS
+
+DEFAULT_PROXY_BATCH = {
+    'MAX_REQUESTS': 20,             # sub-requests accepted in one batch
+    'MAX_CONCURRENCY': 10,          # sub-requests sent upstream at the same time
+    'MAX_BODY_SIZE': 1024 * 1024,   # bytes of a sub-response body returned, larger ones fail with 502
+}
+
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+# Sub-response headers returned with each item
+BATCH_RESPONSE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'X-Cache', 'Retry-After')
+
+# Batch request headers that describe the batch itself, not its sub-requests
+BATCH_OWN_HEADERS = ('CONTENT_TYPE', 'CONTENT_LENGTH', 'HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH',
+                     'HTTP_IF_MODIFIED_SINCE')
+
+
+# Headers a sub-request may not set: the client address and credentials are the batch
+# request's own, so the rate limits and authentication of the batch apply to every item
+BATCH_FORBIDDEN_HEADERS = HOP_BY_HOP_HEADERS | frozenset([
+    'authorization',
+    'cookie',
+    'host',
+    'forwarded',
+    'x-real-ip',
+])
+
+
+class BatchError(ValueError):
+    pass
+
+
+def get_batch_config():
+    config = dict(DEFAULT_PROXY_BATCH)
+    config.update(getattr(settings, 'PROXY_BATCH', {}))
+    return config
+
+
+def parse_batch(body):
+    """
+    Validate a batch request body and return (items, stream). Each item has an id, a
+    method, a path below /api/resources/ and optionally a query dict, extra headers and a
+    JSON body.
+    """
+    try:
+        payload = json.loads(body or b'{}')
+    except ValueError:
+        raise BatchError('The batch body must be JSON.')
+    items = payload.get('requests') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        raise BatchError("'requests' must be a non empty list.")
+    if len(items) > get_batch_config()['MAX_REQUESTS']:
+        raise BatchError(f"A batch holds at most {get_batch_config()['MAX_REQUESTS']} requests.")
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            raise BatchError(f"Request {index} needs a 'path'.")
+        method = str(item.get('method', 'GET')).upper()
+        if method not in BATCH_METHODS:
+            raise BatchError(f"Request {index} has an unsupported method {method}.")
+        headers = item.get('headers') or {}
+        if not isinstance(headers, dict):
+            raise BatchError(f"Request {index} has headers that aren't an object.")
+        for header in headers:
+            # Django reads X_Forwarded_For the same as X-Forwarded-For
+            name = str(header).lower().replace('_', '-')
+            if name in BATCH_FORBIDDEN_HEADERS or name.startswith('x-forwarded-'):
+                raise BatchError(f"Request {index} may not set the {header} header.")
+        parsed.append({
+            'id': item.get('id', index),
+            'method': method,
+            'path': item['path'].lstrip('/'),
+            'query': item.get('query') or {},
+            'headers': headers,
+            'body': item.get('body'),
+        })
+    return parsed, bool(payload.get('stream'))
+
+
+def sub_request(request, item):
+    """
+    A request for one batch item, carrying the batch request's authenticated user and
+    credentials so the item is proxied like a request of its own.
+    """
+    path, _, query_string = item['path'].partition('?')
+    sub = HttpRequest()
+    sub.method = item['method']
+    sub.path = sub.path_info = f"/api/resources/{path}"
+    sub.META = {key: value for key, value in request.META.items() if key not in BATCH_OWN_HEADERS}
+    for header, value in item['headers'].items():
+        sub.META['HTTP_' + header.upper().replace('-', '_')] = str(value)
+
+    query = QueryDict(query_string, mutable=True)
+    for key, value in item['query'].items():
+        query.setlist(key, [str(v) for v in value] if isinstance(value, list) else [str(value)])
+    sub.GET = query
+    sub.META['QUERY_STRING'] = query.urlencode()
+
+    body = b'' if item['body'] is None else json.dumps(item['body']).encode()
+    if body:
+        sub.META['CONTENT_TYPE'] = 'application/json'
+        sub.META['CONTENT_LENGTH'] = str(len(body))
+    sub._stream = io.BytesIO(body)
+    sub._read_started = False
+
+    sub.user = request.user
+    sub.auth = getattr(request, 'auth', None)
+    return sub, path
+
+
+def item_result(item, response, body):
+    """
+    The batch response entry of a sub-response: JSON bodies are embedded as JSON, other
+    text as a string and binary bodies base64 encoded.
+    """
+    result = {
+        'id': item['id'],
+        'status': response.status_code,
+        'headers': {header: response[header] for header in BATCH_RESPONSE_HEADERS if response.has_header(header)},
+    }
+    content_type = response.get('Content-Type', '')
+    if not body:
+        result['body'] = None
+    elif 'json' in content_type:
+        try:
+            result['body'] = json.loads(body)
+        except ValueError:
+            result['body'] = body.decode('utf-8', errors='replace')
+    else:
+        try:
+            result['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            result['body'] = base64.b64encode(body).decode()
+            result['encoding'] = 'base64'
+    return result
+
+
+def error_result(item, status, message):
+    return {'id': item['id'], 'status': status, 'headers': {}, 'body': {'error': message}}
+
+
+def response_body(response, limit):
+    """
+    The complete body of a sub-response, or None when it is larger than limit.
+    """
+    if not response.streaming:
+        return response.content if len(response.content) <= limit else None
+    body = bytearray()
+    try:
+        for chunk in response.streaming_content:
+            body += chunk
+            if len(body) > limit:
+                return None
+    finally:
+        response.close()
+    return bytes(body)
+
+
+async def aresponse_body(response, limit):
+    if not response.streaming:
+        return response.content if len(response.content) <= limit else None
+    body = bytearray()
+    try:
+        async for chunk in response.streaming_content:
+            body += chunk
+            if len(body) > limit:
+                return None
+    finally:
+        response.close()
+    return bytes(body)
@@ -0,0 +1,245 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_http_date_safe
+
+from gatekeeper.metrics import CACHE_ENTRIES, CACHE_BYTES
+
+DEFAULT_PROXY_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 1000,
+    'MAX_SIZE': 64 * 1024 * 1024,       # total bytes of cached bodies
+    'MAX_ENTRY_SIZE': 1024 * 1024,      # larger bodies are never cached
+    'DEFAULT_TTL': 0,                   # freshness when the upstream sends no caching headers
+    'SCOPE': 'user',                    # 'user': one entry per user, 'shared': one entry for everyone
+    'TTL': None,                        # per entity override of the upstream freshness, in seconds
+}
+
+# Response headers kept with a cached entry and replayed when it is served; Retry-After
+# so a 503 shared with coalesced requests still tells their clients when to retry
+CACHED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires', 'Vary', 'Content-Encoding', 'Retry-After')
+
+# Client conditional headers, answered by the proxy from its own copy of the response
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+CacheEntry = namedtuple('CacheEntry', ['status', 'content_type', 'body', 'headers', 'expires_at', 'size'])
+
+
+def get_cache_policy(entity):
+    """
+    Cache policy for a route: PROXY_CACHE overridden by the entity's entry in
+    REVERSE_PROXY_CACHE.
+    """
+    policy = dict(DEFAULT_PROXY_CACHE)
+    policy.update(getattr(settings, 'PROXY_CACHE', {}))
+    policy.update(getattr(settings, 'REVERSE_PROXY_CACHE', {}).get(entity) or {})
+    return policy
+
+
+def canonical_query(query_dict):
+    """
+    Query string with keys and values sorted, so parameter order doesn't split cache entries.
+    """
+    return urlencode(sorted((key, value) for key, values in query_dict.lists() for value in values))
+
+
+def cache_key(service_name, path, query_dict, scope, accept='', accept_encoding=''):
+    """
+    Canonical key of a proxied GET, shared by the response cache and request coalescing.
+    Accept-Encoding is part of it since encoded upstream bodies are kept as they are.
+    """
+    return service_name, path, canonical_query(query_dict), scope, accept, accept_encoding
+
+
+def request_scope(request, policy):
+    """
+    The authorization scope part of the cache key: empty for shared entries, the user id
+    otherwise, so one user's resources are never served to another.
+    """
+    if policy['SCOPE'] == 'shared':
+        return ''
+    return f'user:{request.user.pk}'
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def freshness_lifetime(headers, policy):
+    """
+    Seconds a response may be served from the cache without revalidation, or None if it
+    must not be cached at all.
+    """
+    cache_control = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in cache_control:
+        return None
+    if 'private' in cache_control and policy['SCOPE'] == 'shared':
+        return None
+    vary = {header.strip().lower() for header in headers.get('Vary', '').split(',') if header.strip()}
+    if vary - {'accept-encoding', 'authorization'} or ('authorization' in vary and policy['SCOPE'] == 'shared'):
+        return None
+
+    if policy['TTL'] is not None:
+        return policy['TTL']
+    if 'no-cache' in cache_control:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cache_control:
+            try:
+                return max(0, int(cache_control[directive]))
+            except ValueError:
+                return 0
+    expires = parse_http_date_safe(headers.get('Expires', ''))
+    if expires is not None:
+        return max(0, int(expires - time.time()))
+    return policy['DEFAULT_TTL']
+
+
+class ProxyResponseCache:
+    """
+    In-process LRU cache of proxied GET responses, bounded by entry count and total body
+    size. Entries past their freshness lifetime are kept while they have an ETag, so the
+    proxy can revalidate them with If-None-Match instead of fetching the body again.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """
+        Return (entry, fresh) for the key; entry is None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(key)
+            if entry.expires_at > time.monotonic():
+                self.hits += 1
+                return entry, True
+            if not entry.headers.get('ETag'):
+                self._remove(key)
+                self._publish_size()
+                self.misses += 1
+                return None, False
+            return entry, False
+
+    def store(self, key, response, policy):
+        """
+        Cache a proxied response if it is a complete 200 the upstream allows caching.
+        """
+        if response.status_code != 200 or response.streaming:
+            return
+        lifetime = freshness_lifetime(response, policy)
+        if lifetime is None or (lifetime <= 0 and not response.get('ETag')):
+            return
+        if len(response.content) > policy['MAX_ENTRY_SIZE']:
+            return
+        entry = snapshot_response(response, lifetime)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            self.stores += 1
+            while len(self._entries) > policy['MAX_ENTRIES'] or self._size > policy['MAX_SIZE']:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._publish_size()
+
+    def revalidated(self, key, entry, headers, policy):
+        """
+        Refresh a stale entry after the upstream answered 304 Not Modified.
+        """
+        lifetime = freshness_lifetime(headers, policy)
+        if lifetime is None:
+            with self._lock:
+                self._remove(key)
+            return entry
+        entry = entry._replace(expires_at=time.monotonic() + lifetime)
+        with self._lock:
+            self.revalidations += 1
+            if key in self._entries:
+                self._entries[key] = entry
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._publish_size()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
+
+    def _publish_size(self):
+        CACHE_ENTRIES.set(len(self._entries))
+        CACHE_BYTES.set(self._size)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+
+def snapshot_response(response, lifetime=0):
+    """
+    CacheEntry holding a copy of a buffered response, or None for a streaming one.
+    """
+    if response.streaming:
+        return None
+    return CacheEntry(
+        status=response.status_code,
+        content_type=response['Content-Type'],
+        body=response.content,
+        headers={header: response[header] for header in CACHED_HEADERS if response.has_header(header)},
+        expires_at=time.monotonic() + lifetime,
+        size=len(response.content),
+    )
+
+
+def cached_response(request, entry, cache_status):
+    """
+    Build the client response for a cache entry, answering 304 when the client already has
+    the same ETag.
+    """
+    # If-None-Match uses the weak comparison, the client may hold the W/ ETag of a
+    # compressed copy
+    etag = entry.headers.get('ETag', '').removeprefix('W/')
+    client_etags = [tag.strip().removeprefix('W/') for tag in request.headers.get('If-None-Match', '').split(',')]
+    if etag and etag in client_etags:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(entry.body, status=entry.status, content_type=entry.content_type)
+    for header, value in entry.headers.items():
+        response[header] = value
+    response['X-Cache'] = cache_status
+    return response
+
+
+proxy_cache = ProxyResponseCache()
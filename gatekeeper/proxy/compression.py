@@ -0,0 +1,109 @@
+import gzip
+import zlib
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses are only gzipped without it
+    brotli = None
+
+DEFAULT_RESPONSE_COMPRESSION = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,               # smaller bodies are sent as they are
+    'CONTENT_TYPES': ('application/json', 'application/ld+json', 'application/problem+json'),
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 4,            # brotli's higher qualities cost too much CPU per response
+}
+
+
+def get_compression_config():
+    config = dict(DEFAULT_RESPONSE_COMPRESSION)
+    config.update(getattr(settings, 'RESPONSE_COMPRESSION', {}))
+    return config
+
+
+def parse_accept_encoding(value):
+    """
+    Map each coding of an Accept-Encoding header to its q-value.
+    """
+    codings = {}
+    for item in (value or '').split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, argument = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(argument)
+                except ValueError:
+                    quality = 0.0
+        codings[coding.lower()] = quality
+    return codings
+
+
+def accepts_encoding(accept_encoding, coding):
+    """
+    Whether a client sending this Accept-Encoding header can decode the coding.
+    """
+    codings = parse_accept_encoding(accept_encoding)
+    quality = codings.get(coding.lower(), codings.get('*', 0.0))
+    return quality > 0
+
+
+def choose_encoding(accept_encoding):
+    """
+    The coding to compress a response with for the client, brotli first when it is
+    installed, or None when the client accepts neither.
+    """
+    codings = parse_accept_encoding(accept_encoding)
+    available = (['br'] if brotli is not None else []) + ['gzip']
+    accepted = [coding for coding in available if codings.get(coding, codings.get('*', 0.0)) > 0]
+    if not accepted:
+        return None
+    # The client's preference decides, ties go to the better compression
+    return max(accepted, key=lambda coding: codings.get(coding, codings.get('*', 0.0)))
+
+
+def compress(data, coding, config):
+    if coding == 'br':
+        return brotli.compress(data, quality=config['BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=config['GZIP_LEVEL'], mtime=0)
+
+
+def compress_chunks(chunks, coding, config):
+    compressor = _compressor(coding, config)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def acompress_chunks(chunks, coding, config):
+    compressor = _compressor(coding, config)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def _compressor(coding, config):
+    if coding == 'br':
+        return _BrotliCompressor(config['BROTLI_QUALITY'])
+    # wbits 31 writes the gzip header and trailer around the deflate stream
+    return zlib.compressobj(config['GZIP_LEVEL'], zlib.DEFLATED, 31)
@@ -0,0 +1,27 @@
+from django.conf import settings
+
+from gatekeeper.proxy.registry import get_services
+
+
+def get_service_config(service_name, defaults, setting_name, service_key):
+    """
+    Merge a proxy feature's configuration for one service: the module defaults, overridden
+    by the project wide settings dict, overridden by the service's own entry in the
+    service registry.
+    """
+    config = dict(defaults)
+    config.update(getattr(settings, setting_name, {}))
+    config.update(get_services().get(service_name, {}).get(service_key) or {})
+    return config
+
+
+def service_instances(service):
+    """
+    Base URLs of a service's upstream instances: its 'api' entry may be one URL or a list.
+    """
+    api = service.get('api')
+    if not api:
+        return []
+    if isinstance(api, str):
+        return [api]
+    return list(api)
@@ -0,0 +1,227 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.http import JsonResponse
+
+from gatekeeper.metrics import UPSTREAM_HEALTHY
+from gatekeeper.proxy.conf import get_service_config, service_instances
+from gatekeeper.proxy.registry import service_registry
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_HEALTH_CHECK = {
+    'ENABLED': True,                # probe the service's instances
+    'PATH': 'health',               # probed path, relative to each instance's base URL
+    'INTERVAL': 10,                 # seconds between two probe rounds of the background prober
+    'TIMEOUT': 2,                   # seconds a probe may take before it counts as failed
+    'HEALTHY_AFTER': 2,             # consecutive passed probes that mark an unhealthy instance healthy again
+    'UNHEALTHY_AFTER': 3,           # consecutive failed probes that mark an instance unhealthy
+    'WINDOW': 20,                   # probes kept per instance for the success rate and latency
+    'MAX_CONCURRENCY': 16,          # probes sent at the same time
+}
+
+
+def get_health_check_config():
+    config = dict(DEFAULT_HEALTH_CHECK)
+    config.update(getattr(settings, 'HEALTH_CHECK', {}))
+    return config
+
+
+def get_health_config(service_name):
+    return get_service_config(service_name, DEFAULT_HEALTH_CHECK, 'HEALTH_CHECK', 'health_check')
+
+
+class InstanceHealth:
+    """
+    Rolling probe results of one upstream instance. An instance is healthy until
+    UNHEALTHY_AFTER probes in a row failed, and then unhealthy until HEALTHY_AFTER probes in
+    a row passed, so a single lost probe doesn't flap it.
+    """
+
+    def __init__(self, service_name, url, window):
+        self.service_name = service_name
+        self.url = url
+        self.healthy = True
+        self.consecutive_successes = 0
+        self.consecutive_failures = 0
+        self.probes = deque(maxlen=window)
+        self.last_checked = None
+        self.last_status = None
+        self.last_error = None
+
+    def record(self, result, config):
+        self.probes.append((result['healthy'], result['latency']))
+        self.last_checked = time.time()
+        self.last_status = result['status']
+        self.last_error = result['error']
+        if result['healthy']:
+            self.consecutive_successes += 1
+            self.consecutive_failures = 0
+            if not self.healthy and self.consecutive_successes >= config['HEALTHY_AFTER']:
+                self.healthy = True
+                logger.info(f"{self.service_name} instance {self.url} is healthy again")
+        else:
+            self.consecutive_failures += 1
+            self.consecutive_successes = 0
+            if self.healthy and self.consecutive_failures >= config['UNHEALTHY_AFTER']:
+                self.healthy = False
+                logger.warning(f"{self.service_name} instance {self.url} is unhealthy: "
+                               f"{result['error'] or result['status']}")
+
+    def snapshot(self):
+        latencies = sorted(latency for healthy, latency in self.probes if latency is not None)
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'success_rate': round(sum(1 for healthy, _ in self.probes if healthy) / len(self.probes), 3)
+            if self.probes else None,
+            'latency_ms': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+            'max_latency_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+            'probes': len(self.probes),
+            'last_checked': self.last_checked,
+            'last_status': self.last_status,
+            'last_error': self.last_error,
+        }
+
+
+class HealthRegistry:
+    """
+    Health of every probed instance in this worker process, read by the load balancers.
+    """
+
+    def __init__(self):
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def record(self, result):
+        config = get_health_config(result['service'])
+        with self._lock:
+            key = (result['service'], result['url'])
+            health = self._instances.get(key)
+            if health is None:
+                health = self._instances[key] = InstanceHealth(result['service'], result['url'], config['WINDOW'])
+            health.record(result, config)
+        UPSTREAM_HEALTHY.set(1 if health.healthy else 0, service=result['service'], instance=result['url'])
+
+    def unhealthy(self, service_name, url):
+        # Instances never probed count as healthy
+        health = self._instances.get((service_name, url))
+        return health is not None and not health.healthy
+
+    def snapshot(self):
+        with self._lock:
+            services = {}
+            for (service_name, url), health in sorted(self._instances.items()):
+                services.setdefault(service_name, []).append(health.snapshot())
+            return services
+
+    def reset(self):
+        with self._lock:
+            self._instances = {}
+
+
+health_registry = HealthRegistry()
+
+
+def probe(service_name, url, config):
+    """
+    Probe one instance; any answer below 500 within TIMEOUT passes.
+    """
+    target = urljoin(url if url.endswith('/') else url + '/', config['PATH'])
+    started = time.monotonic()
+    try:
+        response = requests.get(target, timeout=config['TIMEOUT'], allow_redirects=False)
+        response.close()
+    except requests.exceptions.RequestException as e:
+        return {'service': service_name, 'url': url, 'healthy': False, 'status': None,
+                'latency': None, 'error': f"{type(e).__name__}: {e}"}
+    return {'service': service_name, 'url': url, 'healthy': response.status_code < 500,
+            'status': response.status_code, 'latency': time.monotonic() - started, 'error': None}
+
+
+def probe_all(services=None):
+    """
+    Probe every instance of every service concurrently, record the results in the health
+    registry and return them in service order.
+    """
+    if services is None:
+        services = service_registry.current().services
+    targets = []
+    for service_name, service in services.items():
+        config = get_health_config(service_name)
+        if config['ENABLED']:
+            targets.extend((service_name, url, config) for url in service_instances(service))
+    if not targets:
+        return []
+    concurrency = min(get_health_check_config()['MAX_CONCURRENCY'], len(targets))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda target: probe(*target), targets))
+    for result in results:
+        health_registry.record(result)
+    return results
+
+
+class HealthMonitor:
+    """
+    Background thread of a worker process running a probe round every INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def start(self):
+        # A forked worker doesn't inherit the thread, so it starts its own
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='upstream-health-prober', daemon=True)
+        self._thread.start()
+        logger.info("Started the upstream health prober")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                service_registry.refresh_if_stale()
+                probe_all()
+            except Exception as e:
+                logger.error(f"Upstream health probe round failed: {e}")
+            finally:
+                close_old_connections()
+            self._stop.wait(get_health_check_config()['INTERVAL'])
+
+
+health_monitor = HealthMonitor()
+
+
+def start_health_monitor():
+    if get_health_check_config()['ENABLED']:
+        health_monitor.start()
+
+
+def unhealthy_response(service_name):
+    retry_after = get_health_config(service_name)['INTERVAL']
+    response = JsonResponse({'error': f'{service_name} is currently unavailable.'}, status=503)
+    response['Retry-After'] = str(int(retry_after))
+    return response
+
+
+@receiver(setting_changed)
+def reset_health_registry(setting, **kwargs):
+    if setting in ('HEALTH_CHECK', 'AVAILABLE_SERVICES'):
+        health_registry.reset()
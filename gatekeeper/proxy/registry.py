@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError
+from django.dispatch import receiver, Signal
+
+from gatekeeper.proxy.routing import RouteIndex
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_SERVICE_REGISTRY = {
+    'ENABLED': True,                # merge the services and routes registered in the admin into the settings ones
+    'REFRESH_INTERVAL': 5,          # seconds between two checks of the registry version
+}
+
+# Sent with the new snapshot when a worker swaps in a changed registry
+registry_changed = Signal()
+
+RegistrySnapshot = namedtuple('RegistrySnapshot', ['version', 'services', 'mapping', 'route_index'])
+
+
+def get_registry_config():
+    config = dict(DEFAULT_SERVICE_REGISTRY)
+    config.update(getattr(settings, 'SERVICE_REGISTRY', {}))
+    return config
+
+
+def build_snapshot(version, services, mapping):
+    """
+    An immutable snapshot of the services and routes with its route index compiled.
+    """
+    services = MappingProxyType({name: MappingProxyType(dict(service)) for name, service in services.items()})
+    mapping = MappingProxyType(dict(mapping))
+    return RegistrySnapshot(version, services, mapping, RouteIndex(mapping, services))
+
+
+def load_registered(services, mapping):
+    """
+    Merge the active RegisteredService and ServiceRoute rows into copies of the settings'
+    services and mapping. A registered service replaces the settings entry of the same
+    name, a deactivated one withdraws it and its routes.
+    """
+    from aegis.models import RegisteredService, ServiceRoute
+
+    services = dict(services)
+    mapping = dict(mapping)
+    for service in RegisteredService.objects.all():
+        if not service.status:
+            services.pop(service.name, None)
+            continue
+        services[service.name] = {
+            **(service.options or {}),
+            'api': service.api_urls(),
+            'post_auth': service.post_auth or None,
+        }
+    for entity, service_name in ServiceRoute.objects.filter(status=True, service__status=True).values_list(
+            'entity', 'service__name'):
+        mapping[entity] = service_name
+    mapping = {entity: service_name for entity, service_name in mapping.items() if service_name in services}
+    return services, mapping
+
+
+class ServiceRegistry:
+    """
+    The services and reverse proxy routes of this worker: settings.AVAILABLE_SERVICES and
+    settings.REVERSE_PROXY_MAPPING, merged with the ones registered in the admin.
+
+    Requests read the current snapshot without touching the database. At most every
+    REFRESH_INTERVAL seconds one request compares the registry version row with the
+    snapshot's, and only when it changed are the rows loaded and the new snapshot swapped
+    in as a whole.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            # Until the first refresh, or when the registry is disabled, the settings alone
+            snapshot = self._snapshot = build_snapshot(
+                None, settings.AVAILABLE_SERVICES, settings.REVERSE_PROXY_MAPPING)
+        return snapshot
+
+    def stale(self):
+        config = get_registry_config()
+        # A failed load waits for the interval too, retrying on every request would pile onto a failing database
+        return config['ENABLED'] and (
+            self._checked is None or time.monotonic() - self._checked >= config['REFRESH_INTERVAL'])
+
+    def refresh_if_stale(self):
+        if not self.stale():
+            return self.current()
+        # Requests arriving meanwhile keep the current snapshot instead of checking too
+        if not self._lock.acquire(blocking=False):
+            return self.current()
+        try:
+            self._checked = time.monotonic()
+            return self.refresh()
+        finally:
+            self._lock.release()
+
+    async def arefresh_if_stale(self):
+        if not self.stale():
+            return self.current()
+        return await sync_to_async(self.refresh_if_stale)()
+
+    def refresh(self):
+        from aegis.models import ServiceRegistryVersion
+
+        current = self.current()
+        try:
+            version = ServiceRegistryVersion.current()
+            if version == current.version:
+                return current
+            services, mapping = load_registered(settings.AVAILABLE_SERVICES, settings.REVERSE_PROXY_MAPPING)
+        except DatabaseError as e:
+            logger.error(f"Could not load the service registry, keeping the current routes: {e}")
+            return current
+        snapshot = build_snapshot(version, services, mapping)
+        self._snapshot = snapshot
+        if current.version is not None:
+            logger.info(f"Service registry changed to version {version}")
+        if current.services != snapshot.services:
+            registry_changed.send(sender=self.__class__, snapshot=snapshot)
+        return snapshot
+
+    def reset(self):
+        self._snapshot = None
+        self._checked = None
+
+
+service_registry = ServiceRegistry()
+
+
+def get_services():
+    return service_registry.current().services
+
+
+def get_route_index():
+    return service_registry.current().route_index
+
+
+@receiver(setting_changed)
+def reset_service_registry(setting, **kwargs):
+    if setting in ('REVERSE_PROXY_MAPPING', 'AVAILABLE_SERVICES', 'SERVICE_REGISTRY'):
+        service_registry.reset()
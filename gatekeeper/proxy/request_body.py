@@ -0,0 +1,111 @@
+import tempfile
+
+from django.conf import settings
+from rest_framework.parsers import BaseParser, DataAndFiles
+
+from gatekeeper.proxy.conf import get_service_config
+
+DEFAULT_PROXY_REQUEST_BODY = {
+    'STREAM': False,                # stream large bodies straight to the upstream instead of spooling them
+    'MEMORY_LIMIT': 1024 * 1024,    # bodies up to this many bytes are read into memory
+    'CHUNK_SIZE': 64 * 1024,        # bytes copied from the client per read
+}
+
+
+def get_request_body_config(service_name):
+    return get_service_config(service_name, DEFAULT_PROXY_REQUEST_BODY, 'PROXY_REQUEST_BODY', 'request_body')
+
+
+class PassthroughParser(BaseParser):
+    """
+    Accepts any content type without reading the stream, so authentication classes that look
+    at request.POST (OAuth2Authentication does) don't consume the body the proxy forwards.
+    """
+    media_type = '*/*'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return DataAndFiles({}, {})
+
+
+class RequestBodyStream:
+    """
+    File-like view over the unread request body. It reports the declared length so requests
+    sends it upstream with a Content-Length, reading it in blocks rather than all at once.
+    """
+
+    def __init__(self, request, length):
+        self._request = request
+        self._length = length
+        self._position = 0
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        remaining = self._length - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self._request.read(size) if size else b''
+        self._position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def _content_length(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def prepare_request_body(request, service_name):
+    """
+    The body to forward upstream for this request.
+
+    Bodies up to MEMORY_LIMIT bytes are read into memory. Larger bodies are copied in
+    CHUNK_SIZE blocks into a temporary file that spills to disk past MEMORY_LIMIT, or, for
+    services configured with STREAM, forwarded directly from the client connection. Either
+    way no more than MEMORY_LIMIT bytes of the body are held in memory. The caller must
+    close the returned body once the upstream call is done.
+    """
+    config = get_request_body_config(service_name)
+    length = _content_length(request)
+    if length <= config['MEMORY_LIMIT']:
+        return request.read() if length else b''
+    if config['STREAM']:
+        return RequestBodyStream(request, length)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=config['MEMORY_LIMIT'], dir=settings.FILE_UPLOAD_TEMP_DIR)
+    while True:
+        chunk = request.read(config['CHUNK_SIZE'])
+        if not chunk:
+            break
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+async def _aiter_request_body(request, chunk_size):
+    while True:
+        chunk = request.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def prepare_async_request_body(request, service_name):
+    """
+    The body to forward upstream from the async proxy. The ASGI handler has already spooled
+    the incoming body, so large bodies are passed to httpx as an async iterator of
+    CHUNK_SIZE blocks and sent with the client's Content-Length.
+    """
+    config = get_request_body_config(service_name)
+    length = _content_length(request)
+    if length <= config['MEMORY_LIMIT']:
+        return request.read() if length else b''
+    return _aiter_request_body(request, config['CHUNK_SIZE'])
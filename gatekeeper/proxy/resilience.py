@@ -0,0 +1,303 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from django.core.cache import caches
+from django.http import JsonResponse
+
+from gatekeeper.metrics import BREAKER_STATE
+from gatekeeper.proxy.conf import get_service_config
+
+logger = logging.getLogger('aegis')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Value of each state in the circuit breaker state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+DEFAULT_CIRCUIT_BREAKER = {
+    'WINDOW': 30,                   # seconds of outcomes the error and slow call rates are computed over
+    'BUCKETS': 10,                  # the window is kept as this many rolling counters
+    'MIN_CALLS': 10,                # calls needed in the window before the breaker may open
+    'ERROR_RATE': 0.5,              # failed call ratio that opens the breaker
+    'SLOW_CALL_DURATION': 5.0,      # seconds after which a call counts as slow
+    'SLOW_CALL_RATE': 0.8,          # slow call ratio that opens the breaker
+    'OPEN_DURATION': 30,            # seconds to fail fast before letting trial calls through
+    'HALF_OPEN_CALLS': 1,           # concurrent trial calls allowed while half open
+    'STATE_TTL': 3600,              # seconds a worker's published state is kept in the shared cache
+}
+
+DEFAULT_UPSTREAM_RETRY = {
+    'MAX_RETRIES': 2,
+    'BACKOFF_BASE': 0.1,            # seconds, doubled on every attempt
+    'BACKOFF_MAX': 2.0,
+    'BUDGET_RATIO': 0.2,            # retries may add at most this share of calls on top of the traffic
+    'BUDGET_MIN_PER_SECOND': 1,     # retries always allowed at this rate, so low traffic can still retry
+    'RETRY_STATUSES': (502, 503, 504),
+}
+
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+# The worker pids that published a state for a service, and the state of each of them
+BREAKER_STATE_CACHE_KEY = 'proxy:circuit_breakers:{service}'
+BREAKER_WORKER_CACHE_KEY = 'proxy:circuit_breakers:{service}:{pid}'
+
+
+def get_breaker_config(service_name):
+    return get_service_config(service_name, DEFAULT_CIRCUIT_BREAKER, 'CIRCUIT_BREAKER', 'circuit_breaker')
+
+
+def get_retry_config(service_name):
+    return get_service_config(service_name, DEFAULT_UPSTREAM_RETRY, 'UPSTREAM_RETRY', 'retry')
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open circuit breaker for one upstream service.
+
+    Outcomes are counted in rolling time buckets. While closed, the breaker opens when the
+    window holds at least MIN_CALLS calls and either the failure or the slow call ratio
+    reaches its threshold. While open every call fails fast, until OPEN_DURATION has passed
+    and HALF_OPEN_CALLS trial calls are let through: a successful trial closes the breaker,
+    a failed one opens it again.
+    """
+
+    def __init__(self, service_name, config):
+        self.service_name = service_name
+        self.config = config
+        self.state = CLOSED
+        self.opened_at = None
+        self._bucket_width = config['WINDOW'] / config['BUCKETS']
+        self._buckets = {}
+        self._trial_calls = 0
+        self._lock = threading.Lock()
+        self._publisher = None
+
+    def allow_request(self):
+        changed = None
+        try:
+            with self._lock:
+                if self.state == OPEN:
+                    if time.monotonic() - self.opened_at < self.config['OPEN_DURATION']:
+                        return False
+                    changed = self._transition(HALF_OPEN)
+                if self.state == HALF_OPEN:
+                    if self._trial_calls >= self.config['HALF_OPEN_CALLS']:
+                        return False
+                    self._trial_calls += 1
+                return True
+        finally:
+            self._publish(changed)
+
+    def record(self, success, duration):
+        slow = duration >= self.config['SLOW_CALL_DURATION']
+        changed = None
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_calls = max(0, self._trial_calls - 1)
+                changed = self._transition(CLOSED if success and not slow else OPEN)
+            else:
+                calls, failures, slow_calls = self._current_bucket()
+                self._buckets[self._bucket_index()] = [calls + 1, failures + (not success), slow_calls + slow]
+                if self.state == CLOSED:
+                    calls, failures, slow_calls = self._window_totals()
+                    if calls >= self.config['MIN_CALLS'] and (
+                            failures / calls >= self.config['ERROR_RATE']
+                            or slow_calls / calls >= self.config['SLOW_CALL_RATE']):
+                        changed = self._transition(OPEN)
+        self._publish(changed)
+
+    def retry_after(self):
+        if self.state != OPEN:
+            return 0
+        return max(0, int(self.config['OPEN_DURATION'] - (time.monotonic() - self.opened_at)) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            calls, failures, slow_calls = self._window_totals()
+            return {
+                'service': self.service_name,
+                'state': self.state,
+                'calls': calls,
+                'failures': failures,
+                'slow_calls': slow_calls,
+                'retry_after': self.retry_after(),
+            }
+
+    def _bucket_index(self):
+        return int(time.monotonic() // self._bucket_width)
+
+    def _current_bucket(self):
+        return self._buckets.get(self._bucket_index(), [0, 0, 0])
+
+    def _window_totals(self):
+        oldest = self._bucket_index() - self.config['BUCKETS'] + 1
+        for index in [index for index in self._buckets if index < oldest]:
+            del self._buckets[index]
+        totals = [0, 0, 0]
+        for bucket in self._buckets.values():
+            totals = [total + count for total, count in zip(totals, bucket)]
+        return totals
+
+    def _transition(self, state):
+        previous, self.state = self.state, state
+        self._trial_calls = 0
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if state == CLOSED:
+            self._buckets = {}
+        logger.warning(f"Circuit breaker for {self.service_name}: {previous} -> {state}")
+        BREAKER_STATE.set(STATE_VALUES[state], service=self.service_name)
+        return state, time.time()
+
+    def _publish(self, changed):
+        # The shared cache may be on disk, so a state change is written from a thread of its
+        # own rather than under the breaker's lock or on the event loop of the async proxy
+        if changed is None:
+            return
+        state, changed_at = changed
+        self._publisher = threading.Thread(
+            target=publish_breaker_state, args=(self.service_name, state, changed_at, self.config['STATE_TTL']),
+            name='breaker-state-publisher', daemon=True)
+        self._publisher.start()
+
+
+_publish_lock = threading.Lock()
+
+
+def publish_breaker_state(service_name, state, changed_at, ttl):
+    """
+    Record a state change in the shared cache, so the check_api_health command (a separate
+    process) can report the breaker state of every worker process. Each worker writes its
+    own entry, which expires after `ttl` seconds so the states of dead workers go away,
+    and adds its pid to the service's list of workers.
+    """
+    pid = os.getpid()
+    try:
+        shared = caches['shared']
+        key = BREAKER_WORKER_CACHE_KEY.format(service=service_name, pid=pid)
+        with _publish_lock:
+            # Changes published out of order by two threads of this worker keep the latest
+            current = shared.get(key)
+            if current is not None and current['changed_at'] > changed_at:
+                return
+            shared.set(key, {'state': state, 'changed_at': changed_at}, timeout=ttl)
+            # Another worker may rewrite the list at the same time, so check it kept this pid
+            index_key = BREAKER_STATE_CACHE_KEY.format(service=service_name)
+            for _ in range(3):
+                pids = set(published_breaker_states(service_name)) | {pid}
+                shared.set(index_key, sorted(pids), timeout=ttl)
+                if pid in (shared.get(index_key) or ()):
+                    break
+    except Exception as e:
+        logger.error(f"Could not publish circuit breaker state for {service_name}: {e}")
+
+
+def published_breaker_states(service_name):
+    """
+    The breaker state published by each worker process, by pid, leaving out the expired ones.
+    """
+    shared = caches['shared']
+    keys = {pid: BREAKER_WORKER_CACHE_KEY.format(service=service_name, pid=pid)
+            for pid in shared.get(BREAKER_STATE_CACHE_KEY.format(service=service_name)) or ()}
+    entries = shared.get_many(keys.values())
+    return {pid: entries[key] for pid, key in keys.items() if key in entries}
+
+
+class RetryBudget:
+    """
+    Caps retries to a share of the traffic: every call deposits BUDGET_RATIO of a token, a
+    retry withdraws a whole one, and BUDGET_MIN_PER_SECOND tokens are added per second so a
+    quiet service can still be retried. A failing upstream therefore sees at most
+    (1 + BUDGET_RATIO) times its normal load instead of (1 + MAX_RETRIES) times.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.max_tokens = max(config['BUDGET_MIN_PER_SECOND'], 1) * 10
+        self._tokens = self.max_tokens
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.config['BUDGET_RATIO'])
+
+    def withdraw(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.max_tokens, self._tokens + (now - self._refilled_at) * self.config['BUDGET_MIN_PER_SECOND'])
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def backoff_delay(config, attempt):
+    """
+    Full jitter exponential backoff before retry number `attempt` (starting at 1).
+    """
+    return random.uniform(0, min(config['BACKOFF_MAX'], config['BACKOFF_BASE'] * 2 ** (attempt - 1)))
+
+
+class UpstreamGuards:
+    """
+    The circuit breaker and retry budget of every service, created on first use.
+    """
+
+    def __init__(self):
+        self._breakers = {}
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, service_name):
+        breaker = self._breakers.get(service_name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    service_name, CircuitBreaker(service_name, get_breaker_config(service_name)))
+        return breaker
+
+    def retry_budget(self, service_name):
+        budget = self._budgets.get(service_name)
+        if budget is None:
+            with self._lock:
+                budget = self._budgets.setdefault(service_name, RetryBudget(get_retry_config(service_name)))
+        return budget
+
+    def snapshot(self):
+        return [breaker.snapshot() for breaker in list(self._breakers.values())]
+
+    def reset(self):
+        with self._lock:
+            self._breakers = {}
+            self._budgets = {}
+
+
+upstream_guards = UpstreamGuards()
+
+
+def can_retry(method, data, attempt, service_name):
+    """
+    Whether a failed call may be retried: the method is idempotent, the body can be sent
+    again, MAX_RETRIES isn't used up, the breaker still lets calls through and the retry
+    budget has a token left.
+    """
+    config = get_retry_config(service_name)
+    if method not in IDEMPOTENT_METHODS or attempt > config['MAX_RETRIES']:
+        return False
+    if data is not None and not isinstance(data, bytes) and not hasattr(data, 'seek'):
+        return False
+    return upstream_guards.breaker(service_name).allow_request() and upstream_guards.retry_budget(service_name).withdraw()
+
+
+def breaker_open_response(breaker):
+    response = JsonResponse({'error': f'{breaker.service_name} is temporarily unavailable.'}, status=503)
+    response['Retry-After'] = str(breaker.retry_after())
+    return response
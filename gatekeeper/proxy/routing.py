@@ -0,0 +1,65 @@
+from collections import namedtuple
+
+ResolvedRoute = namedtuple('ResolvedRoute', ['entity', 'service', 'api'])
+
+
+def split_segments(path):
+    return [segment for segment in path.split('/') if segment]
+
+
+class RouteIndex:
+    """
+    Segment based prefix trie compiled from the reverse proxy mapping of the service registry.
+
+    A route matches when its entity segments appear as consecutive whole segments of the
+    requested path. When several routes match, the one with the most segments wins, and
+    between equally long matches the leftmost one wins, so resolution no longer depends on
+    the order of the mapping and 'FarmActivities' can never shadow 'FarmActivityTypes'.
+    """
+
+    def __init__(self, mapping, services):
+        self._root = {}
+        self._routes = []
+        self.max_depth = 0
+        for open_agri_entity, resource_provider_id in mapping.items():
+            segments = split_segments(open_agri_entity)
+            if not segments:
+                continue
+            route = ResolvedRoute(
+                entity=open_agri_entity,
+                service=resource_provider_id,
+                api=services.get(resource_provider_id, {}).get('api'),
+            )
+            node = self._root
+            for segment in segments:
+                node = node.setdefault(segment, {})
+            node[None] = route
+            self._routes.append(route)
+            self.max_depth = max(self.max_depth, len(segments))
+
+    def resolve(self, path):
+        """
+        Return the ResolvedRoute serving the path, or None if no route matches.
+        """
+        segments = split_segments(path)
+        best = None
+        best_length = 0
+        for start in range(len(segments)):
+            node = self._root
+            for offset, segment in enumerate(segments[start:start + self.max_depth]):
+                node = node.get(segment)
+                if node is None:
+                    break
+                route = node.get(None)
+                if route is not None and offset + 1 > best_length:
+                    best, best_length = route, offset + 1
+            if best_length == self.max_depth:
+                break
+        return best
+
+    def routes(self):
+        """
+        The resolved route table, sorted by entity.
+        """
+        return sorted(self._routes, key=lambda route: route.entity)
+
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls across the threads of a worker: while a call for a
+    key is in flight, other callers with the same key wait for it and get its result
+    instead of making the call themselves.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Return (result, shared). shared is True when the result came from another caller's
+        call. A waiter gives up after timeout seconds, or when the call raised, and gets
+        (None, True).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait(timeout)
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines, coalescing calls made on the same event loop.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, fn, timeout=None):
+        loop = asyncio.get_running_loop()
+        future = self._calls.get((loop, key))
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout), True
+            except asyncio.TimeoutError:
+                return None, True
+
+        future = self._calls[(loop, key)] = loop.create_future()
+        result = None
+        try:
+            result = await fn()
+            return result, False
+        finally:
+            # Waiters get None when the call raised or was cancelled
+            del self._calls[(loop, key)]
+            future.set_result(result)
+
+
+single_flight = SingleFlight()
+async_single_flight = AsyncSingleFlight()
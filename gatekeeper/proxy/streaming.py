@@ -0,0 +1,180 @@
+import itertools
+import time
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from gatekeeper.proxy.compression import accepts_encoding
+from gatekeeper.proxy.conf import get_service_config
+from gatekeeper.timing import NullTimer
+
+# Upstream response headers passed through to the client besides Content-Type
+PASSTHROUGH_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires', 'Vary')
+
+DEFAULT_PROXY_STREAMING = {
+    'STREAM': False,                # always stream this service's responses
+    'BUFFER_LIMIT': 1024 * 1024,    # max bytes held in memory before switching to streaming
+    'CHUNK_SIZE': 64 * 1024,        # bytes read from the upstream per chunk
+}
+
+
+def get_streaming_config(service_name):
+    return get_service_config(service_name, DEFAULT_PROXY_STREAMING, 'PROXY_STREAMING', 'streaming')
+
+
+def _declared_length(upstream_response):
+    try:
+        return int(upstream_response.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _passthrough_encoding(upstream_response, accept_encoding):
+    """
+    The upstream's Content-Encoding when the client can decode it, so the body is forwarded
+    still encoded, or None when it has to be decoded by the proxy.
+    """
+    encoding = upstream_response.headers.get('Content-Encoding', '').strip()
+    if not encoding or encoding.lower() == 'identity' or ',' in encoding:
+        return None
+    return encoding if accepts_encoding(accept_encoding, encoding) else None
+
+
+def _copy_headers(upstream_response, response, encoding=None):
+    for header in PASSTHROUGH_HEADERS:
+        if header in upstream_response.headers:
+            response[header] = upstream_response.headers[header]
+    if encoding:
+        response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def _streamed_length(upstream_response, content_length, encoding):
+    # requests and httpx decode Content-Encoding while iterating, so the upstream length
+    # only holds for unencoded or passed through bodies. Without it the server falls back
+    # to chunked transfer.
+    if content_length is not None and (encoding or not upstream_response.headers.get('Content-Encoding')):
+        return str(content_length)
+    return None
+
+
+def _close_after(chunks, upstream_response, timer, started):
+    # Django closes the streaming content once the response has been sent (or aborted),
+    # which returns the upstream connection to the pool and ends the body stage.
+    try:
+        yield from chunks
+    finally:
+        upstream_response.close()
+        timer.add_late('body', time.perf_counter() - started)
+
+
+def build_proxy_response(upstream_response, service_name, accept_encoding='', timer=None):
+    """
+    Turn an upstream response requested with stream=True into a Django response.
+
+    Small bodies are buffered into a regular HttpResponse. A body is streamed with a
+    StreamingHttpResponse when the service has streaming enabled, when its declared
+    Content-Length is above BUFFER_LIMIT, or as soon as more than BUFFER_LIMIT bytes have
+    been read, so no more than BUFFER_LIMIT bytes of a body are ever held per request.
+    An encoded body the client accepts (per accept_encoding) is forwarded without being
+    decoded. The time spent reading the body, until a streamed body has been sent, is added
+    to the timer's body stage.
+    """
+    timer = timer or NullTimer()
+    started = time.perf_counter()
+    config = get_streaming_config(service_name)
+    status = upstream_response.status_code
+    content_type = upstream_response.headers.get('Content-Type', 'application/json')
+    content_length = _declared_length(upstream_response)
+    encoding = _passthrough_encoding(upstream_response, accept_encoding)
+
+    if encoding:
+        chunks = upstream_response.raw.stream(config['CHUNK_SIZE'], decode_content=False)
+    else:
+        chunks = upstream_response.iter_content(chunk_size=config['CHUNK_SIZE'])
+    stream = config['STREAM'] or (content_length is not None and content_length > config['BUFFER_LIMIT'])
+    if not stream:
+        buffered = []
+        buffered_size = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size > config['BUFFER_LIMIT']:
+                break
+        else:
+            upstream_response.close()
+            timer.add('body', time.perf_counter() - started)
+            response = HttpResponse(b''.join(buffered), status=status, content_type=content_type)
+            return _copy_headers(upstream_response, response, encoding)
+        chunks = itertools.chain(buffered, chunks)
+
+    response = StreamingHttpResponse(
+        _close_after(chunks, upstream_response, timer, started),
+        status=status,
+        content_type=content_type,
+    )
+    length = _streamed_length(upstream_response, content_length, encoding)
+    if length is not None:
+        response['Content-Length'] = length
+    return _copy_headers(upstream_response, response, encoding)
+
+
+async def _aclose_after(chunks, upstream_response, timer, started):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await upstream_response.aclose()
+        timer.add_late('body', time.perf_counter() - started)
+
+
+async def _achain(buffered, chunks):
+    for chunk in buffered:
+        yield chunk
+    async for chunk in chunks:
+        yield chunk
+
+
+async def build_async_proxy_response(upstream_response, service_name, accept_encoding='', timer=None):
+    """
+    Async counterpart of build_proxy_response for an httpx response sent with stream=True,
+    applying the same buffering, streaming and timing rules.
+    """
+    timer = timer or NullTimer()
+    started = time.perf_counter()
+    config = get_streaming_config(service_name)
+    status = upstream_response.status_code
+    content_type = upstream_response.headers.get('Content-Type', 'application/json')
+    content_length = _declared_length(upstream_response)
+    encoding = _passthrough_encoding(upstream_response, accept_encoding)
+
+    if encoding:
+        chunks = upstream_response.aiter_raw(chunk_size=config['CHUNK_SIZE'])
+    else:
+        chunks = upstream_response.aiter_bytes(chunk_size=config['CHUNK_SIZE'])
+    stream = config['STREAM'] or (content_length is not None and content_length > config['BUFFER_LIMIT'])
+    if not stream:
+        buffered = []
+        buffered_size = 0
+        async for chunk in chunks:
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size > config['BUFFER_LIMIT']:
+                break
+        else:
+            await upstream_response.aclose()
+            timer.add('body', time.perf_counter() - started)
+            response = HttpResponse(b''.join(buffered), status=status, content_type=content_type)
+            return _copy_headers(upstream_response, response, encoding)
+        chunks = _achain(buffered, chunks)
+
+    response = StreamingHttpResponse(
+        _aclose_after(chunks, upstream_response, timer, started),
+        status=status,
+        content_type=content_type,
+    )
+    length = _streamed_length(upstream_response, content_length, encoding)
+    if length is not None:
+        response['Content-Length'] = length
+    return _copy_headers(upstream_response, response, encoding)
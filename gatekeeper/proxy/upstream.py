@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from http import cookiejar
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from gatekeeper.proxy.conf import get_service_config
+
+logger = logging.getLogger('aegis')
+
+# Headers that only make sense for a single transport-level connection and
+# must not be forwarded between the client and the upstream (RFC 7230, 6.1).
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade',
+])
+
+DEFAULT_UPSTREAM_POOL = {
+    'POOL_CONNECTIONS': 10,     # number of distinct hosts kept in the pool
+    'POOL_MAXSIZE': 10,         # max idle keep-alive connections kept per host
+    'POOL_BLOCK': False,        # block instead of opening overflow connections
+    'KEEP_ALIVE': True,
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 30,
+}
+
+
+def get_pool_config(service_name):
+    return get_service_config(service_name, DEFAULT_UPSTREAM_POOL, 'UPSTREAM_POOL', 'pool')
+
+
+# Seconds the current thread spent opening upstream connections (TCP and TLS handshakes),
+# which requests doesn't report apart from the time to first byte
+_connects = threading.local()
+
+
+def connect_time():
+    """
+    Seconds spent by this thread opening upstream connections since the last call.
+    """
+    duration = getattr(_connects, 'duration', 0)
+    _connects.duration = 0
+    return duration
+
+
+def _timed_connect(connection, connect):
+    started = time.perf_counter()
+    try:
+        connect(connection)
+    finally:
+        _connects.duration = getattr(_connects, 'duration', 0) + time.perf_counter() - started
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        _timed_connect(self, HTTPConnection.connect)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _timed_connect(self, HTTPSConnection.connect)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connections add the time they take to open to connect_time().
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+class UpstreamSessionPool:
+    """
+    Keeps one requests.Session per service in settings.AVAILABLE_SERVICES for the lifetime
+    of the worker, so proxied calls reuse keep-alive connections instead of doing a new
+    TCP/TLS handshake each time.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, service_name):
+        session = self._sessions.get(service_name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(service_name)
+                if session is None:
+                    session = self._build_session(service_name)
+                    self._sessions[service_name] = session
+        return session
+
+    def get_timeout(self, service_name):
+        config = get_pool_config(service_name)
+        return config['CONNECT_TIMEOUT'], config['READ_TIMEOUT']
+
+    def close_all(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    def _build_session(self, service_name):
+        config = get_pool_config(service_name)
+        session = requests.Session()
+        adapter = TimedHTTPAdapter(
+            pool_connections=config['POOL_CONNECTIONS'],
+            pool_maxsize=config['POOL_MAXSIZE'],
+            pool_block=config['POOL_BLOCK'],
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # The session is shared by every user of this worker, so it must never keep cookies
+        # set by the upstream; the client's own Cookie header is forwarded per request.
+        session.cookies.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        if not config['KEEP_ALIVE']:
+            session.headers['Connection'] = 'close'
+        logger.info(f"Created upstream session pool for service: {service_name}")
+        return session
+
+
+upstream_pool = UpstreamSessionPool()
+
+
+def forwardable_headers(headers):
+    """
+    Drop the Host and hop-by-hop headers (and any header named in Connection) from the
+    incoming request headers so they don't interfere with the pooled upstream connection.
+    """
+    connection_tokens = {
+        token.strip().lower() for token in headers.get('Connection', '').split(',') if token.strip()
+    }
+    return {
+        key: value for key, value in headers.items()
+        if key.lower() != 'host'
+        and key.lower() not in HOP_BY_HOP_HEADERS
+        and key.lower() not in connection_tokens
+    }
@@ -0,0 +1,263 @@
+import ipaddress
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+
+from gatekeeper.proxy.registry import get_services
+
+logger = logging.getLogger('aegis')
+
+PERIODS = {'s': 1, 'sec': 1, 'second': 1, 'm': 60, 'min': 60, 'minute': 60, 'h': 3600, 'hour': 3600,
+           'd': 86400, 'day': 86400}
+
+DEFAULT_RATE_LIMITS = {
+    'ENABLED': True,
+    'STORE': 'local',               # 'local': buckets per worker process, 'shared': in the 'shared' cache
+    'MAX_KEYS': 100000,             # buckets kept by the local store, least recently used dropped first
+    # Buckets of the reverse proxy, per authenticated user, per OAuth client and per IP
+    'PROXY': {'USER': '600/minute', 'CLIENT': '1200/minute', 'IP': '1200/minute'},
+    # Buckets of the credential endpoints, per submitted username from one IP and per IP.
+    # Tight, since every attempt spends a password hash worth of CPU.
+    'LOGIN': {'USER': '5/minute', 'IP': '20/minute'},
+}
+
+Bucket = namedtuple('Bucket', ['key', 'capacity', 'refill_rate'])
+BucketState = namedtuple('BucketState', ['allowed', 'capacity', 'remaining', 'reset', 'retry_after'])
+
+
+def get_rate_limit_config():
+    config = dict(DEFAULT_RATE_LIMITS)
+    config.update(getattr(settings, 'RATE_LIMITS', {}))
+    return config
+
+
+def parse_rate(rate):
+    """
+    Parse a rate like '600/minute' into (capacity, tokens refilled per second): a full
+    bucket allows a burst of the whole number, refilled evenly over the period.
+    """
+    number, _, period = rate.partition('/')
+    count, unit = '', period
+    while unit[:1].isdigit():
+        count, unit = count + unit[0], unit[1:]
+    seconds = int(count or 1) * PERIODS[unit.strip().lower()]
+    capacity = int(number)
+    return capacity, capacity / seconds
+
+
+class LocalBucketStore:
+    """
+    Token buckets held in the worker process, bounded to MAX_KEYS buckets.
+    """
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, bucket, max_keys):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(bucket.key, (bucket.capacity, now))
+            tokens = min(bucket.capacity, tokens + (now - updated) * bucket.refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[bucket.key] = (tokens, now)
+            while len(self._buckets) > max_keys:
+                self._buckets.popitem(last=False)
+        return _state(bucket, allowed, tokens)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedBucketStore:
+    """
+    Token buckets kept in the 'shared' cache, so all worker processes draw from the same
+    buckets. Reading and writing a bucket isn't atomic, concurrent requests for one key can
+    occasionally both take the last token.
+    """
+
+    def consume(self, bucket, max_keys):
+        cache = caches['shared']
+        now = time.time()
+        key = f'ratelimit:{bucket.key}'
+        tokens, updated = cache.get(key) or (bucket.capacity, now)
+        tokens = min(bucket.capacity, tokens + (now - updated) * bucket.refill_rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Expire the bucket once it would be full again anyway
+        cache.set(key, (tokens, now), timeout=math.ceil((bucket.capacity - tokens) / bucket.refill_rate) + 1)
+        return _state(bucket, allowed, tokens)
+
+    def clear(self):
+        pass
+
+
+def _state(bucket, allowed, tokens):
+    return BucketState(
+        allowed=allowed,
+        capacity=bucket.capacity,
+        remaining=int(tokens),
+        reset=math.ceil((bucket.capacity - tokens) / bucket.refill_rate),
+        retry_after=0 if allowed else math.ceil((1 - tokens) / bucket.refill_rate),
+    )
+
+
+local_store = LocalBucketStore()
+shared_store = SharedBucketStore()
+
+
+class RateLimitResult:
+    """
+    Outcome of drawing a request's tokens from all of its buckets. The most restrictive
+    bucket is reported in the RateLimit-* headers of the response.
+    """
+
+    def __init__(self, states):
+        self.states = states
+        self.allowed = all(state.allowed for state in states)
+
+    @property
+    def limiting(self):
+        if not self.states:
+            return None
+        return min(self.states, key=lambda state: (state.allowed, state.remaining / state.capacity))
+
+    def annotate(self, response):
+        state = self.limiting
+        if state is not None:
+            response['RateLimit-Limit'] = str(state.capacity)
+            response['RateLimit-Remaining'] = str(state.remaining)
+            response['RateLimit-Reset'] = str(state.reset)
+            if not state.allowed:
+                response['Retry-After'] = str(state.retry_after)
+        return response
+
+    def response(self):
+        return self.annotate(JsonResponse({'error': 'Too many requests.'}, status=429))
+
+
+def consume(buckets):
+    """
+    Draw one token from each bucket, stopping at the first empty one.
+    """
+    config = get_rate_limit_config()
+    if not config['ENABLED']:
+        return RateLimitResult([])
+    store = shared_store if config['STORE'] == 'shared' else local_store
+    states = []
+    for bucket in buckets:
+        try:
+            state = store.consume(bucket, config['MAX_KEYS'])
+        except Exception as e:
+            # A broken shared store must not take the gatekeeper down with it
+            logger.error(f"Rate limit store failed, request let through: {e}")
+            continue
+        states.append(state)
+        if not state.allowed:
+            logger.warning(f"Rate limited {bucket.key}")
+            break
+    return RateLimitResult(states)
+
+
+def _buckets(scope, limits, identities):
+    buckets = []
+    for kind, identity in identities:
+        rate = limits.get(kind)
+        if rate and identity is not None:
+            capacity, refill_rate = parse_rate(rate)
+            buckets.append(Bucket(f'{scope}:{kind.lower()}:{identity}', capacity, refill_rate))
+    return buckets
+
+
+@lru_cache(maxsize=8)
+def _trusted_networks(proxies):
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def _is_trusted(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in _trusted_networks(tuple(getattr(settings, 'TRUSTED_PROXIES', ()))))
+
+
+def client_ip(request):
+    """
+    The address of the client. Behind a reverse proxy listed in TRUSTED_PROXIES, e.g. the
+    nginx container, REMOTE_ADDR is the proxy's: the client is then the last
+    X-Forwarded-For hop that isn't a trusted proxy, or X-Real-IP without that header.
+    The headers of anyone else are ignored, clients could forge them.
+    """
+    remote = request.META.get('REMOTE_ADDR')
+    if not remote or not _is_trusted(remote):
+        return remote
+    hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted(hop):
+            return hop
+    if hops:
+        return hops[0]
+    return request.META.get('HTTP_X_REAL_IP', '').strip() or remote
+
+
+def proxy_limits(route):
+    """
+    Rates of a proxied route: the PROXY rates, overridden by the service's 'rate_limit'
+    entry in the service registry, overridden by the entity's entry in
+    REVERSE_PROXY_RATE_LIMITS.
+    """
+    limits = dict(get_rate_limit_config()['PROXY'])
+    limits.update(get_services().get(route.service, {}).get('rate_limit') or {})
+    limits.update(getattr(settings, 'REVERSE_PROXY_RATE_LIMITS', {}).get(route.entity) or {})
+    return limits
+
+
+def proxy_rate_limit(request, route):
+    """
+    Take a proxied request's tokens. Buckets are scoped to the route when it has its own
+    limits and to the service otherwise, so one busy service can't starve the others.
+    """
+    scope = route.entity if route.entity in getattr(settings, 'REVERSE_PROXY_RATE_LIMITS', {}) else route.service
+    # OAuth2 access tokens belong to an application, JWTs don't
+    client = getattr(getattr(request, 'auth', None), 'application_id', None)
+    identities = [
+        ('USER', request.user.pk if request.user.is_authenticated else None),
+        ('CLIENT', client),
+        ('IP', client_ip(request)),
+    ]
+    return consume(_buckets(f'proxy:{scope}', proxy_limits(route), identities))
+
+
+async def aproxy_rate_limit(request, route):
+    # The local store only takes a lock, the shared one does cache I/O in a thread
+    if get_rate_limit_config()['STORE'] == 'shared':
+        return await sync_to_async(proxy_rate_limit)(request, route)
+    return proxy_rate_limit(request, route)
+
+
+def login_rate_limit(request, username):
+    """
+    Take a credential check's tokens, per submitted username from the client's IP and per
+    IP. The username bucket is per IP, so nobody can lock a user out by guessing from
+    elsewhere.
+    """
+    ip = client_ip(request)
+    username = (username or '').strip().lower()
+    identities = [
+        ('USER', f'{username}@{ip}' if username else None),
+        ('IP', ip),
+    ]
+    return consume(_buckets('login', get_rate_limit_config()['LOGIN'], identities))
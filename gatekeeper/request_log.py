@@ -0,0 +1,331 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils.module_loading import import_string
+
+from gatekeeper.metrics import REQUEST_LOG_BACKLOG, REQUEST_LOG_DROPPED, REQUEST_LOG_WRITTEN
+from gatekeeper.traffic import traffic_counters
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_REQUEST_LOGGING = {
+    'SINK': 'database',             # database, jsonl or the dotted path of a sink class
+    'BODY_LIMIT': 4096,             # bytes of the request body kept in the log
+    'ROUTES': {},                   # path prefix: {'SAMPLE_RATE': share of requests logged, 'BODY_LIMIT': bytes}
+    'QUEUE_SIZE': 10000,            # records waiting for the background writer, per worker process
+    'BATCH_SIZE': 500,              # records written by one bulk insert
+    'FLUSH_INTERVAL': 1.0,          # seconds a record waits at most for its batch to fill up
+    'OVERFLOW': 'drop',             # when the queue is full: drop, sample or block
+    'SAMPLE_RATE': 0.1,             # with sample, the share of records still queued once the queue is half full
+    'BLOCK_TIMEOUT': 1.0,           # with block, seconds a request waits for room before its record is dropped
+    'SHUTDOWN_TIMEOUT': 10,         # seconds a stopping worker spends writing out its queue
+    # jsonl sink: every worker process appends to its own file in DIRECTORY and rotates it
+    'DIRECTORY': 'logs/requests',
+    'ROTATE_BYTES': 64 * 1024 * 1024,
+    'ROTATE_INTERVAL': 3600,        # seconds
+    'COMPRESS': True,               # gzip the rotated segments
+}
+
+OVERFLOW_POLICIES = ('drop', 'sample', 'block')
+
+# Fields of a request log record, the RequestLog columns
+RECORD_FIELDS = ('user_id', 'ip_address', 'user_agent', 'path', 'query_string', 'body', 'method',
+                 'response_status', 'timestamp')
+
+
+def get_request_logging_config():
+    config = dict(DEFAULT_REQUEST_LOGGING)
+    config.update(getattr(settings, 'REQUEST_LOGGING', {}))
+    return config
+
+
+def get_route_config(path, config):
+    """
+    Sample rate and body limit of the request path, from its longest ROUTES prefix.
+    """
+    route = {'SAMPLE_RATE': 1, 'BODY_LIMIT': config['BODY_LIMIT']}
+    prefixes = [prefix for prefix in config['ROUTES'] if path.startswith(prefix)]
+    if prefixes:
+        route.update(config['ROUTES'][max(prefixes, key=len)])
+    return route
+
+
+class DatabaseSink:
+    """
+    Inserts the records into the activity_log table. A sink's write returns how many of
+    the records it had to drop, or None when it wrote them all.
+    """
+
+    def __init__(self, config):
+        pass
+
+    def write(self, records, config):
+        from aegis.models import RequestLog
+
+        try:
+            with transaction.atomic():
+                RequestLog.objects.bulk_create([RequestLog(**record) for record in records],
+                                               batch_size=config['BATCH_SIZE'])
+            return None
+        except DatabaseError as e:
+            logger.warning(f"Could not insert {len(records)} request log records at once, inserting them one by one: {e}")
+        # Only the bad record is lost, e.g. of a user deleted since the request
+        dropped = 0
+        for record in records:
+            try:
+                with transaction.atomic():
+                    RequestLog.objects.create(**record)
+            except DatabaseError as e:
+                logger.error(f"Could not write the request log record of {record.get('path')}: {e}")
+                dropped += 1
+        return dropped
+
+    def tick(self, config):
+        pass
+
+    def close(self, config):
+        pass
+
+
+class JsonLinesSink:
+    """
+    Appends the records as JSON lines to a file of this worker process in DIRECTORY, so
+    workers never share a file. The file is rotated once it reaches ROTATE_BYTES or is
+    ROTATE_INTERVAL seconds old, and when the worker stops: renamed to a segment named
+    after the rotation time and the process, gzip compressed with COMPRESS. The
+    load_request_logs command loads rotated segments into the activity_log table.
+    """
+
+    def __init__(self, config):
+        self.directory = config['DIRECTORY']
+        self._file = None
+        self._pid = None
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def current_path(self):
+        return os.path.join(self.directory, f'current-{os.getpid()}.jsonl')
+
+    def write(self, records, config):
+        data = ''.join(json.dumps(record, separators=(',', ':'), default=str) + '\n' for record in records)
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                os.makedirs(self.directory, exist_ok=True)
+                self._file = open(self.current_path(), 'a', encoding='utf-8')
+                self._pid = os.getpid()
+                self._opened = time.monotonic()
+            self._file.write(data)
+            self._file.flush()
+            if self._file.tell() >= config['ROTATE_BYTES']:
+                self._rotate(config)
+
+    def tick(self, config):
+        with self._lock:
+            if self._file is not None and time.monotonic() - self._opened >= config['ROTATE_INTERVAL']:
+                self._rotate(config)
+
+    def close(self, config):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._rotate(config)
+
+    def _rotate(self, config):
+        self._file.close()
+        self._file = None
+        current = self.current_path()
+        if not os.path.getsize(current):
+            os.remove(current)
+            return
+        stamp = datetime.now(dt_timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        segment = os.path.join(self.directory, f'requests-{stamp}-{os.getpid()}.jsonl')
+        if config['COMPRESS']:
+            # Compressed under a temporary name, so the loader never picks up half a segment
+            with open(current, 'rb') as source, gzip.open(segment + '.gz.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.replace(segment + '.gz.tmp', segment + '.gz')
+            os.remove(current)
+        else:
+            os.replace(current, segment)
+
+
+SINKS = {
+    'database': DatabaseSink,
+    'jsonl': JsonLinesSink,
+}
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_sink(config):
+    key = (config['SINK'], config['DIRECTORY'])
+    sink = _sinks.get(key)
+    if sink is None:
+        with _sinks_lock:
+            sink = _sinks.get(key)
+            if sink is None:
+                sink_class = SINKS.get(config['SINK']) or import_string(config['SINK'])
+                sink = _sinks[key] = sink_class(config)
+    return sink
+
+
+def write_records(records, config):
+    try:
+        dropped = get_sink(config).write(records, config) or 0
+    except (DatabaseError, OSError) as e:
+        logger.error(f"Could not write {len(records)} request log records: {e}")
+        REQUEST_LOG_DROPPED.inc(len(records), reason='error')
+        return False
+    if dropped:
+        REQUEST_LOG_DROPPED.inc(dropped, reason='error')
+    REQUEST_LOG_WRITTEN.inc(len(records) - dropped)
+    return True
+
+
+class RequestLogWriter:
+    """
+    Writes the request log off the request path: requests queue their record and a
+    background thread of the worker process hands them to the sink in batches, once BATCH_SIZE
+    records are waiting or FLUSH_INTERVAL seconds after the first one. Until the writer
+    is started, e.g. in management commands and tests, records are written right away.
+    The thread also adds the worker's traffic counters to the rollup tables.
+
+    When the queue is full the OVERFLOW policy applies: drop the record, sample the
+    records from when the queue is half full, or block the request until there is room.
+    The queue is written out when the worker process exits.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._started = False
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            # A forked worker doesn't inherit the thread, so it starts its own with a fresh queue
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=get_request_logging_config()['QUEUE_SIZE'])
+            if not self._started:
+                atexit.register(self.stop)
+            self._pid = os.getpid()
+            self._started = True
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='request-log-writer', daemon=True)
+            self._thread.start()
+        logger.info("Started the request log writer")
+
+    def submit(self, record):
+        config = get_request_logging_config()
+        if not self._started or self._stop.is_set():
+            write_records([record], config)
+            return
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self.start()
+
+        policy = config['OVERFLOW']
+        if policy == 'sample' and self._queue.qsize() >= self._queue.maxsize // 2 \
+                and random.random() >= config['SAMPLE_RATE']:
+            REQUEST_LOG_DROPPED.inc(reason='sampled')
+            return
+        try:
+            if policy == 'block':
+                self._queue.put(record, timeout=config['BLOCK_TIMEOUT'])
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            REQUEST_LOG_DROPPED.inc(reason='overflow')
+            return
+        REQUEST_LOG_BACKLOG.inc()
+
+    def _take(self, limit, timeout):
+        """
+        Up to `limit` queued records, waiting at most `timeout` seconds for the first and
+        then until that timeout runs out for the rest.
+        """
+        records = []
+        deadline = time.monotonic() + timeout
+        while len(records) < limit:
+            remaining = deadline - time.monotonic()
+            try:
+                records.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _run(self):
+        while not self._stop.is_set():
+            config = get_request_logging_config()
+            records = self._take(config['BATCH_SIZE'], config['FLUSH_INTERVAL'])
+            if records:
+                self._write(records, config)
+            traffic_counters.tick()
+            close_old_connections()
+            try:
+                get_sink(config).tick(config)
+            except OSError as e:
+                logger.error(f"Could not rotate the request log: {e}")
+        self.flush()
+
+    def _write(self, records, config):
+        try:
+            write_records(records, config)
+        finally:
+            REQUEST_LOG_BACKLOG.dec(len(records))
+
+    def flush(self):
+        """
+        Write out the queued records in the calling thread.
+        """
+        if self._queue is None:
+            return
+        config = get_request_logging_config()
+        while True:
+            records = self._take(config['BATCH_SIZE'], 0)
+            if not records:
+                return
+            self._write(records, config)
+
+    def stop(self):
+        if not self._started or self._pid != os.getpid() or self._stop.is_set():
+            return
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(get_request_logging_config()['SHUTDOWN_TIMEOUT'])
+        self.flush()
+        traffic_counters.flush()
+        config = get_request_logging_config()
+        try:
+            get_sink(config).close(config)
+        except OSError as e:
+            logger.error(f"Could not rotate the request log: {e}")
+        logger.info("Stopped the request log writer")
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+request_log_writer = RequestLogWriter()
+
+
+def start_request_log_writer():
+    if get_request_logging_config()['OVERFLOW'] not in OVERFLOW_POLICIES:
+        raise ValueError(f"REQUEST_LOGGING['OVERFLOW'] must be one of {', '.join(OVERFLOW_POLICIES)}")
+    request_log_writer.start()
+
@@ -72,8 +72,10 @@ LOGOUT_REDIRECT_URL = 'login'  # Redirect to the login page after logging out
 
 
 MIDDLEWARE = [
+    'gatekeeper.custom_middleware.ServerTimingMiddleware.ServerTimingMiddleware',
     'gatekeeper.custom_middleware.RequestLoggingMiddleware.RequestLoggingMiddleware',
 
+    'gatekeeper.custom_middleware.CompressionMiddleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -120,6 +122,19 @@ DATABASES = {
 }
 
 
+# 'default' is local to each worker process, 'shared' is seen by every worker
+# process and the management commands (e.g. circuit breaker states)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': os.getenv('SHARED_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv('SHARED_CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')),
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -188,7 +203,8 @@ JWT_SIGNING_KEY = get_env_var('JWT_SIGNING_KEY')
 AVAILABLE_SERVICES = {
     'FarmCalendar':
     {
-        'api': os.getenv('FARM_CALENDAR_API', 'http://127.0.0.1:8002/api/'),
+        # one base url per instance, comma separated, the proxy balances over them
+        'api': os.getenv('FARM_CALENDAR_API', 'http://127.0.0.1:8002/api/').split(','),
         'post_auth': os.getenv('FARM_CALENDAR_POST_AUTH', 'http://127.0.0.1:8002/post_auth/')
     },
     'WeatherService': {
@@ -205,6 +221,194 @@ REVERSE_PROXY_MAPPING = {
     'FarmPlants': 'FarmCalendar',
     'WeeklyWeatherForecast': 'WeatherService',
 }
+# services and routes registered in the admin are merged into the two settings
+# above, each worker checks for changes every SERVICE_REGISTRY_REFRESH_INTERVAL seconds
+SERVICE_REGISTRY = {
+    'ENABLED': os.getenv('SERVICE_REGISTRY', 'True') == 'True',
+    'REFRESH_INTERVAL': float(os.getenv('SERVICE_REGISTRY_REFRESH_INTERVAL', '5')),
+}
+
+# per entity overrides of the GET response cache below. TTL replaces the
+# freshness sent by the upstream, SCOPE 'shared' caches one copy for all users
+REVERSE_PROXY_CACHE = {
+    'FarmActivityTypes': {'TTL': 300, 'SCOPE': 'shared'},
+    'WeeklyWeatherForecast': {'TTL': 600, 'SCOPE': 'shared'},
+}
+
+# per entity rate limits of the reverse proxy, overriding RATE_LIMITS['PROXY']
+# and the service's own 'rate_limit' entry above
+REVERSE_PROXY_RATE_LIMITS = {}
+
+# keep-alive connection pool and timeouts used by the reverse proxy for every
+# service above; a service can override any of these with its own 'pool' entry
+UPSTREAM_POOL = {
+    'POOL_CONNECTIONS': int(os.getenv('UPSTREAM_POOL_CONNECTIONS', '10')),
+    'POOL_MAXSIZE': int(os.getenv('UPSTREAM_POOL_MAXSIZE', '10')),
+    'POOL_BLOCK': False,
+    'KEEP_ALIVE': os.getenv('UPSTREAM_KEEP_ALIVE', 'True') == 'True',
+    'CONNECT_TIMEOUT': float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '3.05')),
+    'READ_TIMEOUT': float(os.getenv('UPSTREAM_READ_TIMEOUT', '30')),
+}
+# upstream bodies larger than BUFFER_LIMIT bytes are streamed to the client
+# instead of buffered; a service can always stream with {'streaming': {'STREAM': True}}
+PROXY_STREAMING = {
+    'STREAM': False,
+    'BUFFER_LIMIT': int(os.getenv('PROXY_STREAMING_BUFFER_LIMIT', str(1024 * 1024))),
+    'CHUNK_SIZE': 64 * 1024,
+}
+# request bodies larger than MEMORY_LIMIT bytes are spooled to a temporary file
+# (or streamed straight to the upstream for services with {'request_body': {'STREAM': True}})
+PROXY_REQUEST_BODY = {
+    'STREAM': False,
+    'MEMORY_LIMIT': int(os.getenv('PROXY_REQUEST_BODY_MEMORY_LIMIT', str(1024 * 1024))),
+    'CHUNK_SIZE': 64 * 1024,
+}
+
+# in-process LRU cache for proxied GET responses, honouring the upstream
+# Cache-Control/Expires/ETag headers unless an entity sets its own TTL
+PROXY_CACHE = {
+    'ENABLED': os.getenv('PROXY_CACHE_ENABLED', 'True') == 'True',
+    'MAX_ENTRIES': int(os.getenv('PROXY_CACHE_MAX_ENTRIES', '1000')),
+    'MAX_SIZE': int(os.getenv('PROXY_CACHE_MAX_SIZE', str(64 * 1024 * 1024))),
+    'MAX_ENTRY_SIZE': 1024 * 1024,
+    'DEFAULT_TTL': 0,
+    'SCOPE': 'user',
+}
+
+# per service circuit breaker, opened by the error or slow call rate of the
+# last WINDOW seconds; while open, proxied calls fail fast with a 503
+CIRCUIT_BREAKER = {
+    'WINDOW': 30,
+    'MIN_CALLS': int(os.getenv('CIRCUIT_BREAKER_MIN_CALLS', '10')),
+    'ERROR_RATE': float(os.getenv('CIRCUIT_BREAKER_ERROR_RATE', '0.5')),
+    'SLOW_CALL_DURATION': float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_DURATION', '5')),
+    'SLOW_CALL_RATE': 0.8,
+    'OPEN_DURATION': int(os.getenv('CIRCUIT_BREAKER_OPEN_DURATION', '30')),
+    'HALF_OPEN_CALLS': 1,
+    'STATE_TTL': 3600,
+}
+# retries of idempotent proxied requests, limited to BUDGET_RATIO extra load
+UPSTREAM_RETRY = {
+    'MAX_RETRIES': int(os.getenv('UPSTREAM_MAX_RETRIES', '2')),
+    'BACKOFF_BASE': 0.1,
+    'BACKOFF_MAX': 2.0,
+    'BUDGET_RATIO': 0.2,
+    'BUDGET_MIN_PER_SECOND': 1,
+    'RETRY_STATUSES': (502, 503, 504),
+}
+
+# how the reverse proxy spreads requests over the instances of a service with
+# several 'api' urls: POLICY is round_robin, least_outstanding or power_of_two;
+# an instance failing EJECT_AFTER calls in a row is skipped for EJECT_DURATION
+LOAD_BALANCER = {
+    'POLICY': os.getenv('LOAD_BALANCER_POLICY', 'round_robin'),
+    'EJECT_AFTER': 5,
+    'EJECT_DURATION': 30,
+    'MAX_EJECTED_PERCENT': 50,
+}
+
+# active health probes of every service instance, run by each worker process in
+# the background; the balancer skips unhealthy instances and a service with none
+# left is answered 503 right away. A service can override these with its own
+# 'health_check' entry, e.g. {'ENABLED': False} for one without a health path
+HEALTH_CHECK = {
+    'ENABLED': os.getenv('HEALTH_CHECKS', 'True') == 'True',
+    'PATH': os.getenv('HEALTH_CHECK_PATH', 'health'),
+    'INTERVAL': float(os.getenv('HEALTH_CHECK_INTERVAL', '10')),
+    'TIMEOUT': float(os.getenv('HEALTH_CHECK_TIMEOUT', '2')),
+    'HEALTHY_AFTER': 2,
+    'UNHEALTHY_AFTER': 3,
+}
+
+# brotli (when installed) or gzip compression of large JSON responses, both the
+# gatekeeper's own and proxied ones the upstream didn't already compress
+RESPONSE_COMPRESSION = {
+    'ENABLED': os.getenv('RESPONSE_COMPRESSION', 'True') == 'True',
+    'MIN_SIZE': int(os.getenv('RESPONSE_COMPRESSION_MIN_SIZE', '1024')),
+    'CONTENT_TYPES': ('application/json', 'application/ld+json', 'application/problem+json'),
+}
+
+# token bucket rate limits as 'count/period', a full bucket allows a burst of
+# count requests. STORE 'shared' keeps the buckets in the shared cache so all
+# worker processes draw from the same ones
+# addresses or networks of the reverse proxies in front of the gatekeeper, e.g. the nginx
+# container; only their X-Forwarded-For/X-Real-IP headers are trusted for the client address
+TRUSTED_PROXIES = [proxy.strip() for proxy in os.getenv('TRUSTED_PROXIES', '').split(',') if proxy.strip()]
+
+RATE_LIMITS = {
+    'ENABLED': os.getenv('RATE_LIMITS', 'True') == 'True',
+    'STORE': os.getenv('RATE_LIMITS_STORE', 'local'),
+    'PROXY': {
+        'USER': os.getenv('RATE_LIMIT_PROXY_USER', '600/minute'),
+        'CLIENT': os.getenv('RATE_LIMIT_PROXY_CLIENT', '1200/minute'),
+        'IP': os.getenv('RATE_LIMIT_PROXY_IP', '1200/minute'),
+    },
+    'LOGIN': {
+        'USER': os.getenv('RATE_LIMIT_LOGIN_USER', '5/minute'),
+        'IP': os.getenv('RATE_LIMIT_LOGIN_IP', '20/minute'),
+    },
+}
+
+# /api/resources/_batch, proxying several sub-requests in one call
+PROXY_BATCH = {
+    'MAX_REQUESTS': int(os.getenv('PROXY_BATCH_MAX_REQUESTS', '20')),
+    'MAX_CONCURRENCY': 10,
+}
+
+# per stage timing of requests (auth, route, ratelimit, cache, connect, upstream,
+# body, log, total); HEADER sends it to clients as a Server-Timing header, which
+# exposes internals, so it's off unless asked for
+SERVER_TIMING = {
+    'HEADER': os.getenv('SERVER_TIMING_HEADER', 'False') == 'True',
+    'HISTOGRAMS': True,
+}
+
+# Prometheus metrics served at /metrics. With several worker processes set
+# METRICS_MULTIPROCESS_DIR so every worker's values are aggregated.
+METRICS = {
+    'ENABLED': os.getenv('METRICS', 'True') == 'True',
+    'MULTIPROCESS_DIR': os.getenv('METRICS_MULTIPROCESS_DIR') or None,
+    'TOKEN': os.getenv('METRICS_TOKEN') or None,
+}
+
+# serve /api/resources/ with the async reverse proxy, set by gatekeeper.asgi
+# so it's used whenever the gatekeeper runs under an ASGI server
+ASYNC_REVERSE_PROXY = os.getenv('ASYNC_REVERSE_PROXY', 'False') == 'True'
+
+# only the first BODY_LIMIT bytes of a request body are stored in the activity log.
+# Records are queued and written in batches by a background thread of each worker;
+# OVERFLOW (drop, sample or block) decides what happens when the queue is full.
+# SINK 'jsonl' appends them to rotated files in DIRECTORY instead of the database,
+# loaded later with the load_request_logs command
+REQUEST_LOGGING = {
+    'SINK': os.getenv('REQUEST_LOGGING_SINK', 'database'),
+    'DIRECTORY': os.getenv('REQUEST_LOGGING_DIRECTORY', os.path.join(LOG_DIR, 'requests')),
+    'ROTATE_BYTES': int(os.getenv('REQUEST_LOGGING_ROTATE_BYTES', str(64 * 1024 * 1024))),
+    'ROTATE_INTERVAL': int(os.getenv('REQUEST_LOGGING_ROTATE_INTERVAL', '3600')),
+    'COMPRESS': os.getenv('REQUEST_LOGGING_COMPRESS', 'True') == 'True',
+    # per path prefix, e.g. {'/static/': {'SAMPLE_RATE': 0}, '/api/': {'BODY_LIMIT': 1024}}
+    'ROUTES': {},
+    'BODY_LIMIT': int(os.getenv('REQUEST_LOGGING_BODY_LIMIT', '4096')),
+    'QUEUE_SIZE': int(os.getenv('REQUEST_LOGGING_QUEUE_SIZE', '10000')),
+    'BATCH_SIZE': int(os.getenv('REQUEST_LOGGING_BATCH_SIZE', '500')),
+    'FLUSH_INTERVAL': float(os.getenv('REQUEST_LOGGING_FLUSH_INTERVAL', '1')),
+    'OVERFLOW': os.getenv('REQUEST_LOGGING_OVERFLOW', 'drop'),
+    'SAMPLE_RATE': float(os.getenv('REQUEST_LOGGING_SAMPLE_RATE', '0.1')),
+}
+
+ACTIVITY_LOG = {
+    'RETENTION_DAYS': int(os.getenv('ACTIVITY_LOG_RETENTION_DAYS', '90')),
+    'PARTITIONS_AHEAD': int(os.getenv('ACTIVITY_LOG_PARTITIONS_AHEAD', '7')),
+    'PRUNE_BATCH_SIZE': int(os.getenv('ACTIVITY_LOG_PRUNE_BATCH_SIZE', '5000')),
+    'PRUNE_PAUSE': float(os.getenv('ACTIVITY_LOG_PRUNE_PAUSE', '0.1')),
+}
+
+TRAFFIC_ROLLUPS = {
+    'ENABLED': os.getenv('TRAFFIC_ROLLUPS', 'True') == 'True',
+    'FLUSH_INTERVAL': float(os.getenv('TRAFFIC_ROLLUPS_FLUSH_INTERVAL', '10')),
+    'MINUTE_RETENTION_HOURS': int(os.getenv('TRAFFIC_ROLLUPS_MINUTE_RETENTION_HOURS', '48')),
+    'HOUR_RETENTION_DAYS': int(os.getenv('TRAFFIC_ROLLUPS_HOUR_RETENTION_DAYS', '400')),
+}
 
 
 SIMPLE_JWT = {
@@ -227,12 +431,46 @@ SIMPLE_JWT = {
     'USER_ID_FIELD': 'id',
     'USER_ID_CLAIM': 'user_id',
     'USER_AUTHENTICATION_RULE': 'rest_framework_simplejwt.authentication.default_user_authentication_rule',
+
+    # Tokens carry the user's token_version, bumping it revokes them
+    'TOKEN_OBTAIN_SERIALIZER': 'gatekeeper.tokens.TokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'gatekeeper.tokens.TokenRefreshSerializer',
+}
+
+# JWTs are signed with RS256 or EdDSA key pairs kept in the database and published at
+# /.well-known/jwks.json, so services verify them locally. rotate_signing_keys adds the
+# next key PUBLISH_AHEAD seconds before it signs; JWT_ALG=HS256 keeps the shared secret
+JWT_SIGNING = {
+    'ALGORITHM': JWT_ALG or 'RS256',
+    'ROTATE_AFTER': int(os.getenv('JWT_KEY_ROTATE_AFTER', str(30 * 86400))),
+    'PUBLISH_AHEAD': int(os.getenv('JWT_KEY_PUBLISH_AHEAD', '3600')),
+    'JWKS_MAX_AGE': int(os.getenv('JWKS_MAX_AGE', '900')),
+    'ACCEPT_HS256': os.getenv('JWT_ACCEPT_HS256', 'True') == 'True',
+}
+
+# validated JWTs and OAuth2 access tokens are cached per worker process until
+# they expire, at most MAX_AGE seconds, so repeated requests skip the signature
+# check and the token and user queries. Token versions changed in other workers
+# are polled every VERSIONS_REFRESH_INTERVAL seconds, revoking JWTs within that time
+AUTH_CACHE = {
+    'ENABLED': os.getenv('AUTH_CACHE', 'True') == 'True',
+    'MAX_ENTRIES': int(os.getenv('AUTH_CACHE_MAX_ENTRIES', '10000')),
+    'MAX_AGE': int(os.getenv('AUTH_CACHE_MAX_AGE', '300')),
+    'VERSIONS_REFRESH_INTERVAL': int(os.getenv('TOKEN_VERSION_REFRESH_INTERVAL', '5')),
+}
+
+# POST api/token/introspect/ answers for a batch of tokens from a per-worker cache,
+# results are served from it and may be memoized by callers for at most MAX_AGE seconds
+TOKEN_INTROSPECTION = {
+    'MAX_TOKENS': int(os.getenv('TOKEN_INTROSPECTION_MAX_TOKENS', '100')),
+    'MAX_AGE': int(os.getenv('TOKEN_INTROSPECTION_MAX_AGE', '30')),
+    'GROUP': os.getenv('TOKEN_INTROSPECTION_GROUP', 'token_introspection'),
 }
 
 REST_FRAMEWORK = {
+    # JWT or OAuth2 access token, told apart by the token's shape
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'oauth2_provider.contrib.rest_framework.OAuth2Authentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'gatekeeper.authentication.BearerTokenAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -240,6 +478,7 @@ REST_FRAMEWORK = {
 }
 
 OAUTH2_PROVIDER = {
+    'OAUTH2_VALIDATOR_CLASS': 'gatekeeper.authentication.CachedOAuth2Validator',
     'ACCESS_TOKEN_EXPIRE_SECONDS': 36000,
     'REFRESH_TOKEN_EXPIRE_SECONDS': 864000,
 
@@ -0,0 +1,204 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+DEFAULT_SERVER_TIMING = {
+    'HEADER': False,                # send the stage timings to clients in a Server-Timing header
+    'HISTOGRAMS': True,             # record per service and stage latency histograms
+}
+
+# Upper bounds in seconds of the histogram buckets, the last bucket takes everything slower
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Service name of requests not proxied to any upstream
+GATEKEEPER_SERVICE = 'gatekeeper'
+
+
+def get_timing_config():
+    config = dict(DEFAULT_SERVER_TIMING)
+    config.update(getattr(settings, 'SERVER_TIMING', {}))
+    return config
+
+
+class RequestTimer:
+    """
+    Durations of the stages of one request, in the order they were first timed. A stage
+    timed several times (e.g. the upstream call of a retried request) adds up.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.service = None
+        self.route = None
+        self.stages = {}
+        self.marks = {}
+        self.recorded = False
+
+    def add(self, stage, duration):
+        self.stages[stage] = self.stages.get(stage, 0) + duration
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add_upstream(self, duration, connect):
+        """
+        Time an upstream call up to its response headers, as the time spent opening a new
+        connection (connect) and the rest (upstream, the time to first byte).
+        """
+        if connect:
+            self.add('connect', connect)
+        self.add('upstream', duration - connect)
+
+    def add_late(self, stage, duration):
+        """
+        Time a stage that ends after the response left the middleware, e.g. sending a
+        streamed body. It is too late for the Server-Timing header, but still goes into the
+        latency histograms.
+        """
+        self.add(stage, duration)
+        if self.recorded:
+            latency_histograms.observe(self.service or GATEKEEPER_SERVICE, stage, duration)
+
+    def mark(self, name):
+        self.marks[name] = time.perf_counter()
+
+    def since(self, stage, mark):
+        """
+        Time a stage as the time passed since an earlier mark.
+        """
+        if mark in self.marks:
+            self.add(stage, time.perf_counter() - self.marks.pop(mark))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def header(self):
+        return ', '.join(f'{stage};dur={duration * 1000:.1f}' for stage, duration in self.stages.items())
+
+
+class NullTimer(RequestTimer):
+    """
+    Stands in for the timer of requests the timing middleware didn't see, e.g. batch items.
+    """
+
+    def add(self, stage, duration):
+        pass
+
+    def mark(self, name):
+        pass
+
+
+def get_timer(request):
+    return getattr(request, '_timer', None) or NullTimer()
+
+
+def mark_view(view):
+    """
+    Mark when a view is called, before DRF authenticates the request, so the view can time
+    authentication with timer.since('auth', 'view').
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        get_timer(request).mark('view')
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket latency histogram, so memory doesn't grow with the number of requests.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, duration):
+        self.counts[bisect.bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.sum += duration
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating inside the bucket it falls in.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.sum / self.count * 1000, 2) if self.count else None,
+            'p50_ms': _ms(self.quantile(0.5)),
+            'p90_ms': _ms(self.quantile(0.9)),
+            'p99_ms': _ms(self.quantile(0.99)),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+class LatencyHistograms:
+    """
+    One LatencyHistogram per (service, stage), for the services of the route table and the
+    stages the timers record, so the number of histograms is bounded too.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, service, stage, duration):
+        with self._lock:
+            histogram = self._histograms.get((service, stage))
+            if histogram is None:
+                histogram = self._histograms[(service, stage)] = LatencyHistogram()
+            histogram.observe(duration)
+
+    def record(self, timer):
+        service = timer.service or GATEKEEPER_SERVICE
+        for stage, duration in timer.stages.items():
+            self.observe(service, stage, duration)
+        timer.recorded = True
+
+    def snapshot(self):
+        with self._lock:
+            services = {}
+            for (service, stage), histogram in sorted(self._histograms.items()):
+                services.setdefault(service, {})[stage] = histogram.snapshot()
+            return services
+
+    def clear(self):
+        with self._lock:
+            self._histograms = {}
+
+
+latency_histograms = LatencyHistograms()
@@ -0,0 +1,37 @@
+from rest_framework_simplejwt import serializers, tokens
+
+from gatekeeper.authentication import TOKEN_VERSION_CLAIM, check_token_version
+
+
+class TokenVersionMixin:
+    """
+    Issues tokens carrying the user's current token_version, so bumping it revokes them.
+    """
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[TOKEN_VERSION_CLAIM] = user.token_version
+        return token
+
+
+class AccessToken(TokenVersionMixin, tokens.AccessToken):
+    pass
+
+
+class RefreshToken(TokenVersionMixin, tokens.RefreshToken):
+    # The access tokens it grants copy its token_version claim
+    access_token_class = AccessToken
+
+
+class TokenObtainPairSerializer(serializers.TokenObtainPairSerializer):
+    token_class = RefreshToken
+
+
+class TokenRefreshSerializer(serializers.TokenRefreshSerializer):
+    token_class = RefreshToken
+
+    def validate(self, attrs):
+        # A revoked refresh token must not grant new access tokens
+        check_token_version(self.token_class(attrs['refresh']))
+        return super().validate(attrs)
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db import DatabaseError, IntegrityError, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from gatekeeper.timing import LatencyHistogram
+
+logger = logging.getLogger('aegis')
+
+DEFAULT_TRAFFIC_ROLLUPS = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL': 10,           # seconds a worker process counts requests before adding them to the rollups
+    'MAX_KEYS': 5000,               # counters a worker keeps between flushes, further users are counted as anonymous
+    'MINUTE_RETENTION_HOURS': 48,   # hours of per-minute rollups kept by prune_activity_log
+    'HOUR_RETENTION_DAYS': 400,     # days of per-hour rollups kept by prune_activity_log
+    'DASHBOARD_MINUTES': 60,        # minutes of the per-minute chart on the dashboard
+    'DASHBOARD_HOURS': 24,          # hours the dashboard's tables cover
+    'DASHBOARD_TOP': 10,            # rows of the dashboard's route and user tables
+}
+
+ROLLUP_KEY = ('bucket', 'route', 'service', 'status_class', 'user_id')
+
+
+def get_traffic_config():
+    config = dict(DEFAULT_TRAFFIC_ROLLUPS)
+    config.update(getattr(settings, 'TRAFFIC_ROLLUPS', {}))
+    return config
+
+
+def status_class(status):
+    return f'{status // 100}xx'
+
+
+def histogram_of(rollup):
+    histogram = LatencyHistogram()
+    if len(rollup.latency_counts) == len(histogram.counts):
+        histogram.counts = list(rollup.latency_counts)
+    histogram.count = rollup.requests
+    histogram.sum = rollup.latency_sum
+    return histogram
+
+
+def add_to_rollups(model, counters):
+    """
+    Add the requests counted per rollup key to the rows of a rollup table. The rows are
+    locked while they are added to, as every worker process adds to the same rows.
+    """
+    buckets = {key[0] for key in counters}
+    routes = {key[1] for key in counters}
+    rows = model.objects.select_for_update().filter(bucket__in=buckets, route__in=routes)
+    existing = {tuple(getattr(row, field) for field in ROLLUP_KEY): row for row in rows}
+    changed = []
+    created = []
+    for key, histogram in counters.items():
+        row = existing.get(key)
+        if row is None:
+            created.append(model(**dict(zip(ROLLUP_KEY, key)), requests=histogram.count,
+                                 latency_sum=histogram.sum, latency_counts=histogram.counts))
+            continue
+        merged = histogram_of(row)
+        merged.merge(histogram)
+        row.requests, row.latency_sum, row.latency_counts = merged.count, merged.sum, merged.counts
+        changed.append(row)
+    model.objects.bulk_update(changed, ['requests', 'latency_sum', 'latency_counts'])
+    model.objects.bulk_create(created)
+
+
+class TrafficCounters:
+    """
+    Counts the requests of this worker process per minute, route, service, status class
+    and user, with a latency histogram each, and adds them to the per-minute and per-hour
+    rollup tables every FLUSH_INTERVAL seconds from the request log writer's thread. The
+    dashboard reads those tables, so its cost doesn't grow with the traffic.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, route, service, status, user_id, duration):
+        config = get_traffic_config()
+        minute = timezone.now().replace(second=0, microsecond=0)
+        key = (minute, route[:200], service[:100], status_class(status), user_id or 0)
+        with self._lock:
+            histogram = self._counters.get(key)
+            if histogram is None and len(self._counters) >= config['MAX_KEYS']:
+                key = key[:-1] + (0,)
+                histogram = self._counters.get(key)
+            if histogram is None:
+                histogram = self._counters[key] = LatencyHistogram()
+            histogram.observe(duration)
+
+    def tick(self):
+        if time.monotonic() - self._flushed >= get_traffic_config()['FLUSH_INTERVAL']:
+            self.flush()
+
+    def flush(self):
+        from aegis.models import TrafficHour, TrafficMinute
+
+        with self._lock:
+            minutes, self._counters = self._counters, {}
+            self._flushed = time.monotonic()
+        if not minutes:
+            return
+        hours = {}
+        for key, histogram in minutes.items():
+            hour_key = (key[0].replace(minute=0),) + key[1:]
+            hours.setdefault(hour_key, LatencyHistogram()).merge(histogram)
+        try:
+            for attempt in range(2):
+                try:
+                    with transaction.atomic():
+                        add_to_rollups(TrafficMinute, minutes)
+                        add_to_rollups(TrafficHour, hours)
+                    break
+                except IntegrityError:
+                    # Another worker created one of the rows meanwhile, the retry adds to it
+                    if attempt:
+                        raise
+        except DatabaseError as e:
+            logger.error(f"Could not add {sum(h.count for h in minutes.values())} requests to the traffic rollups: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._counters = {}
+
+
+traffic_counters = TrafficCounters()
+
+
+@receiver(setting_changed)
+def reset_traffic_counters(setting, **kwargs):
+    if setting == 'TRAFFIC_ROLLUPS':
+        traffic_counters.clear()
+
+
+def prune_rollups(config=None):
+    """
+    Delete the rollups older than their retention. Returns the number of rows deleted.
+    """
+    from aegis.models import TrafficHour, TrafficMinute
+
+    config = config or get_traffic_config()
+    now = timezone.now()
+    deleted = TrafficMinute.objects.filter(
+        bucket__lt=now - timedelta(hours=config['MINUTE_RETENTION_HOURS'])).delete()[0]
+    deleted += TrafficHour.objects.filter(
+        bucket__lt=now - timedelta(days=config['HOUR_RETENTION_DAYS'])).delete()[0]
+    return deleted
+
+
+def latency_summary(histogram):
+    return {
+        'requests': histogram.count,
+        'mean_ms': round(histogram.sum / histogram.count * 1000, 1) if histogram.count else None,
+        'p50_ms': round(histogram.quantile(0.5) * 1000, 1) if histogram.count else None,
+        'p95_ms': round(histogram.quantile(0.95) * 1000, 1) if histogram.count else None,
+        'p99_ms': round(histogram.quantile(0.99) * 1000, 1) if histogram.count else None,
+    }
+
+
+def traffic_summary(config=None):
+    """
+    What the dashboard shows: requests and server errors per minute over the last
+    DASHBOARD_MINUTES, and the requests, error rates and latency percentiles per route,
+    service, status class and user over the last DASHBOARD_HOURS, all read from the
+    rollup tables.
+    """
+    from aegis.models import TrafficHour, TrafficMinute
+
+    config = config or get_traffic_config()
+    now = timezone.now()
+    first_minute = now.replace(second=0, microsecond=0) - timedelta(minutes=config['DASHBOARD_MINUTES'] - 1)
+    per_minute = {}
+    for bucket, status, requests in TrafficMinute.objects.filter(bucket__gte=first_minute) \
+            .values_list('bucket', 'status_class', 'requests'):
+        counts = per_minute.setdefault(bucket, [0, 0])
+        counts[0] += requests
+        counts[1] += requests if status == '5xx' else 0
+    minutes = []
+    for offset in range(config['DASHBOARD_MINUTES']):
+        bucket = first_minute + timedelta(minutes=offset)
+        requests, errors = per_minute.get(bucket, (0, 0))
+        minutes.append({'minute': bucket.isoformat(), 'requests': requests, 'errors': errors})
+
+    first_hour = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=config['DASHBOARD_HOURS'] - 1)
+    groups = {'route': {}, 'service': {}, 'status_class': {}, 'user_id': {}}
+    errors = {'route': {}, 'service': {}}
+    total = LatencyHistogram()
+    for rollup in TrafficHour.objects.filter(bucket__gte=first_hour):
+        histogram = histogram_of(rollup)
+        total.merge(histogram)
+        for field, group in groups.items():
+            group.setdefault(getattr(rollup, field), LatencyHistogram()).merge(histogram)
+        if rollup.status_class == '5xx':
+            for field, group in errors.items():
+                group[getattr(rollup, field)] = group.get(getattr(rollup, field), 0) + rollup.requests
+
+    def rows(field, limit=None):
+        found = sorted(groups[field].items(), key=lambda item: (-item[1].count, str(item[0])))[:limit]
+        return [dict({field: value, 'errors': errors.get(field, {}).get(value, 0)}, **latency_summary(histogram))
+                for value, histogram in found]
+
+    users = rows('user_id', config['DASHBOARD_TOP'])
+    names = dict(get_user_model().objects.filter(pk__in=[row['user_id'] for row in users if row['user_id']])
+                 .values_list('pk', 'username'))
+    for row in users:
+        row['username'] = names.get(row['user_id'], 'anonymous' if not row['user_id'] else f"#{row['user_id']}")
+    return {
+        'minutes': minutes,
+        'hours': config['DASHBOARD_HOURS'],
+        'total': latency_summary(total),
+        'routes': rows('route', config['DASHBOARD_TOP']),
+        'services': rows('service'),
+        'status_classes': rows('status_class'),
+        'users': users,
+    }
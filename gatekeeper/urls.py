@@ -11,8 +11,11 @@ from drf_yasg import openapi
 
 from .views import LoginView, RegisterView, PasswordResetView
 from aegis.views.api import FarmCalendarView, WeatherDataView
+from aegis.views.api.auth import TokenObtainView, CustomTokenRefreshView
 
-from .views import LoginView, RegisterView, PasswordResetView, reverse_proxy
+from .views import LoginView, RegisterView, PasswordResetView, reverse_proxy, async_reverse_proxy, batch, async_batch, \
+    route_table, cache_stats, breaker_states, upstream_instances, upstream_health, latency_stats, metrics, jwks, \
+    introspect_tokens
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -38,8 +41,8 @@ urlpatterns = [
     path('admin/', admin.site.urls),
 
     # path('o/', include('oauth2_provider.urls', namespace='oauth2_provider')),
-    # path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
-    # path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/token/', TokenObtainView.as_view(), name='token_obtain_pair'),
+    path('api/token/refresh/', CustomTokenRefreshView.as_view(), name='token_refresh'),
 
     path('api/farm_calendar/', FarmCalendarView.as_view(), name='farm_calendar'),
     path('api/weather_data/', WeatherDataView.as_view(), name='weather_data'),
@@ -51,11 +54,30 @@ urlpatterns = [
     path('reset_password/', PasswordResetView.as_view(), name='reset_password'),
 
     path('aegis/', include('aegis.urls', namespace='aegis')),
+
+    path('metrics', metrics, name='metrics'),
+    path('.well-known/jwks.json', jwks, name='jwks'),
+    path('api/token/introspect/', introspect_tokens, name='token_introspect'),
 ]
 
 # reverse proxy urls
 urlpatterns += [
-    re_path(r'^api/resources/(?P<path>.*)$', reverse_proxy, name='reverse_proxy'),
+    path('api/proxy/routes/', route_table, name='proxy_route_table'),
+    path('api/proxy/cache/', cache_stats, name='proxy_cache_stats'),
+    path('api/proxy/breakers/', breaker_states, name='proxy_breaker_states'),
+    path('api/proxy/upstreams/', upstream_instances, name='proxy_upstream_instances'),
+    path('api/proxy/health/', upstream_health, name='proxy_upstream_health'),
+    path('api/proxy/latency/', latency_stats, name='proxy_latency_stats'),
+    re_path(
+        r'^api/resources/_batch/?$',
+        async_batch if settings.ASYNC_REVERSE_PROXY else batch,
+        name='reverse_proxy_batch'
+    ),
+    re_path(
+        r'^api/resources/(?P<path>.*)$',
+        async_reverse_proxy if settings.ASYNC_REVERSE_PROXY else reverse_proxy,
+        name='reverse_proxy'
+    ),
 ]
 
 if settings.DEBUG:
@@ -1,13 +1,12 @@
-import jwt
 import logging
 import os
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
 
 from django.views.generic import TemplateView
-from django.conf import settings
 from django.contrib.auth import login as auth_login, logout as auth_logout
 from django.views.decorators.cache import never_cache
+from django.views.decorators.debug import sensitive_post_parameters
 from django.utils.decorators import method_decorator
 from django.shortcuts import render, redirect
 from django.urls import reverse, resolve, Resolver404
@@ -15,6 +14,10 @@ from django.http import HttpResponseRedirect
 
 from gatekeeper.forms import LoginForm, RegisterForm, PasswordResetForm
 from aegis.models import DefaultAuthUserExtend
+from gatekeeper.authentication import TOKEN_VERSION_CLAIM
+from gatekeeper.jwt_keys import encode_token
+from gatekeeper.proxy.registry import service_registry
+from gatekeeper.ratelimit import login_rate_limit
 
 logger = logging.getLogger('aegis')
 
@@ -29,6 +32,7 @@ JWT_EXPIRATION = timedelta(hours=1)
 
 
 @method_decorator(never_cache, name='dispatch')
+@method_decorator(sensitive_post_parameters(), name='dispatch')
 class LoginView(TemplateView):
     template_name = "auth/login.html"
 
@@ -50,16 +54,27 @@ class LoginView(TemplateView):
         return render(request, self.template_name, context)
 
     def post(self, request, *args, **kwargs):
-        form = LoginForm(request, data=request.POST)
         next_url = request.session.get('next', '')
+
+        # Throttle before the form checks the password hash
+        limit = login_rate_limit(request, request.POST.get('username'))
+        if not limit.allowed:
+            context = self.get_context_data(**kwargs)
+            context['form'] = LoginForm(initial={'next': next_url})
+            context['next'] = next_url
+            context['errors'] = ['Too many login attempts. Please try again later.']
+            return limit.annotate(render(request, self.template_name, context, status=429))
+
+        form = LoginForm(request, data=request.POST)
         if form.is_valid():
             user = form.get_user()
             auth_login(request, user)
 
             # Generate tokens
-            jwt_token = self.generate_token(user.id, settings.JWT_SIGNING_KEY, JWT_EXPIRATION)
+            jwt_token = self.generate_token(user, JWT_EXPIRATION)
 
-            service_post_auth_url = settings.AVAILABLE_SERVICES.get(next_url, {}).get('post_auth')
+            services = service_registry.refresh_if_stale().services
+            service_post_auth_url = services.get(next_url, {}).get('post_auth')
             # redirect to external service if it's
             # registered with a post_auth url in the available services
             if service_post_auth_url is not None:
@@ -98,19 +113,22 @@ class LoginView(TemplateView):
         except Resolver404:
             return False
 
-    def generate_token(self, user_id, secret, expiration):
+    def generate_token(self, user, expiration):
         """
-        Generate a JWT token.
+        Generate a JWT token, signed with the current key of the key ring. It carries the
+        user's token_version, so bumping it revokes the token.
         """
         payload = {
-            'user_id': user_id,
+            'user_id': user.id,
+            TOKEN_VERSION_CLAIM: user.token_version,
             'exp': datetime.utcnow() + expiration,
             'iat': datetime.utcnow()
         }
-        return jwt.encode(payload, secret, algorithm='HS256')
+        return encode_token(payload)
 
 
 @method_decorator(never_cache, name='dispatch')
+@method_decorator(sensitive_post_parameters(), name='dispatch')
 class RegisterView(TemplateView):
     form_class = RegisterForm
     template_name = 'auth/register.html'
@@ -137,6 +155,7 @@ class RegisterView(TemplateView):
 
 
 @method_decorator(never_cache, name='dispatch')
+@method_decorator(sensitive_post_parameters(), name='dispatch')
 class PasswordResetView(TemplateView):
     template_name = 'auth/password_reset.html'
     form_class = PasswordResetForm
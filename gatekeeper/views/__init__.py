@@ -1,2 +1,8 @@
 from .AuthV import LoginView, RegisterView, PasswordResetView
-from .api_reverse_proxy import reverse_proxy
+from .api_reverse_proxy import reverse_proxy, batch
+from .api_async_reverse_proxy import async_reverse_proxy, async_batch
+from .proxy_status import route_table, cache_stats, breaker_states, upstream_instances, upstream_health, \
+    latency_stats
+from .metrics import metrics
+from .jwks import jwks
+from .introspection import introspect_tokens
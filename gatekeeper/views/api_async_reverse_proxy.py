@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from gatekeeper.metrics import UPSTREAM_RESPONSES
+from gatekeeper.proxy.async_upstream import ConnectTrace, async_upstream_pool
+from gatekeeper.proxy.balancer import load_balancers
+from gatekeeper.proxy.batch import (
+    BatchError, parse_batch, get_batch_config, sub_request, item_result, error_result, aresponse_body
+)
+from gatekeeper.proxy.cache import (
+    proxy_cache, get_cache_policy, cache_key, request_scope, cached_response, snapshot_response, CONDITIONAL_HEADERS
+)
+from gatekeeper.proxy.health import unhealthy_response
+from gatekeeper.proxy.registry import service_registry, get_route_index
+from gatekeeper.proxy.request_body import PassthroughParser, prepare_async_request_body
+from gatekeeper.proxy.resilience import (
+    upstream_guards, get_retry_config, can_retry, backoff_delay, breaker_open_response
+)
+from gatekeeper.proxy.singleflight import async_single_flight
+from gatekeeper.proxy.streaming import build_async_proxy_response
+from gatekeeper.proxy.upstream import upstream_pool, forwardable_headers
+from gatekeeper.ratelimit import aproxy_rate_limit
+from gatekeeper.timing import get_timer
+
+logger = logging.getLogger('aegis')
+
+ALLOWED_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+
+def authenticate(request):
+    """
+    Run the DRF authentication classes against the request, like @api_view does for the
+    sync proxy. Returns the authenticated user, or None.
+    """
+    drf_request = Request(
+        request,
+        parsers=[PassthroughParser()],
+        authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+    )
+    user = drf_request.user
+    return user if user is not None and user.is_authenticated else None
+
+
+async def authentication_error(request):
+    """
+    Authenticate the request, returning the 401 response when it can't be.
+    """
+    # DRF sets request.user on the Django request as a side effect, so the
+    # logging middleware sees the authenticated user as it does for the sync proxy
+    try:
+        user = await sync_to_async(authenticate)(request)
+    except AuthenticationFailed as e:
+        return JsonResponse({'detail': e.detail}, status=e.status_code)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    return None
+
+
+@csrf_exempt
+async def async_reverse_proxy(request, path):
+    """
+    Reverse proxy running natively on the event loop when served through gatekeeper.asgi,
+    so waiting on an upstream doesn't hold a worker thread. Authentication is the only step
+    that still runs in a thread, since the authentication classes query the database.
+    """
+    if request.method not in ALLOWED_METHODS:
+        return JsonResponse({'error': 'Method not supported'}, status=405)
+
+    timer = get_timer(request)
+    with timer.stage('auth'):
+        error = await authentication_error(request)
+    if error is not None:
+        return error
+
+    with timer.stage('route'):
+        route = (await service_registry.arefresh_if_stale()).route_index.resolve(path)
+    if route is None or not route.api:
+        return JsonResponse({'error': 'No service can provide this resource.'}, status=405)
+    timer.service = route.service
+    timer.route = route.entity
+
+    with timer.stage('ratelimit'):
+        limit = await aproxy_rate_limit(request, route)
+    if not limit.allowed:
+        return limit.response()
+
+    # Forward the request headers, GET requests go through the response cache
+    headers = forwardable_headers(request.headers)
+    if request.method == 'GET':
+        response = await cached_get(request, route, path, headers)
+    else:
+        response = await forward(request, route, path, headers)
+    return limit.annotate(response)
+
+
+@csrf_exempt
+async def async_batch(request):
+    """
+    Async counterpart of the batch view, running the sub-requests as concurrent tasks on
+    the event loop.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not supported'}, status=405)
+    error = await authentication_error(request)
+    if error is not None:
+        return error
+    try:
+        items, stream = parse_batch(request.body)
+    except BatchError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    await service_registry.arefresh_if_stale()
+    config = get_batch_config()
+    semaphore = asyncio.Semaphore(config['MAX_CONCURRENCY'])
+
+    async def run(item):
+        async with semaphore:
+            return await proxy_item(request, item, config['MAX_BODY_SIZE'])
+
+    tasks = [asyncio.ensure_future(run(item)) for item in items]
+    if stream:
+        async def results():
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task).encode() + b'\n'
+        return StreamingHttpResponse(results(), content_type='application/x-ndjson')
+    return JsonResponse({'responses': await asyncio.gather(*tasks)})
+
+
+async def proxy_item(request, item, body_limit):
+    try:
+        sub, path = sub_request(request, item)
+        route = get_route_index().resolve(path)
+        if route is None or not route.api:
+            return error_result(item, 405, 'No service can provide this resource.')
+        limit = await aproxy_rate_limit(sub, route)
+        if not limit.allowed:
+            response = limit.response()
+        elif sub.method == 'GET':
+            response = await cached_get(sub, route, path, forwardable_headers(sub.headers))
+        else:
+            response = await forward(sub, route, path, forwardable_headers(sub.headers))
+        body = await aresponse_body(response, body_limit)
+    except Exception as e:
+        logger.error(f"Batch request {item['id']} failed: {e}")
+        return error_result(item, 500, 'The request failed.')
+    if body is None:
+        return error_result(item, 502, 'The response is too large for a batch.')
+    return item_result(item, response, body)
+
+
+async def cached_get(request, route, path, headers):
+    policy = get_cache_policy(route.entity)
+    key = cache_key(
+        route.service, path, request.GET, request_scope(request, policy),
+        request.headers.get('Accept', ''), request.headers.get('Accept-Encoding', ''))
+    entry = None
+    if policy['ENABLED']:
+        with get_timer(request).stage('cache'):
+            entry, fresh = proxy_cache.lookup(key)
+        if fresh:
+            return cached_response(request, entry, 'HIT')
+
+    # The upstream response may be shared with coalesced requests, so the client's own
+    # conditional headers are answered by cached_response instead of being forwarded
+    for header in CONDITIONAL_HEADERS:
+        headers.pop(header, None)
+    if entry is not None:
+        # Revalidate the stale entry instead of fetching the whole body again
+        headers['If-None-Match'] = entry.headers['ETag']
+
+    async def fetch():
+        response = await forward(request, route, path, headers)
+        if entry is not None and response.status_code == 304:
+            return None, proxy_cache.revalidated(key, entry, response, policy), 'REVALIDATED'
+        if policy['ENABLED']:
+            proxy_cache.store(key, response, policy)
+        return response, snapshot_response(response), 'MISS'
+
+    # Identical concurrent GETs wait for the one already in flight and share its response
+    result, shared = await async_single_flight.do(key, fetch, timeout=sum(upstream_pool.get_timeout(route.service)))
+    if result is None or (shared and result[1] is None):
+        # The shared call failed, timed out or streamed its body, so make our own
+        result, shared = await fetch(), False
+    response, snapshot, cache_status = result
+    if snapshot is not None:
+        return cached_response(request, snapshot, 'COALESCED' if shared else cache_status)
+    response['X-Cache'] = cache_status
+    return response
+
+
+async def forward(request, route, path, headers):
+    service_name = route.service
+    method = request.method
+
+    # Fail fast while the service's circuit breaker is open
+    breaker = upstream_guards.breaker(service_name)
+    if not breaker.allow_request():
+        return breaker_open_response(breaker)
+
+    # and while the health prober finds every instance of the service unhealthy
+    balancer = load_balancers.get(service_name)
+    if not balancer.healthy():
+        return unhealthy_response(service_name)
+
+    # Forward the request body, streaming large bodies in both directions
+    client = async_upstream_pool.get_client(service_name)
+    params = dict(request.GET.lists()) if method == 'GET' else None
+    content = prepare_async_request_body(request, service_name) if method != 'GET' else None
+
+    # Send the request to one of the service's instances, retrying failed idempotent
+    # requests on another instance with jittered backoff while the retry budget allows
+    instance = None
+    timer = get_timer(request)
+    retry_config = get_retry_config(service_name)
+    upstream_guards.retry_budget(service_name).deposit()
+    attempt = 0
+    try:
+        while True:
+            attempt += 1
+            instance = balancer.acquire(exclude=instance)
+            started = time.monotonic()
+            trace = ConnectTrace()
+            upstream_request = client.build_request(
+                method, f"{instance.url}{path}", headers=headers, params=params, content=content,
+                extensions={'trace': trace})
+            try:
+                # stream=True returns once the headers are in, so this is the time to first
+                # byte; the time spent opening a new connection is timed apart
+                response = await client.send(upstream_request, stream=True)
+            except httpx.HTTPError as e:
+                timer.add_upstream(time.monotonic() - started, trace.duration)
+                balancer.release(instance, False, time.monotonic() - started)
+                breaker.record(False, time.monotonic() - started)
+                UPSTREAM_RESPONSES.inc(
+                    service=service_name, status='timeout' if isinstance(e, httpx.TimeoutException) else 'error')
+                if not can_retry(method, content, attempt, service_name):
+                    raise
+                logger.warning(f"{service_name} request failed, retrying: {e}")
+            else:
+                timer.add_upstream(time.monotonic() - started, trace.duration)
+                balancer.release(instance, response.status_code < 500, time.monotonic() - started)
+                breaker.record(response.status_code < 500, time.monotonic() - started)
+                UPSTREAM_RESPONSES.inc(service=service_name, status=response.status_code)
+                if response.status_code not in retry_config['RETRY_STATUSES'] or \
+                        not can_retry(method, content, attempt, service_name):
+                    return await build_async_proxy_response(
+                        response, service_name, request.headers.get('Accept-Encoding', ''), timer)
+                await response.aclose()
+                logger.warning(f"{service_name} answered {response.status_code}, retrying")
+            await asyncio.sleep(backoff_delay(retry_config, attempt))
+    except httpx.TimeoutException as e:
+        logger.error(f"{service_name} request timed out: {e}")
+        return JsonResponse({'error': 'Upstream service timed out.'}, status=504)
+    except httpx.HTTPError as e:
+        logger.error(f"{service_name} request failed: {e}")
+        return JsonResponse({'error': 'Service Unavailable'}, status=503)
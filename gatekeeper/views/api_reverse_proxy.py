@@ -1,43 +1,234 @@
-from django.http import JsonResponse, HttpResponse
-from django.conf import settings
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.http import JsonResponse, StreamingHttpResponse
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, parser_classes
 
 import requests
 
+from gatekeeper.metrics import UPSTREAM_RESPONSES
+from gatekeeper.proxy.balancer import load_balancers
+from gatekeeper.proxy.batch import (
+    BatchError, parse_batch, get_batch_config, sub_request, item_result, error_result, response_body
+)
+from gatekeeper.proxy.cache import (
+    proxy_cache, get_cache_policy, cache_key, request_scope, cached_response, snapshot_response, CONDITIONAL_HEADERS
+)
+from gatekeeper.proxy.health import unhealthy_response
+from gatekeeper.proxy.registry import service_registry, get_route_index
+from gatekeeper.proxy.request_body import PassthroughParser, prepare_request_body
+from gatekeeper.proxy.resilience import (
+    upstream_guards, get_retry_config, can_retry, backoff_delay, breaker_open_response
+)
+from gatekeeper.proxy.singleflight import single_flight
+from gatekeeper.proxy.streaming import build_proxy_response
+from gatekeeper.proxy.upstream import connect_time, upstream_pool, forwardable_headers
+from gatekeeper.ratelimit import proxy_rate_limit
+from gatekeeper.timing import get_timer, mark_view
+
+logger = logging.getLogger('aegis')
+
+
+@mark_view
 @api_view(['GET', 'POST', 'PUT', 'DELETE'])
 @permission_classes([IsAuthenticated])
+@parser_classes([PassthroughParser])
 def reverse_proxy(request, path):
+    # DRF has authenticated the request by now
+    timer = get_timer(request)
+    timer.since('auth', 'view')
 
-    provider_api = None
-    for open_agri_entity, resource_provider_id in settings.REVERSE_PROXY_MAPPING.items():
-        if open_agri_entity in path:
-            provider_api = settings.AVAILABLE_SERVICES.get(resource_provider_id, {}).get('api')
-    if provider_api is None:
+    with timer.stage('route'):
+        route = service_registry.refresh_if_stale().route_index.resolve(path)
+    if route is None or not route.api:
         return JsonResponse({'error': 'No service can provide this resource.'}, status=405)
+    timer.service = route.service
+    timer.route = route.entity
 
-    url = f"{provider_api}{path}"
-    method = request.method
+    with timer.stage('ratelimit'):
+        limit = proxy_rate_limit(request, route)
+    if not limit.allowed:
+        return limit.response()
 
-    # Forward the request headers and body
-    headers = {key: value for key, value in request.headers.items() if key != 'Host'}
-    data = request.body
-
-    # Forward the request based on the HTTP method
-    if method == 'POST':
-        response = requests.post(url, headers=headers, data=data)
-    elif method == 'GET':
-        response = requests.get(url, headers=headers, params=request.GET)
-    elif method == 'PUT':
-        response = requests.put(url, headers=headers, data=data)
-    elif method == 'DELETE':
-        response = requests.delete(url, headers=headers, data=data)
+    # Forward the request headers, GET requests go through the response cache
+    headers = forwardable_headers(request.headers)
+    if request.method == 'GET':
+        response = cached_get(request, route, path, headers)
     else:
-        return JsonResponse({'error': 'Method not supported'}, status=405)
-
-    # Create a Django response object with the same status code and content
-    return HttpResponse(
-        response.content,
-        status=response.status_code,
-        content_type=response.headers.get('Content-Type', 'application/json')
-    )
+        response = forward(request, route, path, headers)
+    return limit.annotate(response)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@parser_classes([PassthroughParser])
+def batch(request):
+    """
+    Proxy a list of sub-requests in one call, authenticated once and sent upstream
+    concurrently. Answers {"responses": [...]} in request order, or with "stream": true an
+    NDJSON stream with one line per sub-response as soon as it completes.
+    """
+    try:
+        items, stream = parse_batch(request.body)
+    except BatchError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # The items resolve their routes on the snapshot current now
+    service_registry.refresh_if_stale()
+    config = get_batch_config()
+    executor = ThreadPoolExecutor(max_workers=min(config['MAX_CONCURRENCY'], len(items)))
+    futures = [executor.submit(proxy_item, request, item, config['MAX_BODY_SIZE']) for item in items]
+    executor.shutdown(wait=False)
+
+    if stream:
+        def results():
+            for future in as_completed(futures):
+                yield json.dumps(future.result()).encode() + b'\n'
+        return StreamingHttpResponse(results(), content_type='application/x-ndjson')
+    return JsonResponse({'responses': [future.result() for future in futures]})
+
+
+def proxy_item(request, item, body_limit):
+    """
+    Proxy one batch item through the same routing, rate limits, cache and upstream calls
+    as a request of its own.
+    """
+    try:
+        sub, path = sub_request(request, item)
+        route = get_route_index().resolve(path)
+        if route is None or not route.api:
+            return error_result(item, 405, 'No service can provide this resource.')
+        limit = proxy_rate_limit(sub, route)
+        if not limit.allowed:
+            response = limit.response()
+        elif sub.method == 'GET':
+            response = cached_get(sub, route, path, forwardable_headers(sub.headers))
+        else:
+            response = forward(sub, route, path, forwardable_headers(sub.headers))
+        body = response_body(response, body_limit)
+    except Exception as e:
+        logger.error(f"Batch request {item['id']} failed: {e}")
+        return error_result(item, 500, 'The request failed.')
+    if body is None:
+        return error_result(item, 502, 'The response is too large for a batch.')
+    return item_result(item, response, body)
+
+
+def cached_get(request, route, path, headers):
+    policy = get_cache_policy(route.entity)
+    key = cache_key(
+        route.service, path, request.GET, request_scope(request, policy),
+        request.headers.get('Accept', ''), request.headers.get('Accept-Encoding', ''))
+    entry = None
+    if policy['ENABLED']:
+        with get_timer(request).stage('cache'):
+            entry, fresh = proxy_cache.lookup(key)
+        if fresh:
+            return cached_response(request, entry, 'HIT')
+
+    # The upstream response may be shared with coalesced requests, so the client's own
+    # conditional headers are answered by cached_response instead of being forwarded
+    for header in CONDITIONAL_HEADERS:
+        headers.pop(header, None)
+    if entry is not None:
+        # Revalidate the stale entry instead of fetching the whole body again
+        headers['If-None-Match'] = entry.headers['ETag']
+
+    def fetch():
+        response = forward(request, route, path, headers)
+        if entry is not None and response.status_code == 304:
+            return None, proxy_cache.revalidated(key, entry, response, policy), 'REVALIDATED'
+        if policy['ENABLED']:
+            proxy_cache.store(key, response, policy)
+        return response, snapshot_response(response), 'MISS'
+
+    # Identical concurrent GETs wait for the one already in flight and share its response
+    result, shared = single_flight.do(key, fetch, timeout=sum(upstream_pool.get_timeout(route.service)))
+    if result is None or (shared and result[1] is None):
+        # The shared call failed, timed out or streamed its body, so make our own
+        result, shared = fetch(), False
+    response, snapshot, cache_status = result
+    if snapshot is not None:
+        return cached_response(request, snapshot, 'COALESCED' if shared else cache_status)
+    response['X-Cache'] = cache_status
+    return response
+
+
+def forward(request, route, path, headers):
+    service_name = route.service
+    method = request.method
+
+    # Fail fast while the service's circuit breaker is open
+    breaker = upstream_guards.breaker(service_name)
+    if not breaker.allow_request():
+        return breaker_open_response(breaker)
+
+    # and while the health prober finds every instance of the service unhealthy
+    balancer = load_balancers.get(service_name)
+    if not balancer.healthy():
+        return unhealthy_response(service_name)
+
+    # Forward the request body without buffering large bodies in memory
+    data = prepare_request_body(request, service_name) if method != 'GET' else None
+    params = request.GET if method == 'GET' else None
+
+    # Forward the request through the service's pooled keep-alive session to one of its
+    # instances, retrying failed idempotent requests on another instance with jittered
+    # backoff while the retry budget allows
+    instance = None
+    session = upstream_pool.get_session(service_name)
+    timeout = upstream_pool.get_timeout(service_name)
+    timer = get_timer(request)
+    retry_config = get_retry_config(service_name)
+    upstream_guards.retry_budget(service_name).deposit()
+    attempt = 0
+    try:
+        while True:
+            attempt += 1
+            instance = balancer.acquire(exclude=instance)
+            started = time.monotonic()
+            connect_time()
+            try:
+                # stream=True returns once the headers are in, so this is the time to first
+                # byte; the time spent opening a new connection is timed apart
+                response = session.request(
+                    method, f"{instance.url}{path}", headers=headers, params=params, data=data, timeout=timeout,
+                    stream=True)
+            except requests.exceptions.RequestException as e:
+                timer.add_upstream(time.monotonic() - started, connect_time())
+                balancer.release(instance, False, time.monotonic() - started)
+                breaker.record(False, time.monotonic() - started)
+                UPSTREAM_RESPONSES.inc(service=service_name, status='timeout' if isinstance(
+                    e, requests.exceptions.Timeout) else 'error')
+                if not can_retry(method, data, attempt, service_name):
+                    raise
+                logger.warning(f"{service_name} request failed, retrying: {e}")
+            else:
+                timer.add_upstream(time.monotonic() - started, connect_time())
+                balancer.release(instance, response.status_code < 500, time.monotonic() - started)
+                breaker.record(response.status_code < 500, time.monotonic() - started)
+                UPSTREAM_RESPONSES.inc(service=service_name, status=response.status_code)
+                if response.status_code not in retry_config['RETRY_STATUSES'] or \
+                        not can_retry(method, data, attempt, service_name):
+                    # Create a Django response object with the same status code and content,
+                    # streaming it through when it is too large to buffer
+                    return build_proxy_response(
+                        response, service_name, request.headers.get('Accept-Encoding', ''), timer)
+                response.close()
+                logger.warning(f"{service_name} answered {response.status_code}, retrying")
+            time.sleep(backoff_delay(retry_config, attempt))
+            if hasattr(data, 'seek'):
+                data.seek(0)
+    except requests.exceptions.Timeout as e:
+        logger.error(f"{service_name} request timed out: {e}")
+        return JsonResponse({'error': 'Upstream service timed out.'}, status=504)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"{service_name} request failed: {e}")
+        return JsonResponse({'error': 'Service Unavailable'}, status=503)
+    finally:
+        if hasattr(data, 'close'):
+            data.close()
+
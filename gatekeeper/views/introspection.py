@@ -0,0 +1,52 @@
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.debug import sensitive_post_parameters
+from rest_framework import status
+from oauth2_provider.models import Application
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import BasePermission
+from rest_framework.response import Response
+
+from gatekeeper.introspection import get_introspection_config, introspect
+
+
+class IsIntrospectionClient(BasePermission):
+    """
+    Downstream services: OAuth2 client credentials applications, and staff users or members
+    of the TOKEN_INTROSPECTION GROUP. Any other user would learn whose tokens they hold.
+    """
+
+    def has_permission(self, request, view):
+        application = getattr(request.auth, 'application', None)
+        if application is not None and \
+                application.authorization_grant_type == Application.GRANT_CLIENT_CREDENTIALS:
+            return True
+        user = request.user
+        if not user or not user.is_authenticated:
+            return False
+        return user.is_staff or user.groups.filter(name=get_introspection_config()['GROUP']).exists()
+
+
+@sensitive_post_parameters()
+@api_view(['POST'])
+@permission_classes([IsIntrospectionClient])
+def introspect_tokens(request):
+    """
+    Introspect a batch of tokens for a downstream service: {"tokens": [...]} is answered
+    with {"results": [...]} in the same order, each result {"active": false} or the
+    token's user_id, token_version, groups and exp. The response may be memoized for as
+    long as its Cache-Control max-age says.
+    """
+    config = get_introspection_config()
+    tokens = request.data.get('tokens') if isinstance(request.data, dict) else None
+    if not isinstance(tokens, list) or not all(isinstance(token, str) and token for token in tokens):
+        return Response({'error': 'Expected {"tokens": [...]} with a list of token strings.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if len(tokens) > config['MAX_TOKENS']:
+        return Response({'error': f"At most {config['MAX_TOKENS']} tokens can be introspected at once."},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    results, max_age = introspect(tokens, config)
+    response = Response({'results': results})
+    patch_cache_control(response, private=True, max_age=max_age)
+    patch_vary_headers(response, ('Authorization',))
+    return response
@@ -0,0 +1,16 @@
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+from gatekeeper.jwt_keys import get_jwt_signing_config, key_ring
+
+
+@require_GET
+def jwks(request):
+    """
+    Publish the public keys verifying the gatekeeper's JWTs, so services can check tokens
+    locally. The next key is listed before it signs, so a copy cached for JWKS_MAX_AGE
+    seconds never misses the key of a fresh token.
+    """
+    response = JsonResponse(key_ring.jwks())
+    response['Cache-Control'] = f"public, max-age={int(get_jwt_signing_config()['JWKS_MAX_AGE'])}"
+    return response
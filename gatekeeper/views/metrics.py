@@ -0,0 +1,34 @@
+import hmac
+import ipaddress
+
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+
+from gatekeeper.metrics import get_metrics_config, render
+
+
+def is_loopback(address):
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+@require_GET
+def metrics(request):
+    """
+    Serve the metrics of all worker processes in the Prometheus text format. When
+    METRICS['TOKEN'] is set the scraper must send it as a bearer token; without one only
+    scrapers on the same host are answered, the labels name internal upstream URLs.
+    """
+    config = get_metrics_config()
+    token = config['TOKEN']
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return HttpResponseForbidden()
+    elif not is_loopback(request.META.get('REMOTE_ADDR')):
+        return HttpResponseForbidden()
+    if not config['ENABLED']:
+        return HttpResponse(status=404)
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
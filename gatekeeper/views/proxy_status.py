@@ -0,0 +1,74 @@
+from rest_framework.permissions import IsAdminUser
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from gatekeeper.proxy.balancer import load_balancers
+from gatekeeper.proxy.cache import proxy_cache
+from gatekeeper.proxy.health import health_registry
+from gatekeeper.proxy.resilience import upstream_guards
+from gatekeeper.proxy.registry import service_registry
+from gatekeeper.proxy.singleflight import single_flight, async_single_flight
+from gatekeeper.timing import latency_histograms
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def route_table(request):
+    """
+    List the resolved reverse proxy route table and the registry version it was built from.
+    """
+    snapshot = service_registry.refresh_if_stale()
+    routes = [route._asdict() for route in snapshot.route_index.routes()]
+    return Response({'version': snapshot.version, 'routes': routes})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """
+    Hit/miss counters and size of the proxy response cache, and how many requests were
+    coalesced onto an identical upstream call already in flight.
+    """
+    stats = proxy_cache.stats()
+    stats['coalesced'] = single_flight.coalesced + async_single_flight.coalesced
+    return Response(stats)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def breaker_states(request):
+    """
+    State and rolling window counters of the circuit breaker of every upstream service
+    this worker process has called.
+    """
+    return Response({'breakers': upstream_guards.snapshot()})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def upstream_instances(request):
+    """
+    In-flight calls, moving average latency and ejection state of every upstream instance
+    this worker process has balanced requests over.
+    """
+    return Response({'services': load_balancers.snapshot()})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def upstream_health(request):
+    """
+    Rolling probe success rate, latency and health of every upstream instance the health
+    prober of this worker process has checked.
+    """
+    return Response({'services': health_registry.snapshot()})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def latency_stats(request):
+    """
+    Latency histograms and percentile estimates of every request stage, per upstream
+    service ('gatekeeper' for requests that weren't proxied).
+    """
+    return Response({'services': latency_histograms.snapshot()})
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gatekeeper.settings')
 
 application = get_wsgi_application()
+
+# Probe the upstream instances and write the request log in the background of every
+# worker process, once the apps are loaded
+from gatekeeper.proxy.health import start_health_monitor  # noqa: E402
+from gatekeeper.request_log import start_request_log_writer  # noqa: E402
+
+start_health_monitor()
+start_request_log_writer()
@@ -0,0 +1,19 @@
+import glob
+import logging
+import os
+
+import uvicorn
+
+host = os.getenv('APP_HOST', '0.0.0.0')
+port = int(os.getenv('APP_PORT', '9000'))
+workers = int(os.getenv('APP_WORKERS', '1'))
+
+logging.basicConfig(filename='logs/uvicorn.log', level=logging.INFO)
+
+# Metrics files of the workers of an earlier run would be counted again
+metrics_dir = os.getenv('METRICS_MULTIPROCESS_DIR')
+if metrics_dir:
+    for path in glob.glob(os.path.join(metrics_dir, 'metrics_*.db')):
+        os.remove(path)
+
+uvicorn.run('gatekeeper.asgi:application', host=host, port=port, workers=workers, lifespan='off')
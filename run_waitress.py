@@ -1,9 +1,21 @@
+import glob
 import logging
+import signal
+import sys
 import warnings
 import os
 
-from waitress import serve
-from gatekeeper.wsgi import application
+from waitress import create_server
+
+# Metrics files of the processes of an earlier run would be counted again. Removed before
+# the application is loaded, so the file of this process is never removed.
+metrics_dir = os.getenv('METRICS_MULTIPROCESS_DIR')
+if metrics_dir:
+    for path in glob.glob(os.path.join(metrics_dir, 'metrics_*.db')):
+        os.remove(path)
+
+from gatekeeper.metrics import watch_waitress  # noqa: E402
+from gatekeeper.wsgi import application  # noqa: E402
 
 host = os.getenv('APP_HOST', '0.0.0.0')
 port = int(os.getenv('APP_PORT', '9000'))
@@ -12,4 +24,9 @@ logging.basicConfig(filename='logs/waitress.log', level=logging.INFO)
 
 warnings.filterwarnings("ignore")
 
-serve(application, host=host, port=port)
+# Exit normally on SIGTERM, so the queued request log records are written out
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+server = create_server(application, host=host, port=port)
+watch_waitress(server.task_dispatcher)
+server.run()